@@ -0,0 +1,164 @@
+import re
+import string
+import zipfile
+from itertools import islice
+
+from app.binding import COMPUTED_FIELDS
+from app.config import load_section
+from app.output import PdfOutput
+from app.pdfstream import Progress
+from app.tpdf import BATCH_ROWS, TPdf, registry
+
+# настройки архива по умолчанию (config.load_section), например
+# TPDF_ARCHIVE_NAME="{last_name}_{n}"
+CONFIG = {
+    # шаблон имени pdf записи в архиве: поля строки данных и вычисляемые
+    # поля в фигурных скобках, n - номер строки с 1
+    "name": "{n:05d}",
+    # уровень сжатия zip (1-9): pdf уже сжат, выигрыш небольшой
+    "compresslevel": 1,
+}
+
+# символы, недопустимые в именах файлов (windows) и управляющие
+UNSAFE_CHARS = re.compile(r'[\\/:*?"<>|\x00-\x1f]')
+MAX_NAME = 120
+
+
+def load_config():
+    """Настройки архива с учётом переменных окружения"""
+    return load_section("archive", CONFIG)
+
+
+def check_name_template(template):
+    """Проверяет синтаксис шаблона имени файла
+
+    :raises ValueError: непарные скобки и т.п.
+    """
+    for literal, field, spec, conversion in string.Formatter().parse(template):
+        if field == "":
+            raise ValueError("В шаблоне имени нужны имена полей: {поле}")
+
+
+class RowNames(dict):
+    """Значения для шаблона имени: поля строки, вычисляемые поля, пусто"""
+
+    def __missing__(self, key):
+        computed = COMPUTED_FIELDS.get(key)
+        return "" if computed is None else computed.fn(self)
+
+
+def record_name(template, row, n):
+    """Имя pdf записи номер n (с 1) по шаблону template
+
+    Если по шаблону имя не получилось (пустое или ошибка формата значения),
+    используется номер строки
+    """
+    try:
+        name = template.format_map(RowNames(row, n=n))
+    except (ValueError, TypeError, KeyError, IndexError, AttributeError):
+        name = ""
+    name = UNSAFE_CHARS.sub("_", name).strip(" .")[:MAX_NAME]
+    return name or "{:05d}".format(n)
+
+
+class ArchiveWriter:
+    """Обёртка над output для zipfile: без seek zipfile считает смещения
+    файлов по результату write, а потоковые writer (streaming.QueueWriter
+    и т.п.) его не возвращают"""
+
+    def __init__(self, f):
+        self.f = f
+        self.size = 0
+
+    def write(self, data):
+        self.f.write(data)
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        if hasattr(self.f, "flush"):
+            self.f.flush()
+
+
+def write_zip(complete, rows, output, name=None, fill_x=False, options=None,
+              progress=None, compresslevel=None, render=None):
+    """По pdf на каждую строку данных в zip архив в output
+
+    Архив пишется потоком: каждый pdf сразу по мере генерации сжимается в
+    архив, временных файлов нет. В памяти - наложения одной пачки строк
+    (BATCH_ROWS) и страницы одной записи. output может быть без seek
+    (сокет, sock.makefile("wb")) - тогда размеры файлов пишутся после их
+    данных, и архив можно распаковывать, не дожидаясь его конца.
+    :param complete: комплект документов для каждой строки, как в
+        TPdf.get_complete - список пар (имя шаблона, количество копий)
+    :param rows: итератор строк данных (словарей)
+    :param output: объект с методом write(bytes)
+    :param name: шаблон имени файла записи, по умолчанию - CONFIG["name"]
+    :param options: параметры вывода pdf (output.OutputOptions)
+    :param progress: callback(rows, rows_per_sec)
+    :param render: функция (complete, rows, fill_x) -> пары (строка, страницы
+        её комплекта), по умолчанию iter_records - рисование в этом потоке
+    :return: статистика: строки, время, строк в секунду, страницы, байты pdf
+        и размер архива
+    """
+    config = load_config()
+    name = name or config["name"]
+    check_name_template(name)
+    form_objects = [obj for doc_name in dict(complete) for obj in registry.get(doc_name).shared]
+    counter = Progress(progress)
+    pages = size = 0
+    names = set()
+    output = ArchiveWriter(output)
+    with zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED,
+                         compresslevel=compresslevel or config["compresslevel"]) as archive:
+        for row, record in (render or iter_records)(complete, rows, fill_x):
+            file_name = unique_name(record_name(name, row, counter.rows + 1), names)
+            # время, сжатие и его уровень файла - от архива
+            with archive.open(file_name + ".pdf", "w") as f:
+                pdf_output = PdfOutput(f, options)
+                with pdf_output as pdf_writer:
+                    # копии документа ссылаются на одни и те же страницы
+                    pdf_writer.share(*form_objects, *record)
+                    for page in record:
+                        pdf_writer.add_page(page)
+                        pages += 1
+            size += pdf_output.bytes
+            # запись целиком - клиенту, не дожидаясь следующей
+            output.flush()
+            counter.step()
+    counter.report()
+    return dict(counter.stats(), pages=pages, bytes=size, archive_bytes=output.size)
+
+
+def iter_records(complete, rows, fill_x=False):
+    """Строки данных и страницы их комплектов документов: генератор пар
+    (строка, страницы), документы рисуются пачками по BATCH_ROWS строк"""
+    tpdf = TPdf()
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, BATCH_ROWS))
+        if not batch:
+            return
+        # документы пачки рисуются по шаблонам, собираются по строкам
+        documents = {doc_name: tpdf.render_documents(doc_name, batch, fill_x)
+                     for doc_name in dict(complete)}
+        for row in batch:
+            record = {doc_name: next(docs) for doc_name, docs in documents.items()}
+            yield row, [page for doc_name, count in complete for page in record[doc_name] * count]
+
+
+def unique_name(name, names):
+    """name, а если такое имя уже было - name_2, name_3..."""
+    unique, i = name, 1
+    while unique.lower() in names:
+        i += 1
+        unique = "{}_{}".format(name, i)
+    names.add(unique.lower())
+    return unique
+
+
+def write_zip_with_data(dir_name, output, rows=None, **kwargs):
+    """write_zip для одного шаблона, по умолчанию - строки его файла данных"""
+    if rows is None:
+        rows = TPdf.iter_data_rows(dir_name)
+    return write_zip([(dir_name, 1)], rows, output, **kwargs)
@@ -0,0 +1,313 @@
+import os
+import shutil
+import signal
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from functools import partial
+from itertools import islice
+
+from pdfrw import PdfFileReader
+
+from app.archive import check_name_template, load_config as archive_config, record_name, unique_name
+from app.fonts import FontSubsets
+from app.output import PdfOutput
+from app.pdfstream import Progress, content_keys
+from app.tpdf import BATCH_ROWS, TPdf, registry
+
+
+def _init_worker(dir_names):
+    """Прогревает рабочий процесс: шаблоны и шрифты разбираются один раз
+
+    Ctrl+C обрабатывает родительский процесс: он дописывает начатые чанки и
+    останавливает пул, рабочие процессы сигнал не прерывает
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    for dir_name in dir_names:
+        registry.get(dir_name)
+
+
+def _render_chunk(complete, fill_x, task):
+    """Наложения строк чанка по шаблонам комплекта
+
+    :param task: строки чанка и состояние шрифтов родителя на момент
+        отправки чанка (FontSubsets.export)
+    :return: наложения и состояние шрифтов после чанка
+    """
+    rows, fonts = task
+    tpdf = TPdf(FontSubsets(fonts))
+    return _chunk_overlays(tpdf, complete, fill_x, rows), tpdf.font_subsets.export()
+
+
+def _chunk_overlays(tpdf, complete, fill_x, rows):
+    return {dir_name: tpdf.render_overlays_batch(dir_name, rows, fill_x)
+            for dir_name in dict(complete)}
+
+
+def _seed_chunk(tpdf, complete, fill_x, rows):
+    """Задание процессу: строки чанка и состояние шрифтов, в котором коды
+    символов чанка уже назначены (TPdf.assign_codes) - в том же порядке, что
+    и при последовательной обработке строк"""
+    for dir_name in dict(complete):
+        tpdf.assign_codes(dir_name, rows, fill_x)
+    return rows, tpdf.font_subsets.export()
+
+
+def _accept_chunk(tpdf, complete, fill_x, task, result):
+    """Наложения чанка в кодах символов общего состояния шрифтов tpdf
+
+    Коды символов чанка назначены до отправки (_seed_chunk), и процесс,
+    рисуя чанк, новых не добавляет - наложения подходят как есть. Если всё
+    же добавил (перенос текста разошёлся с assign_codes), а состояние с
+    момента отправки не менялось, состояние процесса становится общим,
+    иначе чанк перерисовывается здесь.
+    :return: наложения и True, если чанк перерисован
+    """
+    rows, started = task
+    overlays, finished = result
+    fonts = tpdf.font_subsets
+    before = FontSubsets(started).version()
+    if FontSubsets(finished).version() == before:
+        return overlays, False
+    if fonts.version() == before:
+        fonts.load(finished)
+        return overlays, False
+    return _chunk_overlays(tpdf, complete, fill_x, rows), True
+
+
+def _merge_chunk(complete, overlays, fonts):
+    """Накладывает наложения чанка на формы: генератор списков страниц, по
+    одному на строку (комплект документов с копиями)
+
+    :param fonts: общие подмножества шрифтов, пишутся в pdf при закрытии
+        writer
+    """
+    rows = len(overlays[complete[0][0]])
+    for i in range(rows):
+        pages = []
+        for dir_name, count in complete:
+            pages.extend(TPdf.merge_overlays(dir_name, overlays[dir_name][i], fonts=fonts) * count)
+        yield pages
+
+
+def _write_documents(pdf_writer, documents):
+    """Пишет страницы документов, возвращает их число"""
+    pages = 0
+    for document in documents:
+        for page in document:
+            pdf_writer.add_page(page)
+            pages += 1
+    return pages
+
+
+def chunked(rows, size):
+    """Делит итератор строк на списки по size строк"""
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def ordered_map(executor, fn, chunks, window=2):
+    """Как executor.map, но держит в работе не больше window заданий
+
+    Возвращает пары (чанк, результат) в порядке чанков, а сами чанки читаются
+    по мере освобождения очереди, поэтому в памяти не копится весь набор строк.
+    """
+    pending = deque()
+    for chunk in chunks:
+        pending.append((chunk, executor.submit(fn, chunk)))
+        if len(pending) >= window:
+            chunk, future = pending.popleft()
+            yield chunk, future.result()
+    while pending:
+        chunk, future = pending.popleft()
+        yield chunk, future.result()
+
+
+def render_chunks(executor, complete, rows, chunk_size=100, fill_x=False, fonts=None,
+                  window=2, stats=None):
+    """Наложения строк рисуют процессы пула executor по чанкам, здесь они
+    накладываются на формы в исходном порядке строк
+
+    Состояние шрифтов одно на все чанки (см. _seed_chunk, _accept_chunk),
+    поэтому страницы те же, что и у последовательного TPdf.render_documents.
+    :param executor: пул процессов (concurrent.futures.ProcessPoolExecutor)
+    :param complete: комплект документов на каждую строку, как в
+        TPdf.get_complete
+    :param fonts: общее состояние шрифтов (fonts.FontSubsets), например
+        прерванной обработки
+    :param window: сколько чанков одновременно в работе у пула
+    :param stats: словарь, в "rerendered" которого считаются чанки,
+        перерисованные здесь (см. _accept_chunk)
+    :return: генератор пар (строки чанка, генератор списков страниц строк),
+        страницы чанка нужно забрать до следующего чанка
+    """
+    tpdf = TPdf(fonts or True)
+    # состояние шрифтов для чанка берётся в момент отправки процессу
+    tasks = (_seed_chunk(tpdf, complete, fill_x, rows_chunk)
+             for rows_chunk in chunked(rows, chunk_size))
+    results = ordered_map(executor, partial(_render_chunk, complete, fill_x), tasks, window)
+    for task, result in results:
+        overlays, rerendered = _accept_chunk(tpdf, complete, fill_x, task, result)
+        if rerendered and stats is not None:
+            stats["rerendered"] = stats.get("rerendered", 0) + 1
+        yield task[0], _merge_chunk(complete, overlays, tpdf.font_subsets)
+
+
+def iter_records(executor, complete, rows, fill_x=False, chunk_size=BATCH_ROWS, window=2):
+    """Как render_chunks, но по строкам: генератор пар (строка данных,
+    страницы её комплекта документов)"""
+    for rows_chunk, documents in render_chunks(executor, complete, rows, chunk_size, fill_x,
+                                               window=window):
+        yield from zip(rows_chunk, documents)
+
+
+def render_rows(dir_name, rows, output=None, output_dir=None, workers=None,
+                chunk_size=100, fill_x=False, progress=None, complete=None,
+                per_record=False, name=None, options=None, start=0, on_chunk=None,
+                fonts=None, executor=None):
+    """Параллельное впечатывание набора строк данных в шаблон dir_name
+
+    Строки делятся на чанки по chunk_size и раздаются пулу из workers
+    процессов, каждый из которых рисует наложения (reportlab) с прогретым
+    шаблоном. Родительский процесс накладывает их на страницы формы в исходном
+    порядке строк и пишет потоком. Состояние шрифтов одно на всю обработку
+    (см. _seed_chunk), шрифты встраиваются в pdf один раз, и для одного
+    шаблона результат побайтно совпадает с TPdf.write_pdf_with_data.
+
+    Файлы в output_dir появляются целиком (пишутся во временные и
+    переименовываются), после каждого вызывается on_chunk - на этом
+    строится продолжение прерванной обработки (см. cli.py).
+    :param dir_name: имя документа
+    :param rows: итератор словарей с данными, по одному на документ
+    :param output: объект с методом write(bytes) для единого pdf
+    :param output_dir: папка, в которую пишется по pdf файлу на чанк
+        (указывается вместо output)
+    :param workers: количество процессов, по умолчанию - по числу ядер
+    :param chunk_size: количество строк в одном задании
+    :param fill_x: bool заполнять значения полей их именами
+    :param progress: callback(rows, rows_per_sec), вызывается по ходу работы
+    :param complete: комплект документов на каждую строку, как в
+        TPdf.get_complete, по умолчанию [(dir_name, 1)]; dir_name тогда -
+        только префикс имён файлов
+    :param per_record: в output_dir - по pdf на строку, в подпапке на чанк
+    :param name: шаблон имени pdf строки (как в archive.write_zip)
+    :param options: параметры вывода pdf (output.OutputOptions)
+    :param start: номер первого чанка (имена файлов при продолжении), номера
+        строк для шаблона имени - с start * chunk_size + 1
+    :param on_chunk: callback(index, rows, pages) после записи чанка
+    :param fonts: общее состояние шрифтов (fonts.FontSubsets), например
+        прерванной обработки; к вызову on_chunk в нём состояние после чанка
+    :param executor: пул процессов для наложений, например общий пул
+        приложения, по умолчанию - свой на workers прогретых процессов
+    :return: статистика: строки, страницы, время, строк в секунду, файлы,
+        чанки, перерисованные в родительском процессе (rerendered)
+    """
+    if (output is None) == (output_dir is None):
+        raise ValueError("Нужно указать либо output, либо output_dir")
+    complete = complete or [(dir_name, 1)]
+    if per_record:
+        name = name or archive_config()["name"]
+        check_name_template(name)
+    workers = workers or os.cpu_count()
+    form_objects = [obj for doc_name in dict(complete) for obj in registry.get(doc_name).shared]
+    counter = Progress(progress)
+    pages = 0
+    files = []
+    chunk_stats = {"rerendered": 0}
+
+    with ExitStack() as stack:
+        if output is not None:
+            pdf_writer = stack.enter_context(PdfOutput(output, options))
+            pdf_writer.share(*form_objects)
+        if executor is None:
+            executor = stack.enter_context(ProcessPoolExecutor(
+                workers, initializer=_init_worker, initargs=(list(dict(complete)),)))
+        chunks = render_chunks(executor, complete, rows, chunk_size, fill_x, fonts,
+                               window=workers * 2, stats=chunk_stats)
+        for index, (rows_chunk, documents) in enumerate(chunks, start):
+            if output_dir is None:
+                chunk_pages = _write_documents(pdf_writer, documents)
+            elif per_record:
+                path = os.path.join(output_dir, "%s_%05d" % (dir_name, index))
+                chunk_pages = _write_records(path, documents, rows_chunk, name,
+                                             index * chunk_size + 1, form_objects, options)
+                files.append(path)
+            else:
+                path = os.path.join(output_dir, "%s_%05d.pdf" % (dir_name, index))
+                with open(path + ".tmp", "wb") as f, PdfOutput(f, options) as chunk_writer:
+                    chunk_writer.share(*form_objects)
+                    chunk_pages = _write_documents(chunk_writer, documents)
+                os.replace(path + ".tmp", path)
+                files.append(path)
+            pages += chunk_pages
+            counter.step(len(rows_chunk))
+            if on_chunk is not None:
+                on_chunk(index, len(rows_chunk), chunk_pages)
+
+    counter.report()
+    return dict(counter.stats(), pages=pages, files=files, **chunk_stats)
+
+
+def _write_records(path, documents, rows, name, first, form_objects, options):
+    """Пишет по pdf на строку чанка в папку path, возвращает число страниц
+
+    Папка собирается под временным именем и переименовывается целиком,
+    имена файлов уникальны в пределах чанка
+    """
+    tmp_path = path + ".tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    names = set()
+    pages = 0
+    for n, (row, document) in enumerate(zip(rows, documents), first):
+        file_name = unique_name(record_name(name, row, n), names)
+        with open(os.path.join(tmp_path, file_name + ".pdf"), "wb") as f, \
+                PdfOutput(f, options) as pdf_writer:
+            pdf_writer.share(*form_objects)
+            pages += _write_documents(pdf_writer, [document])
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+    return pages
+
+
+def merge_files(paths, output, options=None):
+    """Склеивает pdf файлы paths (части, чанки) в один pdf в output
+
+    Одинаковые по содержимому объекты (формы шаблона, шрифты, картинки)
+    пишутся один раз на весь результат, а не на каждый файл: повторы
+    ссылаются на уже записанный объект. Объекты файла забываются после его
+    страниц, в памяти остаются только отпечатки и номера записанных объектов.
+    :return: количество страниц
+    """
+    pages = 0
+    written = {}  # отпечаток содержимого -> номер записанного объекта
+    with PdfOutput(output, options) as pdf_writer:
+        for path in paths:
+            file_pages = PdfFileReader(path).pages
+            pdf_writer.share(*file_pages)
+            keys = content_keys(file_pages)
+            first = {}
+            for obj, key in keys.values():
+                if key in written:
+                    pdf_writer.reuse(obj, written[key])
+                elif key in first:
+                    pdf_writer.alias(obj, first[key])
+                else:
+                    first[key] = obj
+            pages += _write_documents(pdf_writer, [file_pages])
+            for key, obj in first.items():
+                num = pdf_writer.number(obj)
+                if num is not None:
+                    written[key] = num
+            pdf_writer.unshare()
+    return pages
+
+
+def render_xlsx(dir_name, **kwargs):
+    """Параллельное впечатывание строк файла данных шаблона (data.xlsx,
+    data.csv и т.д.), параметры как у render_rows"""
+    return render_rows(dir_name, TPdf.iter_data_rows(dir_name), **kwargs)
@@ -0,0 +1,196 @@
+import threading
+from collections import namedtuple
+from datetime import date, datetime as dt
+
+from reportlab.pdfbase.pdfmetrics import stringWidth
+
+# виды полей плана: текст известен при компиляции, значение из данных,
+# вычисляемое поле
+LITERAL, DATA, COMPUTED = "literal", "data", "computed"
+
+# расширения значений полей, которые рисуются как картинки из папки images
+IMAGE_EXTENSIONS = ("jpg", "JPG", "png", "PNG")
+
+# источник значения поля: kind - вид, key - столбец данных или имя
+# вычисляемого поля, fmt - форматтер столбца, value - текст литерала
+Slot = namedtuple("Slot", "kind key fmt value")
+
+# вычисляемое поле: fn(строка данных) -> текст, constant - значение не
+# зависит от строки и считается один раз на пачку строк
+ComputedField = namedtuple("ComputedField", "fn constant")
+
+# значение поля-картинки: имя файла в папке images шаблона
+ImageValue = namedtuple("ImageValue", "name")
+
+COMPUTED_FIELDS = {}
+
+
+def computed_field(name, constant=False):
+    """Декоратор: регистрирует функцию fn(row) как вычисляемое поле name
+
+    Поле вычисляется, если в данных нет столбца с таким именем. row - строка
+    данных как есть (без форматирования), значения могут быть None.
+    """
+    def decorator(fn):
+        COMPUTED_FIELDS[name] = ComputedField(fn, constant)
+        return fn
+    return decorator
+
+
+def format_text(values):
+    return ["" if value is None else str(value) for value in values]
+
+
+def format_date(values):
+    """Даты "ГГГГ-ММ-ДД" и объекты date/datetime в "ДД.ММ.ГГГГ", прочее -
+    как текст. В столбце даты обычно повторяются, каждая разбирается один раз"""
+    memo = {}
+    result = []
+    for value in values:
+        if value is None:
+            result.append("")
+        elif isinstance(value, (date, dt)):
+            result.append(value.strftime("%d.%m.%Y"))
+        elif isinstance(value, str):
+            text = memo.get(value)
+            if text is None:
+                try:
+                    text = dt.strptime(value, "%Y-%m-%d").strftime("%d.%m.%Y")
+                except ValueError:
+                    text = value  # если формат даты другой, то не надо паниковать
+                memo[value] = text
+            result.append(text)
+        else:
+            result.append(str(value))
+    return result
+
+
+def format_number(values):
+    """Числа без лишних нулей: 5.0 -> "5", 2.50 -> "2.5", прочее - как текст"""
+    result = []
+    for value in values:
+        if value is None:
+            result.append("")
+        elif isinstance(value, float):
+            result.append(str(int(value)) if value.is_integer() else
+                          ("%.6f" % value).rstrip("0"))
+        else:
+            result.append(str(value))
+    return result
+
+
+# форматтеры столбцов по именам: fn(список значений) -> список текстов;
+# имя задаётся необязательным параметром поля fmt в fields.json
+FORMATTERS = {
+    "text": format_text,
+    "date": format_date,
+    "number": format_number,
+}
+
+
+def default_format(column):
+    """Форматтер столбца, если у поля не задан fmt: даты - по имени столбца"""
+    return "date" if "date" in column else "text"
+
+
+def fit_name(name, width, font_name, font_size):
+    """Имя поля, обрезанное по ширине поля (для настройки положения полей)"""
+    while len(name) and stringWidth(name, font_name, font_size) > width:
+        name = name[:-1]
+    return name
+
+
+class BindingPlan:
+    """План подстановки значений в поля шаблона
+
+    Строится один раз для шаблона и набора столбцов данных: для каждого поля
+    заранее известно, откуда брать значение - готовый текст, столбец данных
+    (с форматтером) или вычисляемое поле. Поля с одинаковым источником
+    делят одну ячейку (slot). Значения пачки строк форматируются по
+    столбцам, а не по ключам каждой строки.
+    :param fields: поля шаблона постранично
+    :param columns: имена столбцов данных
+    :param fill_x: заполнять поля их именами
+    """
+
+    def __init__(self, fields, columns, fill_x=False):
+        self.slots = []
+        slot_index = {}
+        self.pages = {}
+        # шрифты полей и шрифт, с которого начинается каждая страница
+        self.fonts = tuple(sorted({"DejaVuSans"}.union(
+            field.font_name for page_fields in fields.values() for field in page_fields)))
+        for page_num, page_fields in fields.items():
+            planned = []
+            for field in page_fields:
+                if fill_x:
+                    slot = Slot(LITERAL, None, None, fit_name(
+                        field.name, field.width, field.font_name, field.font_size))
+                elif field.name in columns:
+                    slot = Slot(DATA, field.name, field.fmt or default_format(field.name), None)
+                elif field.name in COMPUTED_FIELDS:
+                    slot = Slot(COMPUTED, field.name, None, None)
+                else:
+                    slot = Slot(LITERAL, None, None, "")
+                if slot not in slot_index:
+                    slot_index[slot] = len(self.slots)
+                    self.slots.append(slot)
+                planned.append((field, slot_index[slot]))
+            self.pages[page_num] = tuple(planned)
+
+    def resolve(self, rows):
+        """Значения ячеек плана для пачки строк
+
+        :return: по кортежу значений на строку, в порядке self.slots; у
+            полей-картинок значение - ImageValue
+        """
+        count = len(rows)
+        if not self.slots:
+            return [()] * count
+        columns = []
+        for slot in self.slots:
+            if slot.kind == LITERAL:
+                column = [slot.value] * count
+            elif slot.kind == DATA:
+                column = FORMATTERS[slot.fmt]([row.get(slot.key) for row in rows])
+                column = [ImageValue(value) if value.split(".")[-1] in IMAGE_EXTENSIONS
+                          else value for value in column]
+            else:
+                computed = COMPUTED_FIELDS[slot.key]
+                if computed.constant:
+                    column = [computed.fn(rows[0] if rows else {})] * count
+                else:
+                    column = [computed.fn(row) for row in rows]
+            columns.append(column)
+        return list(zip(*columns))
+
+
+class PlanCache:
+    """Скомпилированные планы по шаблону, столбцам данных и fill_x
+
+    В ключ входят только столбцы, совпадающие с именами полей, поэтому
+    запросы с разными лишними ключами данных используют один план.
+    """
+
+    def __init__(self, max_items=256):
+        self.max_items = max_items
+        self._items = {}
+        self._lock = threading.Lock()
+
+    def get(self, template, columns, fill_x=False, font_stamps=()) -> "BindingPlan":
+        names = {field.name for page_fields in template.fields.values()
+                 for field in page_fields}
+        key = (template.dir_name, template.stamp, font_stamps if fill_x else (),
+               bool(fill_x), frozenset(names.intersection(columns)))
+        with self._lock:
+            plan = self._items.get(key)
+        if plan is None:
+            plan = BindingPlan(template.fields, key[-1], fill_x)
+            with self._lock:
+                if len(self._items) >= self.max_items:
+                    self._items.clear()
+                plan = self._items.setdefault(key, plan)
+        return plan
+
+
+plans = PlanCache()
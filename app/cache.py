@@ -0,0 +1,285 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from datetime import datetime as dt
+
+from app.binding import IMAGE_EXTENSIONS
+from app.config import load_section
+from app.output import default_options
+from app.tpdf import FILES, file_stamp, registry
+
+# настройки кэша по умолчанию (config.load_section), например
+# TPDF_CACHE_DIR=/var/cache/tpdf
+CONFIG = {
+    # объём кэша в памяти, 0 - кэш выключен
+    "max_bytes": 64 * 1024 * 1024,
+    # папка для вытесненных из памяти результатов, пусто - без диска
+    "dir": "",
+    "max_disk_bytes": 1024 * 1024 * 1024,
+}
+
+
+def load_config():
+    """Настройки кэша с учётом переменных окружения"""
+    return load_section("cache", CONFIG)
+
+
+def result_key(complete, data, fill_x=False, options=None):
+    """Ключ результата get_complete - хэш всего, от чего зависит pdf
+
+    Входят содержимое файлов шаблонов, отпечатки их шрифтов и картинок из
+    данных, комплект, данные, fill_x и параметры вывода. Одинаковый запрос по неизменным
+    шаблонам даёт одинаковый ключ в любом процессе, поэтому ключ годится и
+    как ETag.
+    """
+    templates = []
+    for name in sorted({name for name, count in complete}):
+        template = registry.get(name)
+        images = {
+            value: file_stamp(os.path.join(FILES, name, "images", value))
+            for value in map(str, data.values())
+            if value.split(".")[-1] in IMAGE_EXTENSIONS
+        }
+        templates.append([name, template.digest,
+                          registry.font_stamps(template.fonts), images])
+    spec = {
+        "templates": templates,
+        "complete": [[name, count] for name, count in complete],
+        # repr для не-json значений, чтобы дата и её строка не совпали
+        "data": data,
+        "fill_x": bool(fill_x),
+        "output": (options or default_options())._asdict(),
+        # поле now шаблона - текущая дата
+        "today": dt.now().strftime("%d.%m.%Y"),
+    }
+    spec = json.dumps(spec, sort_keys=True, ensure_ascii=False, default=repr)
+    return hashlib.sha256(spec.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """LRU кэш готовых pdf по ключу result_key
+
+    Результаты держатся в памяти до max_bytes, вытесненные из памяти
+    сохраняются в папку directory (если задана) до max_disk_bytes, оттуда
+    вытесняются давно не использованные.
+    :param max_bytes: объём кэша в памяти
+    :param directory: папка для вытесненных из памяти результатов
+    :param max_disk_bytes: объём кэша на диске
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, directory=None,
+                 max_disk_bytes=1024 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._bytes = 0
+        self._disk = OrderedDict()  # ключ -> размер файла
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self._load_disk()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".pdf")
+
+    def _load_disk(self):
+        """Подхватывает результаты, оставшиеся на диске с прошлого запуска"""
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".pdf") and entry.is_file():
+                st = entry.stat()
+                files.append((st.st_mtime_ns, entry.name[:-4], st.st_size))
+        for _, key, size in sorted(files):
+            self._disk[key] = size
+            self._disk_bytes += size
+        self._evict_disk()
+
+    def get(self, key):
+        """Готовый pdf по ключу или None"""
+        with self._lock:
+            body = self._items.get(key)
+            if body is not None:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return body
+            if key not in self._disk:
+                self.misses += 1
+                return None
+            self._disk.move_to_end(key)
+        try:
+            with open(self._path(key), "rb") as f:
+                body = f.read()
+            # время изменения - порядок вытеснения после перезапуска
+            os.utime(self._path(key))
+        except FileNotFoundError:
+            with self._lock:
+                self._disk_bytes -= self._disk.pop(key, 0)
+                self.misses += 1
+            return None
+        with self._lock:
+            self.disk_hits += 1
+        self.put(key, body)
+        return body
+
+    def put(self, key, body):
+        """Сохраняет результат, вытесняя давно не использованные"""
+        if len(body) > self.max_bytes:
+            self._spill(key, body)
+            return
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                return
+            self._items[key] = body
+            self._bytes += len(body)
+            evicted = []
+            while self._bytes > self.max_bytes:
+                old_key, old_body = self._items.popitem(last=False)
+                self._bytes -= len(old_body)
+                evicted.append((old_key, old_body))
+        for old_key, old_body in evicted:
+            self._spill(old_key, old_body)
+
+    def _spill(self, key, body):
+        """Переносит вытесненный из памяти результат на диск"""
+        if not self.directory or len(body) > self.max_disk_bytes:
+            return
+        with self._lock:
+            if key in self._disk:
+                return
+        # пишем во временный файл и переименовываем, чтобы параллельный
+        # get не прочитал недописанный файл
+        tmp_path = "{}.{}.tmp".format(self._path(key), threading.get_ident())
+        with open(tmp_path, "wb") as f:
+            f.write(body)
+        self.put_file(key, tmp_path)
+
+    def put_file(self, key, path):
+        """Сохраняет на диск результат из файла path (файл переносится в
+        папку кэша), например не поместившийся в память (CachingWriter)"""
+        size = os.path.getsize(path)
+        os.replace(path, self._path(key))
+        with self._lock:
+            if key not in self._disk:
+                self._disk[key] = size
+                self._disk_bytes += size
+            self._evict_disk()
+
+    def _evict_disk(self):
+        while self._disk_bytes > self.max_disk_bytes:
+            key, size = self._disk.popitem(last=False)
+            self._disk_bytes -= size
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._bytes = 0
+
+    def stats(self):
+        return {
+            "items": len(self._items),
+            "bytes": self._bytes,
+            "disk_items": len(self._disk),
+            "disk_bytes": self._disk_bytes,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+        }
+
+
+class CachingWriter:
+    """Пишет в output и запоминает записанное, чтобы после успешной генерации
+    положить результат в кэш
+
+    Копия держится в памяти, пока она не больше limit. Больший pdf, если
+    задана папка spill_dir, дописывается во временный файл в ней (до
+    spill_limit), иначе копия не копится.
+    """
+
+    def __init__(self, output, limit, spill_dir=None, spill_limit=0):
+        self.output = output
+        self.limit = limit
+        self.spill_dir = spill_dir
+        self.spill_limit = spill_limit
+        self.chunks = []
+        self.file = None
+        self.path = None
+        self.size = 0
+
+    def write(self, data):
+        self.output.write(data)
+        if self.chunks is None and self.file is None:
+            return
+        self.size += len(data)
+        if self.file is not None:
+            if self.size > self.spill_limit:
+                self.discard()
+            else:
+                self.file.write(data)
+        elif self.size <= self.limit:
+            self.chunks.append(bytes(data))
+        elif self.spill_dir and self.size <= self.spill_limit:
+            fd, self.path = tempfile.mkstemp(suffix=".tmp", dir=self.spill_dir)
+            self.file = os.fdopen(fd, "wb")
+            self.file.writelines(self.chunks)
+            self.file.write(data)
+            self.chunks = None
+        else:
+            self.chunks = None
+
+    def getvalue(self):
+        """Копия pdf в памяти или None"""
+        return None if self.chunks is None else b"".join(self.chunks)
+
+    def spilled(self):
+        """Путь к дописанному временному файлу с копией pdf или None"""
+        if self.file is None:
+            return None
+        self.file.close()
+        self.file = None
+        return self.path
+
+    def discard(self):
+        """Удаляет временный файл, если копия не понадобилась"""
+        if self.file is not None:
+            self.file.close()
+            os.remove(self.path)
+        self.file = self.chunks = None
+
+
+def write_cached(cache, key, fn, *args, output, **kwargs):
+    """Вызывает fn(*args, output=output, **kwargs), сохраняя результат в кэш"""
+    writer = CachingWriter(output, cache.max_bytes, cache.directory, cache.max_disk_bytes)
+    try:
+        result = fn(*args, output=writer, **kwargs)
+        body = writer.getvalue()
+        if body is not None:
+            cache.put(key, body)
+        else:
+            path = writer.spilled()
+            if path is not None:
+                cache.put_file(key, path)
+    finally:
+        writer.discard()
+    return result
+
+
+def setup_result_cache(app):
+    """Создаёт кэш результатов в app["result_cache"] (None, если выключен)"""
+    config = load_config()
+    app["result_cache"] = None
+    if config["max_bytes"] > 0:
+        app["result_cache"] = ResultCache(
+            config["max_bytes"], config["dir"] or None, config["max_disk_bytes"])
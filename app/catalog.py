@@ -0,0 +1,190 @@
+import asyncio
+import logging
+import os
+import threading
+from collections import defaultdict, namedtuple
+
+import openpyxl
+
+from app.config import load_section
+from app.sources import find_data_file
+from app.tpdf import FILES, TPdf, file_stamp, registry
+
+log = logging.getLogger(__name__)
+
+# настройки каталога по умолчанию (config.load_section), например
+# TPDF_CATALOG_INTERVAL=1
+CONFIG = {
+    # период опроса папки шаблонов, секунды
+    "interval": 5.0,
+}
+
+# сведения о шаблоне для страниц приложения; error - текст ошибки, если
+# шаблон не удалось разобрать
+TemplateInfo = namedtuple(
+    "TemplateInfo", "dir_name pages fields fonts has_data has_fields stamp error")
+
+
+def load_config():
+    """Настройки каталога с учётом переменных окружения"""
+    return load_section("catalog", CONFIG)
+
+
+def template_files(dir_path):
+    """Файлы шаблона: форма, настройки полей и файл данных (data.xlsx,
+    data.csv и т.д., если его нет - путь к data.xlsx)"""
+    return (
+        os.path.join(dir_path, "form.pdf"),
+        os.path.join(dir_path, "fields.json"),
+        find_data_file(dir_path) or os.path.join(dir_path, "data.xlsx"),
+    )
+
+
+def default_fields(xlsx_path):
+    """Настройки полей по умолчанию из первых двух строк data.xlsx: поля
+    страницы друг под другом, по порядку столбцов"""
+    new_pos = defaultdict(list)
+    wb_obj = openpyxl.load_workbook(xlsx_path, read_only=True)
+    try:
+        rows = wb_obj.active.iter_rows(max_row=2, values_only=True)
+        page_nums, field_names = next(rows, ()), next(rows, ())
+    finally:
+        wb_obj.close()
+    y_by_page_num = dict()
+    for page_num, field_name in zip(page_nums, field_names):
+        page_num = str(int(page_num) - 1)
+        y_by_page_num.setdefault(page_num, 720)
+        new_pos[page_num].append([50, y_by_page_num[page_num], field_name, "Times New Roman", 10, 400])
+        y_by_page_num[page_num] -= 30
+    return dict(new_pos)
+
+
+def create_default_fields(dir_name, dir_path):
+    """Формирует настройки полей по умолчанию, если у шаблона есть data.xlsx,
+    но нет fields.json. Файл создаётся один раз: если его уже записал другой
+    процесс, он не меняется
+
+    :return: True - файл создан
+    """
+    _, fields_path, data_path = template_files(dir_path)
+    if os.path.isfile(fields_path) or not data_path.endswith(".xlsx") \
+            or not os.path.isfile(data_path):
+        return False
+    return TPdf.create_fields_file(dir_name, default_fields(data_path))
+
+
+class TemplateCatalog:
+    """Каталог шаблонов tpdf_templates: число страниц и полей, шрифты, есть ли
+    данные
+
+    Строится при запуске и обновляется опросом времени изменения файлов
+    шаблонов в фоновом потоке, страницы приложения читают только каталог.
+    Изменённые шаблоны сразу перекомпилируются в реестре, поэтому первый
+    запрос после правки не ждёт разбора pdf. Там же, один раз, формируются
+    настройки полей по умолчанию для шаблонов с data.xlsx без fields.json.
+    """
+
+    def __init__(self, root=FILES, interval=CONFIG["interval"]):
+        self.root = root
+        self.interval = interval
+        self.fonts = ()
+        self._items = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def items(self):
+        """Сведения о всех шаблонах, по имени"""
+        with self._lock:
+            return [self._items[name] for name in sorted(self._items)]
+
+    def get(self, dir_name):
+        with self._lock:
+            return self._items.get(dir_name)
+
+    def refresh(self, dir_name=None):
+        """Обновляет сведения об изменившихся шаблонах (или только о dir_name)"""
+        self.fonts = registry.register_fonts()
+        if dir_name is None:
+            names = {entry.name for entry in os.scandir(self.root) if entry.is_dir()}
+        else:
+            names = {dir_name}
+        for name in names:
+            dir_path = os.path.join(self.root, name)
+            stamp = file_stamp(*template_files(dir_path))
+            old = self.get(name)
+            if old is not None and old.stamp == stamp:
+                continue
+            if not os.path.isdir(dir_path):
+                with self._lock:
+                    self._items.pop(name, None)
+                continue
+            info = self._scan(name, dir_path, stamp)
+            with self._lock:
+                self._items[name] = info
+        if dir_name is None:
+            with self._lock:
+                for name in set(self._items) - names:
+                    del self._items[name]
+
+    def _scan(self, name, dir_path, stamp):
+        form_path, fields_path, data_path = template_files(dir_path)
+        has_data = stamp[2] is not None
+        try:
+            if stamp[1] is None and has_data:
+                # если нет файла настроек полей и есть файл с данными, то формируем файл настроек
+                create_default_fields(name, dir_path)
+                stamp = file_stamp(*template_files(dir_path))
+            if stamp[0] is None or stamp[1] is None:
+                return TemplateInfo(name, None, None, (), has_data, stamp[1] is not None,
+                                    stamp, None)
+            template = registry.get(name)
+            return TemplateInfo(
+                dir_name=name,
+                pages=len(template.pages),
+                fields=sum(len(fields) for fields in template.fields.values()),
+                fonts=template.fonts,
+                has_data=has_data,
+                has_fields=True,
+                stamp=stamp,
+                error=None,
+            )
+        except Exception as e:
+            log.exception("не удалось разобрать шаблон %s", name)
+            return TemplateInfo(name, None, None, (), has_data, stamp[1] is not None,
+                                stamp, repr(e))
+
+    def start(self):
+        """Запускает фоновый опрос папки шаблонов"""
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.refresh()
+            except Exception:
+                log.exception("ошибка обновления каталога шаблонов")
+
+
+def setup_catalog(app):
+    """Создаёт каталог шаблонов в app["catalog"]: строится при запуске app,
+    дальше обновляется в фоне"""
+    app["catalog"] = TemplateCatalog(interval=load_config()["interval"])
+
+    async def on_startup(app):
+        await asyncio.get_running_loop().run_in_executor(None, app["catalog"].refresh)
+        app["catalog"].start()
+
+    async def on_cleanup(app):
+        app["catalog"].stop()
+
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
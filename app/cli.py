@@ -0,0 +1,297 @@
+"""Массовое впечатывание данных в pdf из командной строки, без веб сервера
+
+    python -m app.cli try_xlsx -o result.pdf                 # data.* шаблона
+    python -m app.cli try_xlsx --data rows.csv -o result.pdf -w 8
+    python -m app.cli ZayavlenieNaZagranpasport ClearPage:2 --data rows.jsonl \\
+        -d out --per-record --name "{last_name}_{n}"
+
+Рисует тем же ядром, что и веб обработчики (batch.render_rows): строки
+делятся на чанки по --chunk-size и раздаются -w процессам. Результат - один
+pdf (-o) или папка файлов (-d): по pdf на чанк или, с --per-record, по pdf
+на строку в подпапке на чанк. После каждого чанка прогресс сохраняется в
+checkpoint.json (для -o - в папке <файл>.parts рядом с результатом), и
+прерванный запуск (Ctrl+C, падение) с теми же параметрами продолжается с
+последнего записанного чанка; --restart - начать заново. По ходу работы в
+stderr выводится прогресс, в конце в stdout - статистика в json.
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+from itertools import islice
+
+from app.archive import check_name_template
+from app.batch import merge_files, render_rows
+from app.fonts import FontSubsets
+from app.output import OutputUnavailable, check_linearize, parse_options
+from app.sources import UnsupportedSource, find_data_file, iter_rows, source_format
+from app.tpdf import FILES, file_stamp, registry
+
+CHECKPOINT = "checkpoint.json"
+
+
+class CheckpointMismatch(Exception):
+    """Сохранённый прогресс относится к запуску с другими параметрами"""
+
+
+class Checkpoint:
+    """Прогресс обработки в json файле path: параметры запуска spec, сколько
+    строк, чанков и страниц уже записано и состояние шрифтов. Файл
+    заменяется атомарно, поэтому после падения в нём всегда последний
+    целиком записанный чанк. Продолженный запуск назначает символам те же
+    коды, что и прерванный, и шрифты частей единого pdf при склейке
+    пишутся один раз."""
+
+    def __init__(self, path, spec):
+        self.path = path
+        # как после чтения из json: кортежи - списками
+        self.spec = json.loads(json.dumps(spec))
+        self.rows = self.chunks = self.pages = 0
+        self.fonts = FontSubsets()
+
+    def load(self):
+        """Читает сохранённый прогресс, если он есть
+
+        :return: True - продолжение прерванного запуска
+        :raises CheckpointMismatch: параметры запуска изменились
+        """
+        if not os.path.isfile(self.path):
+            return False
+        with open(self.path, encoding="utf-8") as f:
+            state = json.load(f)
+        if state["spec"] != self.spec:
+            raise CheckpointMismatch(
+                "{} сохранён для других параметров или данных, "
+                "для запуска заново - --restart".format(self.path))
+        self.rows, self.chunks, self.pages = state["rows"], state["chunks"], state["pages"]
+        # сохранённые до появления состояния шрифтов - с пустого состояния
+        self.fonts.load(state.get("fonts", ()))
+        return True
+
+    def step(self, index, rows, pages):
+        """callback для render_rows(on_chunk=...): чанк записан"""
+        self.rows += rows
+        self.chunks = index + 1
+        self.pages += pages
+        self.save()
+
+    def save(self):
+        state = {"spec": self.spec, "rows": self.rows, "chunks": self.chunks, "pages": self.pages,
+                 "fonts": self.fonts.export()}
+        with open(self.path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(state, f, ensure_ascii=False, indent=2)
+        os.replace(self.path + ".tmp", self.path)
+
+    def remove(self):
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+
+def parse_complete(documents):
+    """Комплект документов из аргументов "шаблон" или "шаблон:копий"
+
+    :raises ValueError: неверное количество копий
+    """
+    complete = []
+    for document in documents:
+        dir_name, _, count = document.partition(":")
+        count = int(count or 1)
+        if count < 1:
+            raise ValueError("Количество копий {} меньше 1".format(document))
+        complete.append((dir_name, count))
+    return complete
+
+
+def remove_tmp(work_dir):
+    """Удаляет недописанные при прерывании чанки (*.tmp)"""
+    for entry in os.listdir(work_dir):
+        if entry.endswith(".tmp"):
+            path = os.path.join(work_dir, entry)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+
+
+class ProgressPrinter:
+    """Прогресс в stderr: строки с учётом продолженных, скорость, остаток"""
+
+    def __init__(self, done, total, stream=sys.stderr):
+        self.done = done
+        self.total = total
+        self.stream = stream
+        self.end = "\r" if stream.isatty() else "\n"
+
+    def __call__(self, rows, rows_per_sec):
+        done = self.done + rows
+        line = "строк: {}/{}, {:.1f} строк/с".format(done, self.total, rows_per_sec)
+        if rows_per_sec:
+            line += ", осталось {:.0f} с".format(max(self.total - done, 0) / rows_per_sec)
+        print(line.ljust(60), end=self.end, file=self.stream, flush=True)
+
+    def close(self):
+        if self.end == "\r":
+            print(file=self.stream)
+
+
+def run(args):
+    """Впечатывание по разобранным аргументам
+
+    :return: статистика в виде словаря
+    """
+    complete = args.complete
+    dir_name = complete[0][0]
+    data = os.path.abspath(args.data)
+    options = args.options
+    if args.output:
+        output = os.path.abspath(args.output)
+        work_dir = output + ".parts"
+    else:
+        output = work_dir = os.path.abspath(args.output_dir)
+    os.makedirs(work_dir, exist_ok=True)
+
+    spec = {
+        "complete": [[doc_name, count] for doc_name, count in complete],
+        "templates": {doc_name: registry.get(doc_name).digest for doc_name in dict(complete)},
+        "data": data,
+        "data_stamp": file_stamp(data),
+        "chunk_size": args.chunk_size,
+        "fill_x": args.fill_x,
+        "per_record": args.per_record,
+        "name": args.name,
+        "options": options._asdict(),
+    }
+    checkpoint = Checkpoint(os.path.join(work_dir, CHECKPOINT), spec)
+    if args.restart:
+        checkpoint.remove()
+    resumed = checkpoint.load()
+    remove_tmp(work_dir)
+
+    total = sum(1 for _ in iter_rows(data))
+    rows = islice(iter_rows(data), checkpoint.rows, None)
+    if resumed:
+        print("Продолжение: записано строк {} из {}".format(checkpoint.rows, total),
+              file=sys.stderr)
+
+    printer = None if args.quiet else ProgressPrinter(checkpoint.rows, total)
+    # части единого pdf - промежуточные, потоки объектов и линеаризация -
+    # только при склейке
+    chunk_options = options._replace(object_streams=False, linearize=False) \
+        if args.output else options
+    try:
+        stats = render_rows(
+            dir_name, rows, output_dir=work_dir, workers=args.workers,
+            chunk_size=args.chunk_size, fill_x=args.fill_x, progress=printer,
+            complete=complete, per_record=args.per_record, name=args.name,
+            options=chunk_options, start=checkpoint.chunks, on_chunk=checkpoint.step,
+            fonts=checkpoint.fonts)
+    finally:
+        if printer is not None:
+            printer.close()
+
+    if args.output:
+        parts = [os.path.join(work_dir, "%s_%05d.pdf" % (dir_name, i))
+                 for i in range(checkpoint.chunks)]
+        with open(output + ".tmp", "wb") as f:
+            merge_files(parts, f, options)
+        os.replace(output + ".tmp", output)
+        shutil.rmtree(work_dir)
+        size = os.path.getsize(output)
+    else:
+        checkpoint.remove()
+        size = sum(os.path.getsize(os.path.join(root, file_name))
+                   for root, _, file_names in os.walk(work_dir) for file_name in file_names)
+
+    seconds = stats["seconds"]
+    return {
+        "output": output,
+        "rows": checkpoint.rows,
+        "resumed_rows": checkpoint.rows - stats["rows"],
+        "pages": checkpoint.pages,
+        "chunks": checkpoint.chunks,
+        "bytes": size,
+        "seconds": seconds,
+        "rows_per_sec": stats["rows_per_sec"],
+        "pages_per_sec": round(stats["pages"] / seconds, 1) if seconds else 0.0,
+        "workers": args.workers or os.cpu_count(),
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m app.cli", description=__doc__.splitlines()[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="\n".join(__doc__.splitlines()[2:]))
+    parser.add_argument("documents", nargs="+", metavar="шаблон[:копий]",
+                        help="документы комплекта на каждую строку данных")
+    parser.add_argument("--data", help="файл данных (xlsx, csv, jsonl, parquet, arrow), "
+                                       "по умолчанию - data.* первого шаблона")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("-o", "--output", help="pdf файл результата")
+    target.add_argument("-d", "--output-dir", help="папка для pdf файлов")
+    parser.add_argument("--per-record", action="store_true",
+                        help="с -d: по pdf на строку данных")
+    parser.add_argument("--name", help="шаблон имени pdf строки, как у /tpdf/get_zip_with_data")
+    parser.add_argument("-w", "--workers", type=int, help="процессов, по умолчанию - по числу ядер")
+    parser.add_argument("--chunk-size", type=int, default=100,
+                        help="строк в чанке: задание процесса и шаг сохранения прогресса")
+    parser.add_argument("--fill-x", action="store_true", help="заполнять поля их именами")
+    for option in ("compress", "object_streams", "linearize"):
+        parser.add_argument("--" + option.replace("_", "-"), dest=option, metavar="1|0",
+                            help="параметр вывода pdf, по умолчанию - TPDF_OUTPUT_*")
+    parser.add_argument("--restart", action="store_true",
+                        help="не продолжать прерванный запуск, начать заново")
+    parser.add_argument("-q", "--quiet", action="store_true", help="без прогресса в stderr")
+    parser.add_argument("-v", "--verbose", action="store_true", help="подробный лог")
+    args = parser.parse_args(argv)
+
+    try:
+        args.complete = parse_complete(args.documents)
+        args.options = parse_options({option: getattr(args, option) for option in
+                                      ("compress", "object_streams", "linearize")})
+        if args.options.linearize:
+            check_linearize()
+        if args.name:
+            check_name_template(args.name)
+    except (ValueError, OutputUnavailable) as e:
+        parser.error(str(e))
+    for doc_name, count in args.complete:
+        if not os.path.isfile(os.path.join(FILES, doc_name, "fields.json")):
+            parser.error("Нет шаблона {}".format(doc_name))
+    if args.data is None:
+        args.data = find_data_file(os.path.join(FILES, args.complete[0][0]))
+        if args.data is None:
+            parser.error("У шаблона {} нет файла данных, укажите --data".format(
+                args.complete[0][0]))
+    elif not os.path.isfile(args.data):
+        parser.error("Нет файла данных {}".format(args.data))
+    try:
+        source_format(args.data)
+    except UnsupportedSource as e:
+        parser.error(str(e))
+    if args.per_record and not args.output_dir:
+        parser.error("--per-record - только вместе с -d")
+    if args.chunk_size < 1 or args.workers is not None and args.workers < 1:
+        parser.error("--chunk-size и --workers должны быть больше 0")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    try:
+        stats = run(args)
+    except CheckpointMismatch as e:
+        print(e, file=sys.stderr)
+        return 2
+    except KeyboardInterrupt:
+        print("Прервано, для продолжения запустите с теми же параметрами", file=sys.stderr)
+        return 130
+    print(json.dumps(stats, ensure_ascii=False, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,37 @@
+"""Настройки модулей приложения
+
+Настройки по умолчанию - словарь CONFIG модуля, каждый параметр
+переопределяется переменной окружения TPDF_<РАЗДЕЛ>_<ПАРАМЕТР>, например
+TPDF_CACHE_DIR=/var/cache/tpdf для параметра dir раздела cache.
+"""
+import os
+
+# значения флагов (параметров со значением по умолчанию True/False)
+FLAGS = {"1": True, "true": True, "yes": True, "0": False, "false": False, "no": False}
+
+
+def load_section(name, defaults):
+    """Настройки раздела name с учётом переменных окружения
+
+    :param defaults: настройки по умолчанию, значения переменных окружения
+        приводятся к типу значения по умолчанию (флаги - см. FLAGS)
+    :return: новый словарь, defaults не меняется
+    :raises ValueError: значение переменной окружения не приводится к типу
+    """
+    config = dict(defaults)
+    for key, default in config.items():
+        env_name = "TPDF_{}_{}".format(name, key).upper()
+        value = os.environ.get(env_name)
+        if value is None:
+            continue
+        if isinstance(default, bool):
+            if value.lower() not in FLAGS:
+                raise ValueError("{}={!r}: ожидается 1 или 0".format(env_name, value))
+            config[key] = FLAGS[value.lower()]
+            continue
+        try:
+            config[key] = type(default)(value)
+        except ValueError:
+            raise ValueError("{}={!r}: ожидается {}".format(
+                env_name, value, type(default).__name__)) from None
+    return config
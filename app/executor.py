@@ -0,0 +1,130 @@
+import asyncio
+import contextvars
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+
+from aiohttp import web
+
+from app.config import load_section
+from app.metrics import PROFILE, endpoint, profiled
+
+# настройки пулов по умолчанию, раздел настроек (config.load_section) -
+# имя пула, например TPDF_BATCH_KIND=process
+CONFIG = {
+    # одиночные документы: предпросмотр полей, комплекты документов
+    "render": {"kind": "thread", "workers": 4, "max_queue": 32, "retry_after": 1},
+    # массовое впечатывание данных xlsx, не должно тормозить одиночные запросы
+    "batch": {"kind": "thread", "workers": 1, "max_queue": 4, "retry_after": 30},
+}
+# пулы, которые могут быть пулами процессов: наложения строк рисуют процессы
+# пула (batch.iter_records), pdf собирается и отдаётся клиенту в потоке.
+# Одиночным документам процессы не помогают, для них - процессы сервера
+# (TPDF_SERVER_WORKERS)
+PROCESS_POOLS = ("batch",)
+
+
+def load_config(name):
+    """Настройки пула name с учётом переменных окружения"""
+    return load_section(name, CONFIG[name])
+
+
+class RenderExecutor:
+    """Ограниченный пул для тяжёлой синхронной работы вне event loop
+
+    Одновременно выполняется не больше workers заданий, ещё не больше
+    max_queue ждут в очереди. Если очередь заполнена, запрос сразу получает
+    503 с заголовком Retry-After, а не копится в памяти.
+    :param kind: "thread" или "process" - тип пула
+    """
+
+    def __init__(self, name, kind="thread", workers=4, max_queue=32, retry_after=1):
+        if kind not in ("thread", "process"):
+            raise ValueError("Неизвестный тип пула: {}".format(kind))
+        self.name = name
+        self.kind = kind
+        self.workers = workers
+        self.max_queue = max_queue
+        self.retry_after = retry_after
+        self.in_flight = 0
+        self.queued = 0
+        self.rejected = 0
+        self.pool = None
+        # потоки для заданий, которые должны идти в потоке даже у пула
+        # процессов (потоковая выдача пишет в объект event loop)
+        self.thread_pool = None
+        self._semaphore = None
+
+    def start(self):
+        pool_class = ThreadPoolExecutor if self.kind == "thread" else ProcessPoolExecutor
+        self.pool = pool_class(self.workers)
+        self.thread_pool = self.pool if self.kind == "thread" else ThreadPoolExecutor(self.workers)
+        self._semaphore = asyncio.Semaphore(self.workers)
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
+            self.thread_pool.shutdown(wait=False)
+            self.pool = self.thread_pool = None
+
+    async def run(self, fn, *args, in_thread=False, **kwargs):
+        """Выполняет fn(*args, **kwargs) в пуле, не блокируя event loop
+
+        Для пула процессов fn и аргументы должны сериализоваться pickle.
+        :param in_thread: выполнить в потоке даже для пула процессов, с тем же
+            ограничением workers и очереди
+        """
+        if self.in_flight >= self.workers and self.queued >= self.max_queue:
+            self.rejected += 1
+            raise web.HTTPServiceUnavailable(
+                headers={"Retry-After": str(self.retry_after)})
+        self.queued += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.queued -= 1
+        self.in_flight += 1
+        try:
+            loop = asyncio.get_running_loop()
+            call = partial(fn, *args, **kwargs)
+            if PROFILE["slow_ms"]:
+                call = partial(profiled, endpoint.get() or self.name, call)
+            if in_thread or self.kind == "thread":
+                # в потоке доступен контекст запроса (маршрут для метрик)
+                call = partial(contextvars.copy_context().run, call)
+            return await loop.run_in_executor(
+                self.thread_pool if in_thread else self.pool, call)
+        finally:
+            self.in_flight -= 1
+            self._semaphore.release()
+
+    def stats(self):
+        return {
+            "kind": self.kind,
+            "workers": self.workers,
+            "max_queue": self.max_queue,
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "rejected": self.rejected,
+        }
+
+
+def setup_executors(app):
+    """Создаёт пулы из CONFIG в app["executors"], запуск и остановка - вместе с app"""
+    app["executors"] = {
+        name: RenderExecutor(name, **load_config(name)) for name in CONFIG
+    }
+    for name, executor in app["executors"].items():
+        if executor.kind == "process" and name not in PROCESS_POOLS:
+            raise ValueError("TPDF_{}_KIND=process не поддерживается, пулы процессов: {}".format(
+                name.upper(), ", ".join(PROCESS_POOLS)))
+
+    async def on_startup(app):
+        for executor in app["executors"].values():
+            executor.start()
+
+    async def on_cleanup(app):
+        for executor in app["executors"].values():
+            executor.shutdown()
+
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
@@ -0,0 +1,191 @@
+from functools import partial
+
+from pdfrw import PdfArray, PdfDict, PdfName
+from pdfrw.compress import compress
+from reportlab.pdfbase import pdfdoc, pdfmetrics
+from reportlab.pdfbase.ttfonts import (
+    FF_NONSYMBOLIC, FF_SYMBOLIC, SUBSETN, TTFont, makeToUnicodeCMap)
+
+from app.metrics import stage
+from app.pdfstream import LatePdfDict
+
+
+class FontSubsets:
+    """Общие подмножества TTF шрифтов для всех наложений одного документа
+
+    reportlab встраивает в каждое наложение своё подмножество каждого шрифта,
+    и документ на 1000 строк несёт 1000 почти одинаковых шрифтов. Здесь у
+    всех canvas документа общее состояние шрифта (коды символов назначаются
+    один раз и совпадают во всех наложениях), а вместо шрифтов наложения
+    получают заглушки. При наложении на форму заглушки заменяются общими
+    объектами шрифтов, которые заполняются всеми символами документа при
+    записи (LatePdfDict) и попадают в pdf по одному на подмножество.
+
+    Экземпляр используется одним потоком, обычно один на TPdf.
+    :param exported: результат export() другого экземпляра - продолжение его
+        состояния, например в другом процессе
+    """
+
+    def __init__(self, exported=None):
+        self.names = []  # имена шрифтов, номер в списке - номер в заглушках
+        self.subsets = {}  # имя шрифта -> списки символов подмножеств
+        self.states = {}  # имя шрифта -> TTFont.State, общий для всех canvas
+        self.fonts = {}  # (номер шрифта, номер подмножества) -> LatePdfDict
+        # (имя шрифта, номер подмножества) -> (символов, шрифт pdf): если
+        # pdf по одним наложениям пишется несколько (по файлу на запись),
+        # шрифт пересобирается, только когда в подмножестве есть новые символы
+        self.built = {}
+        if exported is not None:
+            self.load(exported)
+
+    def install(self, can, font_names):
+        """Подключает к canvas общие состояния шрифтов font_names, вызывать
+        до рисования"""
+        doc = can._doc
+        for name in font_names:
+            font = pdfmetrics.getFont(name)
+            if not is_shared(font):
+                continue
+            state = self.state(name)
+            # внутреннее имя шрифта (/F2) у каждого canvas своё
+            state.internalName = None
+            font.state[doc] = state
+
+    def state(self, name):
+        """Общее состояние (назначенные коды символов) шрифта name"""
+        state = self.states.get(name)
+        if state is None:
+            font = pdfmetrics.getFont(name)
+            state = self.states[name] = TTFont.State(font._asciiReadable, font)
+            self.subsets[name] = state.subsets
+            self.names.append(name)
+        return state
+
+    def split(self, name, text):
+        """Текст в кодах общего состояния шрифта name, без canvas
+
+        :return: номер шрифта и, как TTFont.splitString, список пар (номер
+            подмножества, коды символов в bytes)
+        """
+        font = pdfmetrics.getFont(name)
+        # splitString берёт состояние по ключу документа, документ здесь - self
+        font.state[self] = self.state(name)
+        return self.names.index(name), font.splitString(text, self)
+
+    def stub(self, can):
+        """Вместо встраивания общих шрифтов - заглушки, вызывать перед
+        can.save()"""
+        doc = can._doc
+        doc.delayedFonts = [
+            FontStub(self.names.index(font.fontName), font.state[doc])
+            if font.fontName in self.states else font
+            for font in doc.delayedFonts
+        ]
+
+    def replace(self, font_resources):
+        """Заменяет заглушки в словаре /Font ресурсов наложения общими шрифтами"""
+        if font_resources is None:
+            return
+        for key, font in list(font_resources.iteritems()):
+            if font.TPdfFont is not None:
+                font_resources[key] = self.font(int(font.TPdfFont), int(font.TPdfSubset))
+
+    def font(self, index, subset):
+        font = self.fonts.get((index, subset))
+        if font is None:
+            font = self.fonts[index, subset] = LatePdfDict(
+                partial(self.build, self.names[index], subset))
+        return font
+
+    def build(self, name, subset):
+        """Шрифт pdf для подмножества subset шрифта name со всеми символами,
+        назначенными к этому моменту (как TTFont.addObjects в reportlab)"""
+        chars = self.subsets[name][subset]
+        built = self.built.get((name, subset))
+        if built is not None and built[0] == len(chars):
+            return built[1]
+        face = pdfmetrics.getFont(name).face
+        base_font = b"".join((SUBSETN(subset), b"+", face.name, face.subfontNameX)).decode("pdfdoc")
+        with stage("font_subset"):
+            font_file = PdfDict()
+            font_file.stream = face.makeSubset(chars).decode("latin-1")
+            font_file.Length1 = len(font_file.stream)
+        to_unicode = PdfDict()
+        to_unicode.stream = makeToUnicodeCMap(base_font, chars)
+        compress([font_file, to_unicode])
+        font = PdfDict(
+            Type=PdfName.Font,
+            Subtype=PdfName.TrueType,
+            BaseFont=PdfName(base_font),
+            FirstChar=0,
+            LastChar=len(chars) - 1,
+            Widths=PdfArray([face.getCharWidth(char) for char in chars]),
+            ToUnicode=to_unicode,
+            FontDescriptor=PdfDict(
+                Type=PdfName.FontDescriptor,
+                Ascent=face.ascent,
+                CapHeight=face.capHeight,
+                Descent=face.descent,
+                Flags=face.flags & ~FF_NONSYMBOLIC | FF_SYMBOLIC,
+                FontBBox=PdfArray(face.bbox),
+                FontName=PdfName(base_font),
+                ItalicAngle=face.italicAngle,
+                StemV=face.stemV,
+                FontFile2=font_file,
+                MissingWidth=face.defaultWidth,
+            ),
+        )
+        self.built[name, subset] = (len(chars), font)
+        return font
+
+    def export(self):
+        """Копия состояний шрифтов (коды символов) простыми списками: для
+        передачи в другой процесс (пул процессов сериализует задание позже,
+        когда это состояние уже может измениться) или сохранения в json"""
+        return [
+            [name, sorted(state.assignments.items()), state.subsets, state.nextCode]
+            for name, state in ((name, self.states[name]) for name in self.names)
+        ]
+
+    def load(self, exported):
+        """Заменяет состояния шрифтов результатом export() экземпляра,
+        продолжившего это состояние: уже выданные шрифты (font) остаются
+        теми же объектами и собираются по новому состоянию"""
+        self.names, self.states, self.subsets = [], {}, {}
+        for name, assignments, subsets, next_code in exported:
+            font = pdfmetrics.getFont(name)
+            state = TTFont.State(font._asciiReadable, font)
+            state.assignments = {code: n for code, n in assignments}
+            state.subsets = [list(subset) for subset in subsets]
+            state.nextCode = next_code
+            self.names.append(name)
+            self.states[name] = state
+            self.subsets[name] = state.subsets
+
+    def version(self):
+        """Отпечаток состояния: меняется, когда символам назначаются новые
+        коды (состояние только растёт)"""
+        return tuple((name, self.states[name].nextCode) for name in self.names)
+
+
+def is_shared(font):
+    """Шрифт с подмножествами (TTF), которые может делить FontSubsets"""
+    return getattr(font, "_dynamicFont", False)
+
+
+class FontStub:
+    """Встраивание шрифта в наложение reportlab (вместо TTFont.addObjects):
+    в словарь шрифтов пишутся только номера шрифта и подмножества"""
+
+    def __init__(self, index, state):
+        self.index = index
+        self.state = state
+
+    def addObjects(self, doc):
+        fonts = doc.idToObject["BasicFonts"].dict
+        for subset in range(len(self.state.subsets)):
+            fonts["%s+%d" % (self.state.internalName, subset)] = pdfdoc.PDFDictionary({
+                "Type": pdfdoc.PDFName("Font"),
+                "TPdfFont": self.index,
+                "TPdfSubset": subset,
+            })
@@ -0,0 +1,114 @@
+from bisect import bisect_right
+from functools import reduce
+from itertools import accumulate
+from operator import add
+from typing import Generator
+
+from reportlab.pdfbase import pdfmetrics
+
+# таблицы ширин символов по ключу (имя шрифта, размер шрифта)
+_tables = {}
+
+
+class GlyphWidths(dict):
+    """Ширины символов шрифта font_name размера font_size, в пунктах
+
+    Ширина символа вычисляется reportlab при первом обращении и запоминается,
+    поэтому значения совпадают с canvas.stringWidth(символ)
+    """
+
+    def __init__(self, font_name, font_size):
+        super().__init__()
+        self.font_name = font_name
+        self.font_size = font_size
+
+    def __missing__(self, char):
+        width = self[char] = pdfmetrics.stringWidth(char, self.font_name, self.font_size)
+        return width
+
+
+def glyph_widths(font_name, font_size) -> "GlyphWidths":
+    """Общая на процесс таблица ширин символов шрифта заданного размера"""
+    table = _tables.get((font_name, font_size))
+    if table is None:
+        table = _tables[(font_name, font_size)] = GlyphWidths(font_name, font_size)
+    return table
+
+
+def reset_glyph_widths(font_name=None):
+    """Сбрасывает таблицы ширин шрифта font_name (или все) после его
+    перерегистрации"""
+    for key in list(_tables):
+        if font_name is None or key[0] == font_name:
+            _tables.pop(key, None)
+
+
+def wrap_text(text: str, width: float, font_name: str, font_size: float) -> \
+        Generator[str, None, None]:
+    """Делит text на части, если текст не помещается в width
+
+    Результат совпадает с посимвольным алгоритмом TPdf.text_wrap (перенос по
+    пробелам, а слово длиннее строки - по буквам), но ширины символов берутся
+    из кэша, а накопленная длина строки считается сразу для отрезка текста
+    (accumulate), граница строки ищется бинарным поиском. Порядок сложения
+    ширин тот же, что и в посимвольном алгоритме, поэтому совпадают и границы
+    строк при сравнении с width.
+    """
+    widths = list(map(glyph_widths(font_name, font_size).__getitem__, text))
+    n = len(text)
+    text_start = 0
+    j = 0  # с этой позиции считаем накопленную длину строки
+    cur_text_len = 0  # длина строки перед позицией j
+    word_len = 0  # длина текущего слова перед позицией j
+    window = 64
+    while j < n:
+        # run[k] - длина строки после символа j + k - 1
+        run = list(accumulate(widths[j:j + window], initial=cur_text_len))
+        k = bisect_right(run, width, 1)
+        if k == len(run):
+            # в окне строка не переполнилась
+            if j + window >= n:
+                break
+            window *= 2
+            continue
+        i = j + k - 1  # символ, на котором строка превысила ширину
+        space = text.rfind(" ", j, i + 1)
+        if space >= 0:
+            word_len = reduce(add, widths[space + 1:i + 1], 0)
+        else:
+            word_len = reduce(add, widths[j:i + 1], word_len)
+        last_space = max(text.rfind(" ", 0, i + 1), 0)
+        # если слово поместилось, то перенос по пробелу
+        if text_start < last_space:
+            yield text[text_start:last_space]
+            text_start = last_space + 1
+            cur_text_len = word_len
+        # иначе переносим по буквам
+        else:
+            yield text[text_start:i]
+            text_start = i
+            word_len = cur_text_len = widths[i]
+        j = i + 1
+
+    # возвращаем оставшийся кусочек текста
+    yield text[text_start:]
+
+
+def fit_text(text, width, font_name, font_size, max_lines=None, min_font_size=None):
+    """Вписывает текст в поле: уменьшает шрифт и/или обрезает лишние строки
+
+    :param max_lines: максимум строк в поле, лишние строки отбрасываются
+    :param min_font_size: если задан, шрифт уменьшается на единицу, пока текст
+        не уложится в max_lines строк (в одну, если max_lines не задан), но не
+        меньше min_font_size
+    :return: (размер шрифта, список строк)
+    """
+    lines = list(wrap_text(text, width, font_name, font_size))
+    if min_font_size:
+        limit = max_lines or 1
+        while len(lines) > limit and font_size > min_font_size:
+            font_size = max(font_size - 1, min_font_size)
+            lines = list(wrap_text(text, width, font_name, font_size))
+    if max_lines:
+        lines = lines[:max_lines]
+    return font_size, lines
@@ -0,0 +1,215 @@
+import hashlib
+import io
+import os
+import threading
+import zlib
+from collections import OrderedDict, namedtuple
+
+from pdfrw import PdfDict, PdfName
+from PIL import Image
+from reportlab.lib.utils import ImageReader
+from reportlab.pdfbase import pdfdoc, pdfutils
+
+from app.config import load_section
+from app.metrics import stage
+
+# настройки кэша картинок по умолчанию (config.load_section), например
+# TPDF_IMAGES_MAX_DPI=300
+CONFIG = {
+    # сколько картинок держать в памяти
+    "max_items": 64,
+    # картинки крупнее ширины поля при этом разрешении уменьшаются до неё,
+    # 0 - не уменьшаются
+    "max_dpi": 0,
+}
+
+# подготовленная картинка: ImageReader (с уже декодированными данными после
+# первого использования) и блокировка - ImageReader нельзя использовать из
+# нескольких потоков одновременно
+CachedImage = namedtuple("CachedImage", "reader lock")
+
+
+class ImageCache:
+    """Ограниченный LRU кэш подготовленных картинок для полей-фото
+
+    Ключ - путь, время изменения и размер файла (изменённый файл будет
+    прочитан заново) и, если задан max_dpi, размер уменьшенной картинки.
+    :param max_items: сколько картинок держать в памяти
+    :param max_dpi: если задано, картинки крупнее ширины поля при этом
+        разрешении уменьшаются до неё
+    """
+
+    def __init__(self, max_items=64, max_dpi=0):
+        self.max_items = max_items
+        self.max_dpi = max_dpi
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path, width=None) -> "CachedImage":
+        """Картинка path для поля шириной width пунктов"""
+        st = os.stat(path)
+        max_px = None
+        if self.max_dpi and width:
+            max_px = max(int(width / 72 * self.max_dpi + 0.5), 1)
+        key = (path, st.st_mtime_ns, st.st_size, max_px)
+        with self._lock:
+            image = self._items.get(key)
+            if image is not None:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return image
+            self.misses += 1
+        with stage("image_decode"):
+            image = CachedImage(self._load(path, max_px), threading.Lock())
+        with self._lock:
+            image = self._items.setdefault(key, image)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+        return image
+
+    @staticmethod
+    def _load(path, max_px):
+        if max_px is None:
+            return ImageReader(path)
+        im = Image.open(path)
+        if im.width <= max_px:
+            return ImageReader(path)
+        im.thumbnail((max_px, max_px * im.height // im.width + 1))
+        packet = io.BytesIO()
+        if im.mode in ("RGBA", "LA", "P"):
+            im.save(packet, "PNG")
+        else:
+            im.save(packet, "JPEG", quality=90)
+        packet.seek(0)
+        return ImageReader(packet)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def stats(self):
+        return {"items": len(self._items), "hits": self.hits, "misses": self.misses}
+
+
+def load_config():
+    """Настройки кэша картинок с учётом переменных окружения"""
+    return load_section("images", CONFIG)
+
+
+image_cache = ImageCache(**load_config())
+
+
+class BinaryImageXObject(pdfdoc.PDFImageXObject):
+    """Картинка reportlab без обёртки ASCII85, независимо от глобальной
+    настройки rl_config.useA85: pdf отдаётся двоичным, а обёртка раздувает
+    потоки картинок на четверть"""
+
+    def loadImageFromJPEG(self, imageFile):
+        try:
+            try:
+                info = pdfutils.readJPEGInfo(imageFile)
+            finally:
+                imageFile.seek(0)
+        except Exception:
+            return False
+        self.width, self.height = info[0], info[1]
+        self.bitsPerComponent = 8
+        self.colorSpace = {1: "DeviceGray", 3: "DeviceRGB"}.get(info[2], "DeviceCMYK")
+        if self.colorSpace == "DeviceCMYK":
+            self._dotrans = 1
+        self.streamContent = imageFile.read()
+        self._filters = ("DCTDecode",)
+        self.mask = None
+        return True
+
+    def loadImageFromSRC(self, im):
+        fp = im.jpeg_fh()
+        if fp:
+            self.loadImageFromJPEG(fp)
+            return
+        self.width, self.height = im.getSize()
+        self.streamContent = zlib.compress(im.getRGBData())
+        self._filters = ("FlateDecode",)
+        self.colorSpace = pdfdoc._mode2CS[im.mode]
+        self.bitsPerComponent = 8
+        self._checkTransparency(im)
+
+    def _checkTransparency(self, im):
+        if self.mask == "auto" and im._dataA:
+            # маска прозрачности - тоже без ASCII85
+            self.mask = None
+            self._smask = BinaryImageXObject(
+                pdfdoc._digester(im._dataA.getRGBData()), im._dataA, mask=None)
+            self._smask._decode = [0, 1]
+        else:
+            super()._checkTransparency(im)
+
+
+def register_image(can, reader, mask="auto"):
+    """Добавляет картинку в документ canvas как BinaryImageXObject под тем же
+    именем, под которым её ищет drawImage, - тогда drawImage использует её,
+    а не создаёт свою с обёрткой по rl_config.useA85. Настройка одна на
+    процесс, поэтому она не меняется: так canvas в разных потоках не влияют
+    друг на друга и не ждут друг друга"""
+    rawdata = reader.getRGBData()  # заодно читает маску reader._dataA
+    mdata = reader._dataA.getRGBData() if mask == "auto" and reader._dataA else str(mask).encode()
+    name = pdfdoc._digester(rawdata + mdata)
+    doc = can._doc
+    reg_name = doc.getXObjectName(name)
+    if doc.idToObject.get(reg_name) is not None:
+        return
+    obj = BinaryImageXObject(name, reader, mask=mask)
+    can._setXObjects(obj)
+    doc.Reference(obj, reg_name)
+    doc.addForm(name, obj)
+    smask = obj.__dict__.pop("_smask", None)
+    if smask is not None:
+        m_reg_name = doc.getXObjectName(smask.name)
+        if doc.idToObject.get(m_reg_name) is None:
+            can._setXObjects(smask)
+            obj.smask = doc.Reference(smask, m_reg_name)
+        else:
+            obj.smask = pdfdoc.PDFObjectReference(m_reg_name)
+
+
+def draw_image(can, path, x, y, width):
+    """Рисует картинку path на canvas в поле шириной width (как раньше через
+    ImageReader), но картинка читается и декодируется один раз на процесс"""
+    image = image_cache.get(path, width)
+    with image.lock, stage("image_draw"):
+        register_image(can, image.reader)
+        can.drawImage(image.reader, x, y, width=width, mask="auto",
+                      preserveAspectRatio=True, anchor="se")
+
+
+def image_key(obj):
+    """Отпечаток картинки (Image XObject) по содержимому и параметрам
+
+    Одинаковые картинки из разных наложений дают одинаковый отпечаток, даже
+    если это разные pdf объекты
+    """
+    digest = hashlib.md5(obj.stream.encode("latin-1"))
+    for key, value in sorted(obj.iteritems()):
+        if key == PdfName.SMask:
+            value = image_key(value)
+        elif isinstance(value, PdfDict):
+            continue
+        digest.update(("%s %s\n" % (key, value)).encode("latin-1"))
+    return digest.hexdigest()
+
+
+def dedup_images(xobjects, seen):
+    """Заменяет в словаре XObject ресурсов одинаковые картинки одной
+
+    :param xobjects: словарь /XObject ресурсов страницы или наложения
+    :param seen: словарь отпечаток -> картинка, общий для всего документа
+    """
+    if xobjects is None:
+        return
+    for name, obj in list(xobjects.iteritems()):
+        if obj.Subtype == PdfName.Image and obj.stream is not None:
+            xobjects[name] = seen.setdefault(image_key(obj), obj)
+        elif obj.Subtype == PdfName.Form and obj.Resources is not None:
+            dedup_images(obj.Resources.XObject, seen)
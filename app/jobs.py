@@ -0,0 +1,326 @@
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from itertools import islice
+
+from app.batch import chunked, merge_files
+from app.config import load_section
+from app.metrics import endpoint
+from app.pdfstream import PdfStreamWriter
+from app.sources import find_data_file, iter_rows, source_format
+from app.tpdf import FILES, TPdf, registry
+
+log = logging.getLogger(__name__)
+
+# настройки заданий по умолчанию (config.load_section), например
+# TPDF_JOBS_DIR=/var/spool/tpdf
+CONFIG = {
+    # папка с базой заданий, входными данными и результатами; по умолчанию -
+    # во временной папке системы, не в папке приложения
+    "dir": os.path.join(tempfile.gettempdir(), "tpdf-spool"),
+    # через сколько строк сохраняется прогресс задания
+    "checkpoint_rows": 100,
+    # сколько заданий выполняется одновременно; при нескольких процессах
+    # сервера задания выполняет только первый (server.py)
+    "workers": 1,
+}
+
+# состояния задания
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    dir_name TEXT NOT NULL,
+    source TEXT NOT NULL,
+    status TEXT NOT NULL,
+    rows_total INTEGER,
+    rows_done INTEGER NOT NULL DEFAULT 0,
+    parts INTEGER NOT NULL DEFAULT 0,
+    pages INTEGER NOT NULL DEFAULT 0,
+    rows_per_sec REAL,
+    error TEXT,
+    created REAL NOT NULL,
+    started REAL,
+    finished REAL
+)
+"""
+
+
+def load_config():
+    """Настройки заданий с учётом переменных окружения"""
+    return load_section("jobs", CONFIG)
+
+
+class JobStore:
+    """Задания в SQLite и их файлы в папке spool
+
+    У каждого задания своя папка: входные строки (rows.jsonl или файл данных
+    data.xlsx, data.csv и т.д.),
+    готовые части pdf по checkpoint_rows строк и итоговый result.pdf.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(os.path.join(directory, "jobs.sqlite3"),
+                                   check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock, self._db:
+            self._db.execute(SCHEMA)
+
+    def path(self, job_id, *names):
+        return os.path.join(self.directory, job_id, *names)
+
+    def create(self, dir_name, rows=None, path=None):
+        """Новое задание по шаблону dir_name
+
+        :param rows: список словарей с данными
+        :param path: путь к файлу с данными в одном из форматов sources.py
+            (файл переносится в папку задания), если не указаны ни rows, ни
+            path - берётся файл данных шаблона
+        :return: id задания
+        """
+        if not os.path.isdir(os.path.join(FILES, dir_name)):
+            raise FileNotFoundError("Нет шаблона {}".format(dir_name))
+        if rows is None and path is None:
+            if find_data_file(os.path.join(FILES, dir_name)) is None:
+                raise FileNotFoundError("У шаблона {} нет файла данных".format(dir_name))
+        job_id = uuid.uuid4().hex
+        os.makedirs(self.path(job_id))
+        try:
+            source, rows_total = self._save_source(job_id, dir_name, rows, path)
+        except BaseException:
+            # битый файл данных: задания нет, его папка не нужна
+            shutil.rmtree(self.path(job_id), ignore_errors=True)
+            raise
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT INTO jobs (id, dir_name, source, status, rows_total, created)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (job_id, dir_name, source, QUEUED, rows_total, time.time()))
+        return job_id
+
+    def _save_source(self, job_id, dir_name, rows, path):
+        """Входные данные в папку задания
+
+        :return: имя файла данных в папке задания и количество строк
+        :raises ValueError: файл данных не читается
+        """
+        if rows is not None:
+            source = "rows.jsonl"
+            with open(self.path(job_id, source), "w", encoding="utf-8") as f:
+                for row in rows:
+                    f.write(json.dumps(row, ensure_ascii=False) + "\n")
+            rows_total = len(rows)
+        elif path is None:
+            source = os.path.basename(find_data_file(os.path.join(FILES, dir_name)))
+            shutil.copy(os.path.join(FILES, dir_name, source), self.path(job_id, source))
+        else:
+            source = "data." + source_format(path)
+            os.replace(path, self.path(job_id, source))
+        if rows is None:
+            rows_total = sum(1 for _ in iter_rows(self.path(job_id, source)))
+        return source, rows_total
+
+    def get(self, job_id):
+        """Задание словарём или None"""
+        with self._lock:
+            row = self._db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def claim(self):
+        """Забирает в работу самое старое задание из очереди
+
+        Задание забирается, только если оно ещё в очереди: базу могут
+        разделять несколько процессов
+        """
+        with self._lock, self._db:
+            row = self._db.execute(
+                "SELECT * FROM jobs WHERE status = ? ORDER BY created LIMIT 1",
+                (QUEUED,)).fetchone()
+            if row is None:
+                return None
+            claimed = self._db.execute(
+                "UPDATE jobs SET status = ?, started = ?, error = NULL WHERE id = ? AND status = ?",
+                (RUNNING, time.time(), row["id"], QUEUED)).rowcount
+        return dict(row) if claimed else None
+
+    def update(self, job_id, **values):
+        with self._lock, self._db:
+            self._db.execute(
+                "UPDATE jobs SET {} WHERE id = ?".format(
+                    ", ".join("{} = ?".format(key) for key in values)),
+                (*values.values(), job_id))
+
+    def requeue(self, status=RUNNING):
+        """Возвращает в очередь задания в состоянии status
+
+        При запуске - прерванные остановкой или падением сервера, они
+        продолжатся с последней сохранённой части
+        """
+        with self._lock, self._db:
+            return self._db.execute(
+                "UPDATE jobs SET status = ? WHERE status = ?", (QUEUED, status)).rowcount
+
+    def requeue_job(self, job_id):
+        """Возвращает в очередь задание, завершившееся ошибкой"""
+        with self._lock, self._db:
+            self._db.execute(
+                "UPDATE jobs SET status = ?, finished = NULL WHERE id = ? AND status = ?",
+                (QUEUED, job_id, FAILED))
+
+    def counts(self):
+        """Количество заданий по состояниям"""
+        with self._lock:
+            return dict(self._db.execute(
+                "SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class JobRunner:
+    """Потоки, выполняющие задания из JobStore
+
+    Строки задания печатаются частями по checkpoint_rows: каждая часть -
+    отдельный pdf, после записи которого в базе сохраняется число готовых
+    строк. Прерванное задание продолжается со следующей части, а когда все
+    строки готовы, части собираются в result.pdf.
+    """
+
+    def __init__(self, store, checkpoint_rows=100, workers=1):
+        self.store = store
+        self.checkpoint_rows = checkpoint_rows
+        self.workers = workers
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._threads = []
+
+    def start(self):
+        # без потоков процесс только принимает задания, выполняет (и
+        # возобновляет прерванные) другой процесс (server.py)
+        if not self.workers:
+            return
+        resumed = self.store.requeue()
+        if resumed:
+            log.info("возобновлено прерванных заданий: %s", resumed)
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self._loop, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        """Останавливает потоки после текущей части, задания остаются в работе
+        и продолжатся при следующем запуске"""
+        self._stop.set()
+        self._wakeup.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def notify(self):
+        """Сообщает потокам о новом задании"""
+        self._wakeup.set()
+
+    def _loop(self):
+        endpoint.set("job")
+        while not self._stop.is_set():
+            job = self.store.claim()
+            if job is None:
+                self._wakeup.wait(1)
+                self._wakeup.clear()
+                continue
+            try:
+                self.run_job(job)
+            except Exception as e:
+                log.exception("задание %s завершилось ошибкой", job["id"])
+                self.store.update(job["id"], status=FAILED, error=repr(e),
+                                  finished=time.time())
+
+    def run_job(self, job):
+        job_id, dir_name = job["id"], job["dir_name"]
+        rows_done, parts, pages = job["rows_done"], job["parts"], job["pages"]
+        tpdf = TPdf()
+        form_objects = registry.get(dir_name).shared
+        rows = islice(iter_rows(self.store.path(job_id, job["source"])), rows_done, None)
+        started, started_rows = time.monotonic(), rows_done
+        for chunk in chunked(rows, self.checkpoint_rows):
+            if self._stop.is_set():
+                return
+            path = self.store.path(job_id, "part_%05d.pdf" % parts)
+            with open(path + ".tmp", "wb") as f:
+                pdf_writer = PdfStreamWriter(f)
+                pdf_writer.share(*form_objects)
+                for document in tpdf.render_documents(dir_name, chunk):
+                    for page in document:
+                        pdf_writer.add_page(page)
+                        pages += 1
+                pdf_writer.close()
+            # часть появляется целиком или не появляется вовсе
+            os.replace(path + ".tmp", path)
+            rows_done += len(chunk)
+            parts += 1
+            elapsed = time.monotonic() - started
+            self.store.update(
+                job_id, rows_done=rows_done, parts=parts, pages=pages,
+                rows_per_sec=round((rows_done - started_rows) / elapsed, 2) if elapsed else None)
+        self.merge_parts(job_id, parts)
+        self.store.update(job_id, status=DONE, finished=time.time())
+
+    def merge_parts(self, job_id, parts):
+        """Собирает части задания в result.pdf и удаляет их"""
+        paths = [self.store.path(job_id, "part_%05d.pdf" % i) for i in range(parts)]
+        result = self.store.path(job_id, "result.pdf")
+        with open(result + ".tmp", "wb") as f:
+            merge_files(paths, f)
+        os.replace(result + ".tmp", result)
+        for path in paths:
+            os.remove(path)
+
+
+def job_status(job):
+    """Состояние задания для клиента: прогресс, скорость и оставшееся время"""
+    eta = None
+    if job["status"] in (QUEUED, RUNNING) and job["rows_per_sec"] and job["rows_total"]:
+        eta = round((job["rows_total"] - job["rows_done"]) / job["rows_per_sec"], 1)
+    return {
+        "id": job["id"],
+        "dir_name": job["dir_name"],
+        "status": job["status"],
+        "rows_total": job["rows_total"],
+        "rows_done": job["rows_done"],
+        "pages": job["pages"],
+        "rows_per_sec": job["rows_per_sec"],
+        "eta_seconds": eta,
+        "error": job["error"],
+        "created": job["created"],
+        "started": job["started"],
+        "finished": job["finished"],
+    }
+
+
+def setup_jobs(app):
+    """Создаёт хранилище и потоки заданий в app["jobs"], запуск и остановка -
+    вместе с app"""
+    config = load_config()
+    store = JobStore(config["dir"])
+    app["jobs"] = JobRunner(store, config["checkpoint_rows"], config["workers"])
+
+    async def on_startup(app):
+        app["jobs"].start()
+
+    async def on_cleanup(app):
+        app["jobs"].stop(timeout=30)
+        store.close()
+
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
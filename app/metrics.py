@@ -0,0 +1,226 @@
+import cProfile
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from app.config import load_section
+
+log = logging.getLogger(__name__)
+
+# границы корзин гистограмм, секунды
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0, 30.0)
+
+# границы корзин гистограммы размеров pdf, байты
+SIZE_BUCKETS = (16 * 1024, 64 * 1024, 256 * 1024, 1024 ** 2, 4 * 1024 ** 2,
+                16 * 1024 ** 2, 64 * 1024 ** 2, 256 * 1024 ** 2, 1024 ** 3)
+
+# маршрут текущего запроса: ставится в middleware и переносится в потоки
+# пулов вместе с контекстом (см. RenderExecutor.run)
+endpoint = ContextVar("endpoint", default="")
+
+# профилирование медленных вызовов в пулах, раздел настроек profile
+# (config.load_section), например TPDF_PROFILE_SLOW_MS=500
+PROFILE = load_section("profile", {
+    # вызовы дольше стольких миллисекунд профилируются, 0 - выключено
+    "slow_ms": 0,
+    # папка для сохранённых профилей
+    "dir": "profiles",
+})
+
+
+class Histogram:
+    """Гистограммы длительностей (или других величин, если заданы свои
+    границы корзин buckets) в формате Prometheus по набору меток"""
+
+    def __init__(self, name, help_text, labels, buckets=BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}  # значения меток -> [счётчики корзин, сумма, количество]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            index = bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+    def render(self):
+        lines = [
+            "# HELP {} {}".format(self.name, self.help_text),
+            "# TYPE {} histogram".format(self.name),
+        ]
+        with self._lock:
+            series = sorted((key, [list(s[0]), s[1], s[2]]) for key, s in self._series.items())
+        for label_values, (buckets, total, count) in series:
+            labels = ",".join('{}="{}"'.format(name, escape(value))
+                              for name, value in zip(self.labels, label_values))
+            cumulative = 0
+            for le, bucket in zip(self.buckets, buckets):
+                cumulative += bucket
+                lines.append('{}_bucket{{{},le="{}"}} {}'.format(self.name, labels, le, cumulative))
+            lines.append('{}_bucket{{{},le="+Inf"}} {}'.format(self.name, labels, count))
+            lines.append("{}_sum{{{}}} {}".format(self.name, labels, round(total, 6)))
+            lines.append("{}_count{{{}}} {}".format(self.name, labels, count))
+        return lines
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+stage_seconds = Histogram(
+    "tpdf_stage_seconds", "Длительность этапов генерации pdf",
+    ("stage", "template", "endpoint"))
+request_seconds = Histogram(
+    "tpdf_request_seconds", "Длительность обработки http запросов",
+    ("endpoint", "status"))
+# итог записи pdf по параметрам вывода (сжатие, потоки объектов,
+# линеаризация), см. output.py
+output_seconds = Histogram(
+    "tpdf_output_seconds", "Длительность сборки и записи pdf",
+    ("endpoint", "options"))
+output_bytes = Histogram(
+    "tpdf_output_bytes", "Размер готовых pdf, байты",
+    ("endpoint", "options"), SIZE_BUCKETS)
+
+
+@contextmanager
+def stage(name, template=""):
+    """Замеряет длительность этапа name генерации по шаблону template"""
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        # имя шаблона может прийти из запроса, а шаблона может не быть:
+        # неудачный этап - без метки шаблона, чтобы не плодить ряды
+        template = ""
+        raise
+    finally:
+        stage_seconds.observe(time.perf_counter() - start, name, template or "",
+                              endpoint.get())
+
+
+def profiled(label, fn):
+    """Вызывает fn() под cProfile, если вызов дольше PROFILE["slow_ms"],
+    сохраняет профиль в папку PROFILE["dir"] (смотреть - python -m pstats)"""
+    profile = cProfile.Profile()
+    try:
+        profile.enable()
+    except ValueError:
+        # профилировщик уже запущен в другом потоке (python 3.12+ разрешает
+        # только один на процесс) - этот вызов не профилируем
+        return fn()
+    start = time.perf_counter()
+    try:
+        return fn()
+    finally:
+        profile.disable()
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        if elapsed_ms >= PROFILE["slow_ms"]:
+            os.makedirs(PROFILE["dir"], exist_ok=True)
+            path = os.path.join(PROFILE["dir"], "{}_{}_{}ms_{}.prof".format(
+                time.strftime("%Y%m%d-%H%M%S"), label.strip("/").replace("/", "_") or "call",
+                int(elapsed_ms), os.getpid()))
+            profile.dump_stats(path)
+            log.warning("медленный вызов %s: %d мс, профиль %s", label, elapsed_ms, path)
+
+
+def gauge(name, help_text, values, kind="gauge"):
+    """Строки метрики name: values - список (метки, значение)"""
+    lines = ["# HELP {} {}".format(name, help_text), "# TYPE {} {}".format(name, kind)]
+    for labels, value in values:
+        labels = ",".join('{}="{}"'.format(k, escape(v)) for k, v in labels.items())
+        lines.append("{}{{{}}} {}".format(name, labels, value) if labels else
+                     "{} {}".format(name, value))
+    return lines
+
+
+def render_metrics(app):
+    """Все метрики приложения в текстовом формате Prometheus"""
+    from app.images import image_cache
+    from app.preview import preview_cache
+
+    lines = stage_seconds.render() + request_seconds.render()
+    lines += output_seconds.render() + output_bytes.render()
+    executors = app["executors"]
+    lines += gauge("tpdf_executor_in_flight", "Заданий выполняется в пуле",
+                   [({"pool": name}, e.in_flight) for name, e in executors.items()])
+    lines += gauge("tpdf_executor_queued", "Заданий ждёт в очереди пула",
+                   [({"pool": name}, e.queued) for name, e in executors.items()])
+    lines += gauge("tpdf_executor_rejected_total", "Отклонено запросов (503)",
+                   [({"pool": name}, e.rejected) for name, e in executors.items()],
+                   "counter")
+
+    caches = {"image": image_cache.stats(), "preview": preview_cache.stats()}
+    if app.get("result_cache") is not None:
+        caches["result"] = app["result_cache"].stats()
+    lines += gauge("tpdf_cache_hits_total", "Попадания в кэш",
+                   [({"cache": name}, s["hits"] + s.get("disk_hits", 0))
+                    for name, s in caches.items()], "counter")
+    lines += gauge("tpdf_cache_misses_total", "Промахи кэша",
+                   [({"cache": name}, s["misses"]) for name, s in caches.items()],
+                   "counter")
+    lines += gauge("tpdf_cache_hit_ratio", "Доля попаданий в кэш", [
+        ({"cache": name}, round((s["hits"] + s.get("disk_hits", 0)) /
+                                (s["hits"] + s.get("disk_hits", 0) + s["misses"]), 4))
+        for name, s in caches.items() if s["hits"] + s.get("disk_hits", 0) + s["misses"]])
+    lines += gauge("tpdf_cache_items", "Записей в кэше",
+                   [({"cache": name}, s["items"]) for name, s in caches.items()])
+
+    if app.get("jobs") is not None:
+        counts = app["jobs"].store.counts()
+        lines += gauge("tpdf_jobs", "Задания на массовое впечатывание по состояниям",
+                       [({"status": status}, count) for status, count in sorted(counts.items())])
+    return "\n".join(lines) + "\n"
+
+
+def setup_metrics(app):
+    """Подключает middleware метрик и маршрут /metrics
+
+    aiohttp импортируется здесь: этапы (stage) замеряются и в процессах без
+    веб сервера (пакетная печать, замеры), им он не нужен
+    """
+    from aiohttp import web
+
+    @web.middleware
+    async def metrics_middleware(request, handler):
+        """Гистограмма длительности запросов по маршрутам, маршрут - в контекст"""
+        resource = request.match_info.route.resource
+        name = resource.canonical if resource is not None else "unknown"
+        token = endpoint.set(name)
+        start = time.perf_counter()
+        status = 500
+        try:
+            response = await handler(request)
+            status = response.status
+            return response
+        except web.HTTPException as e:
+            status = e.status
+            raise
+        finally:
+            request_seconds.observe(time.perf_counter() - start, name, str(status))
+            endpoint.reset(token)
+
+    async def metrics(request):
+        # считается прямо в event loop: метрики нужны и когда пулы заняты
+        return web.Response(body=render_metrics(request.app).encode("utf-8"), headers={
+            "Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    app.middlewares.append(metrics_middleware)
+    app.router.add_get("/metrics", metrics)
@@ -0,0 +1,178 @@
+import importlib.util
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from collections import namedtuple
+
+from app.config import FLAGS, load_section
+from app.metrics import endpoint, output_bytes, output_seconds, stage
+from app.pdfstream import PdfStreamWriter
+
+log = logging.getLogger(__name__)
+
+# параметры вывода pdf по умолчанию, config.load_section, например
+# TPDF_OUTPUT_OBJECT_STREAMS=1, а в запросе - параметрами ?compress=0 и т.д.
+CONFIG = {
+    # сжимать (FlateDecode) наложения полей и другие несжатые потоки
+    "compress": True,
+    # упаковывать объекты без потоков в сжатые потоки объектов (pdf 1.5)
+    "object_streams": False,
+    # линеаризация ("быстрый веб-просмотр"): браузер показывает первую
+    # страницу, не дожидаясь всего файла. pdf собирается целиком во временном
+    # файле и только потом отдаётся, нужен pikepdf или qpdf
+    "linearize": False,
+}
+
+# параметры вывода pdf, см. CONFIG
+OutputOptions = namedtuple("OutputOptions", "compress object_streams linearize")
+
+
+class OutputUnavailable(Exception):
+    """Нет средства линеаризации pdf"""
+
+
+def load_config():
+    """Параметры вывода с учётом переменных окружения"""
+    return load_section("output", CONFIG)
+
+
+def default_options() -> "OutputOptions":
+    return OutputOptions(**load_config())
+
+
+def parse_options(query, default=None) -> "OutputOptions":
+    """Параметры вывода из параметров запроса (?compress=0&linearize=1),
+    не указанные - из default
+
+    :raises ValueError: значение параметра не 1/0, true/false, yes/no
+    """
+    options = (default or default_options())._asdict()
+    for key in options:
+        value = query.get(key)
+        if value is not None:
+            if value.lower() not in FLAGS:
+                raise ValueError("{} - 1 или 0".format(key))
+            options[key] = FLAGS[value.lower()]
+    return OutputOptions(**options)
+
+
+def options_label(options):
+    """Короткое имя набора параметров для метрик и лога"""
+    return "+".join(key for key, value in options._asdict().items() if value) or "plain"
+
+
+def load_pikepdf():
+    """pikepdf или None: импортируется только при первой линеаризации"""
+    try:
+        import pikepdf
+    except ImportError:
+        return None
+    return pikepdf
+
+
+def check_linearize():
+    """Проверяет, есть ли чем линеаризовать pdf - до начала генерации (сам
+    pikepdf при этом не импортируется)"""
+    if importlib.util.find_spec("pikepdf") is None and not shutil.which("qpdf"):
+        raise OutputUnavailable("Для линеаризации нужен pikepdf или qpdf")
+
+
+def linearize(src, dst, options):
+    """Линеаризует pdf из файла src в файл dst
+
+    pikepdf, если установлен, иначе qpdf из PATH. Потоки объектов
+    линеаризованного файла создаются заново, если они включены в options.
+    """
+    pikepdf = load_pikepdf()
+    if pikepdf is not None:
+        mode = pikepdf.ObjectStreamMode
+        with pikepdf.open(src) as pdf:
+            pdf.save(dst, linearize=True, compress_streams=options.compress,
+                     object_stream_mode=mode.generate if options.object_streams else mode.preserve)
+    elif shutil.which("qpdf"):
+        result = subprocess.run([
+            "qpdf", "--linearize",
+            "--compress-streams=" + ("y" if options.compress else "n"),
+            "--object-streams=" + ("generate" if options.object_streams else "preserve"),
+            src, dst,
+        ], stderr=subprocess.PIPE)
+        # 3 - успешно, но с предупреждениями
+        if result.returncode not in (0, 3):
+            raise RuntimeError("qpdf: {}".format(result.stderr.decode(errors="replace")))
+    else:
+        raise OutputUnavailable("Для линеаризации нужен pikepdf или qpdf")
+
+
+class PdfOutput:
+    """Запись pdf в output с параметрами вывода options
+
+    with PdfOutput(output, options) as pdf_writer: - PdfStreamWriter, который
+    закрывается при выходе из блока. Без линеаризации pdf пишется в output
+    сразу, с ней - во временный файл, который при выходе линеаризуется и
+    копируется в output. Размер результата и время от открытия до закрытия
+    (генерация, сжатие, линеаризация) попадают в метрики tpdf_output_* по
+    маршруту и набору параметров и в stats().
+    """
+
+    def __init__(self, output, options=None):
+        self.output = output
+        self.options = options or default_options()
+        self.bytes = 0
+        self.seconds = 0.0
+        self._start = None
+        self._tmp_dir = None
+
+    def __enter__(self) -> PdfStreamWriter:
+        self._start = time.perf_counter()
+        target = self.output
+        if self.options.linearize:
+            check_linearize()
+            self._tmp_dir = tempfile.mkdtemp(prefix="tpdf_")
+            target = open(os.path.join(self._tmp_dir, "source.pdf"), "wb")
+        # при линеаризации потоки объектов создаёт линеаризатор
+        self.pdf_writer = PdfStreamWriter(
+            target, compress=self.options.compress,
+            object_streams=self.options.object_streams and not self.options.linearize)
+        return self.pdf_writer
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is not None:
+                return
+            self.pdf_writer.close()
+            self.bytes = self.pdf_writer.offset
+            if self.options.linearize:
+                self.pdf_writer.f.close()
+                self.bytes = self._linearize()
+        finally:
+            if self._tmp_dir is not None:
+                if not self.pdf_writer.f.closed:
+                    self.pdf_writer.f.close()
+                shutil.rmtree(self._tmp_dir, ignore_errors=True)
+                self._tmp_dir = None
+        self.seconds = time.perf_counter() - self._start
+        label = options_label(self.options)
+        output_seconds.observe(self.seconds, endpoint.get(), label)
+        output_bytes.observe(self.bytes, endpoint.get(), label)
+        log.debug("pdf %s: %s байт за %.3f с", label, self.bytes, self.seconds)
+
+    def _linearize(self):
+        src = os.path.join(self._tmp_dir, "source.pdf")
+        dst = os.path.join(self._tmp_dir, "result.pdf")
+        with stage("pdf_linearize"):
+            linearize(src, dst, self.options)
+        with open(dst, "rb") as f:
+            shutil.copyfileobj(f, self.output, 64 * 1024)
+        return os.path.getsize(dst)
+
+    def stats(self):
+        return {"bytes": self.bytes, "output_seconds": round(self.seconds, 3),
+                "options": options_label(self.options)}
+
+
+def setup_output(app):
+    """Параметры вывода по умолчанию для запросов - в app["output"]"""
+    app["output"] = default_options()
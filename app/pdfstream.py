@@ -0,0 +1,370 @@
+import hashlib
+import logging
+import time
+import zlib
+
+from pdfrw import PdfArray, PdfDict, PdfName, PdfObject
+from pdfrw.pdfwriter import user_fmt
+
+from app.images import image_key
+from app.metrics import stage
+
+log = logging.getLogger(__name__)
+
+# номера объектов каталога и дерева страниц резервируются заранее,
+# а сами объекты пишутся последними, когда известны все страницы
+ROOT_NUM = 1
+PAGES_NUM = 2
+# сколько объектов без потоков упаковывается в один поток объектов
+OBJSTM_SIZE = 100
+
+
+class LatePdfDict(PdfDict):
+    """Объект, содержимое которого известно только к концу сборки pdf
+
+    fill() заполняет его результатом функции filler. PdfStreamWriter
+    резервирует номер объекта при первой ссылке, а пишет объект в close,
+    после заполнения.
+    """
+
+    def __init__(self, filler):
+        super().__init__()
+        self.private.filler = filler
+        self.indirect = True
+
+    def fill(self):
+        self.update(self.filler())
+
+
+def content_keys(objects):
+    """Отпечатки содержимого косвенных объектов, достижимых из objects
+
+    Отпечаток объекта учитывает его поток, значения и отпечатки всего, на что
+    он ссылается (кроме /Parent), поэтому одинаков у одинаковых объектов из
+    разных pdf файлов. У объектов в циклах ссылок отпечатки уникальны.
+    :return: словарь id(obj) -> (obj, отпечаток)
+    """
+    keys = {}
+    visiting = set()
+
+    def value(obj):
+        if isinstance(obj, (PdfDict, PdfArray)):
+            if obj.indirect or getattr(obj, "stream", None) is not None:
+                return "R" + key(obj)
+            return body(obj)
+        return str(obj)
+
+    def body(obj):
+        if isinstance(obj, PdfArray):
+            return "[%s]" % " ".join(value(x) for x in obj)
+        pairs = sorted((k, value(v)) for k, v in obj.iteritems() if k != PdfName.Parent)
+        return "<<%s>>" % " ".join("%s %s" % pair for pair in pairs)
+
+    def key(obj):
+        known = keys.get(id(obj))
+        if known is not None:
+            return known[1]
+        if id(obj) in visiting:
+            return "cycle%s" % id(obj)
+        visiting.add(id(obj))
+        digest = hashlib.md5(body(obj).encode("latin-1"))
+        if isinstance(obj, PdfDict) and obj.stream is not None:
+            digest.update(b"stream")
+            digest.update(obj.stream.encode("latin-1"))
+        visiting.discard(id(obj))
+        keys[id(obj)] = (obj, digest.hexdigest())
+        return keys[id(obj)][1]
+
+    for obj in objects:
+        key(obj)
+    return keys
+
+
+class PdfStreamWriter:
+    """Потоковая запись pdf: страницы пишутся в файл сразу по добавлении
+
+    В отличие от PdfFileWriter не держит в памяти страницы и их объекты до
+    конца сборки. В памяти остаются только смещения объектов для xref и
+    номера страниц, а также объекты, объявленные общими через share (например,
+    содержимое страниц формы) - они пишутся один раз при первом использовании.
+    Одинаковые по содержимому картинки тоже пишутся один раз, а объекты
+    LatePdfDict (например, общие шрифты наложений) - при закрытии файла.
+
+    f - любой объект с методом write(bytes): файл, BytesIO, sock.makefile("wb")
+    :param compress: сжимать (FlateDecode) потоки без фильтров, например
+        наложения полей
+    :param object_streams: упаковывать объекты без потоков (словари страниц,
+        шрифтов и т.п.) по OBJSTM_SIZE в сжатые потоки объектов, таблица xref
+        тоже пишется сжатым потоком (pdf 1.5)
+    """
+
+    def __init__(self, f, version="1.3", compress=True, object_streams=False):
+        self.f = f
+        self.compress = compress
+        self.object_streams = object_streams
+        if object_streams and version < "1.5":
+            version = "1.5"
+        self.offset = 0
+        # смещения объектов, номер = индекс + 1; у объектов в потоках
+        # объектов - (номер потока объектов, индекс в нём)
+        self.offsets = [None, None]
+        self.packed = []  # (номер, текст) объектов текущего потока объектов
+        self.kids = []  # номера объектов страниц
+        self.shared = {}  # id(obj) -> [obj, номер объекта или None]
+        self.images = {}  # отпечаток картинки -> номер объекта
+        self.late = {}  # id(obj) -> [obj, номер объекта] для LatePdfDict
+        self._write("%%PDF-%s\n%%\xe2\xe3\xcf\xd3\n" % version)
+
+    def _write(self, s):
+        data = s.encode("latin-1")
+        self.f.write(data)
+        self.offset += len(data)
+
+    def share(self, *objects):
+        """Объявляет объекты (и всё, на что они ссылаются) общими для страниц
+
+        Общие объекты пишутся в файл один раз, на них ссылаются все страницы.
+        Ссылки /Parent не обходятся, чтобы не захватить чужое дерево страниц.
+        """
+        work = list(objects)
+        while work:
+            obj = work.pop()
+            if id(obj) in self.shared:
+                continue
+            if isinstance(obj, PdfDict):
+                if obj.indirect or obj.stream is not None:
+                    self.shared[id(obj)] = [obj, None]
+                work.extend(v for k, v in obj.iteritems() if k != PdfName.Parent)
+            elif isinstance(obj, PdfArray):
+                if obj.indirect:
+                    self.shared[id(obj)] = [obj, None]
+                work.extend(obj)
+
+    def alias(self, obj, other):
+        """Ссылки на общий объект obj ведут на общий объект other, такой же
+        по содержимому: пишется только other"""
+        self.shared[id(obj)] = self.shared[id(other)]
+
+    def reuse(self, obj, num):
+        """Ссылки на общий объект obj ведут на уже записанный объект num,
+        такой же по содержимому (например, из предыдущего склеиваемого файла)"""
+        self.shared[id(obj)] = [obj, num]
+
+    def number(self, obj):
+        """Номер объекта, под которым записан общий объект obj, или None"""
+        entry = self.shared.get(id(obj))
+        return entry and entry[1]
+
+    def unshare(self):
+        """Забывает общие объекты, например после последней страницы одного
+        из склеиваемых файлов - они больше не нужны и не держатся в памяти"""
+        self.shared.clear()
+
+    def add_page(self, page):
+        """Пишет страницу и все её ещё не записанные объекты"""
+        inheritable = page.inheritable
+        page = PdfDict(
+            page,
+            Resources=inheritable.Resources,
+            MediaBox=inheritable.MediaBox,
+            CropBox=inheritable.CropBox,
+            Rotate=inheritable.Rotate,
+            # дерево страниц пишется в close под зарезервированным номером
+            Parent=PdfObject("%s 0 R" % PAGES_NUM),
+        )
+        page.indirect = True
+        page_num = self._reserve()
+        self.kids.append(page_num)
+        self._write_objects([(page_num, page)])
+        return page_num
+
+    def _write_objects(self, deferred):
+        """Пишет объекты deferred (список пар номер, объект) и все их ещё не
+        записанные объекты"""
+        local = {}
+
+        def ref(obj):
+            if isinstance(obj, PdfDict):
+                if obj.Type == PdfName.Pages:
+                    return "%s 0 R" % PAGES_NUM
+                if obj.Type == PdfName.Catalog:
+                    return "%s 0 R" % ROOT_NUM
+                indirect = obj.indirect or obj.stream is not None
+            else:
+                indirect = getattr(obj, "indirect", False)
+            if not indirect:
+                return fmt(obj)
+            if isinstance(obj, LatePdfDict):
+                entry = self.late.setdefault(id(obj), [obj, None])
+                if entry[1] is None:
+                    entry[1] = self._reserve()
+                return "%s 0 R" % entry[1]
+            # общий объект нумеруется один раз на весь файл, остальные - в
+            # пределах страницы (после записи страницы они больше не нужны)
+            entry = self.shared.get(id(obj))
+            if entry is not None:
+                if entry[1] is None:
+                    entry[1] = self._reserve()
+                    deferred.append((entry[1], obj))
+                return "%s 0 R" % entry[1]
+            num = local.get(id(obj))
+            if num is None:
+                key = None
+                if isinstance(obj, PdfDict) and obj.Subtype == PdfName.Image:
+                    # одинаковые картинки разных страниц пишем один раз
+                    key = image_key(obj)
+                    num = self.images.get(key)
+                if num is None:
+                    num = self._reserve()
+                    deferred.append((num, obj))
+                    if key is not None:
+                        self.images[key] = num
+                local[id(obj)] = num
+            return "%s 0 R" % num
+
+        def fmt(obj):
+            if isinstance(obj, (list, tuple)):
+                return "[%s]" % " ".join(ref(x) for x in obj)
+            if isinstance(obj, dict):
+                if not isinstance(obj, PdfDict):
+                    obj = PdfDict(obj)
+                pairs = dict(obj.iteritems())
+                stream = obj.stream
+                if stream is not None and self.compress and obj.Filter is None:
+                    # сжимаем при записи, сам объект (возможно, общий для
+                    # запросов) не меняется
+                    with stage("pdf_compress"):
+                        packed = zlib.compress(stream.encode("latin-1"))
+                    if len(packed) < len(stream):
+                        stream = packed.decode("latin-1")
+                        pairs[PdfName.Filter] = PdfName.FlateDecode
+                        pairs[PdfName.Length] = len(stream)
+                pairs = sorted((getattr(k, "encoded", None) or k, v) for k, v in pairs.items())
+                result = "<<%s>>" % " ".join("%s %s" % (k, ref(v)) for k, v in pairs)
+                if stream is not None:
+                    result = "%s\nstream\n%s\nendstream" % (result, stream)
+                return result
+            if hasattr(obj, "indirect"):
+                return str(getattr(obj, "encoded", None) or obj)
+            return user_fmt(obj)
+
+        while deferred:
+            num, obj = deferred.pop()
+            self._write_obj(num, fmt(obj), getattr(obj, "stream", None) is None)
+
+    def _reserve(self):
+        self.offsets.append(None)
+        return len(self.offsets)
+
+    def _write_obj(self, num, body, packable=False):
+        """Пишет объект num, объект без потока (packable) при object_streams
+        откладывается в поток объектов"""
+        if self.object_streams and packable:
+            self.packed.append((num, body))
+            if len(self.packed) >= OBJSTM_SIZE:
+                self._write_object_stream()
+            return
+        self.offsets[num - 1] = self.offset
+        self._write("%s 0 obj\n%s\nendobj\n" % (num, body))
+
+    def _write_object_stream(self):
+        """Пишет отложенные объекты одним сжатым потоком объектов"""
+        if not self.packed:
+            return
+        with stage("pdf_object_streams"):
+            num = self._reserve()
+            header = []
+            offset = 0
+            for index, (obj_num, body) in enumerate(self.packed):
+                header.append("%s %s" % (obj_num, offset))
+                offset += len(body) + 1
+                self.offsets[obj_num - 1] = (num, index)
+            header = " ".join(header) + "\n"
+            data = header + "\n".join(body for obj_num, body in self.packed)
+            data = zlib.compress(data.encode("latin-1")).decode("latin-1")
+            self.offsets[num - 1] = self.offset
+            self._write("%s 0 obj\n<</Filter /FlateDecode /First %s /Length %s /N %s /Type /ObjStm>>"
+                        "\nstream\n%s\nendstream\nendobj\n" % (
+                            num, len(header), len(data), len(self.packed), data))
+            self.packed = []
+
+    def close(self):
+        """Пишет отложенные объекты, дерево страниц, каталог, таблицу xref и
+        трейлер"""
+        late = []
+        for obj, num in self.late.values():
+            obj.fill()
+            late.append((num, obj))
+        self._write_objects(late)
+        self._write_obj(PAGES_NUM, "<</Count %s /Kids [%s] /Type /Pages>>" % (
+            len(self.kids), " ".join("%s 0 R" % num for num in self.kids)), True)
+        self._write_obj(ROOT_NUM, "<</Pages %s 0 R /Type /Catalog>>" % PAGES_NUM, True)
+        if self.object_streams:
+            self._write_object_stream()
+            self._write_xref_stream()
+            return
+        xref = self.offset
+        self._write("xref\n0 %s\n" % (len(self.offsets) + 1))
+        self._write("%010d %05d f\r\n" % (0, 65535))
+        for offset in self.offsets:
+            self._write("%010d %05d n\r\n" % (offset, 0))
+        self._write("trailer\n\n<</Root %s 0 R /Size %s>>\nstartxref\n%s\n%%%%EOF\n" % (
+            ROOT_NUM, len(self.offsets) + 1, xref))
+
+    def _write_xref_stream(self):
+        """Таблица xref и трейлер одним сжатым потоком (вместо текстовой
+        таблицы, в ней не записать объекты из потоков объектов)"""
+        num = self._reserve()
+        xref = self.offsets[num - 1] = self.offset
+        width = max(1, (xref.bit_length() + 7) // 8)
+        rows = [b"\x00" + bytes(width) + b"\xff\xff"]
+        for entry in self.offsets:
+            if isinstance(entry, tuple):
+                rows.append(b"\x02" + entry[0].to_bytes(width, "big") + entry[1].to_bytes(2, "big"))
+            else:
+                rows.append(b"\x01" + entry.to_bytes(width, "big") + b"\x00\x00")
+        data = zlib.compress(b"".join(rows)).decode("latin-1")
+        self._write("%s 0 obj\n<</Filter /FlateDecode /Length %s /Root %s 0 R /Size %s "
+                    "/Type /XRef /W [1 %s 2]>>\nstream\n%s\nendstream\nendobj\n" % (
+                        num, len(data), ROOT_NUM, len(self.offsets) + 1, width, data))
+        self._write("startxref\n%s\n%%%%EOF\n" % xref)
+
+
+class Progress:
+    """Счётчик строк пакетной обработки со скоростью в строках в секунду
+
+    callback(rows, rows_per_sec) вызывается каждые every строк и в конце
+    """
+
+    def __init__(self, callback=None, every=100):
+        self.callback = callback
+        self.every = every
+        self.rows = 0
+        self.start = time.monotonic()
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.start
+
+    @property
+    def rate(self):
+        elapsed = self.elapsed
+        return self.rows / elapsed if elapsed else 0.0
+
+    def step(self, rows=1):
+        before = self.rows
+        self.rows += rows
+        if self.rows // self.every != before // self.every:
+            self.report()
+
+    def report(self):
+        log.info("обработано строк: %s, %.1f строк/с", self.rows, self.rate)
+        if self.callback is not None:
+            self.callback(self.rows, self.rate)
+
+    def stats(self):
+        return {
+            "rows": self.rows,
+            "seconds": round(self.elapsed, 3),
+            "rows_per_sec": round(self.rate, 1),
+        }
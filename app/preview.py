@@ -0,0 +1,103 @@
+import io
+import shutil
+import subprocess
+import threading
+from collections import OrderedDict
+
+from app.pdfstream import PdfStreamWriter
+from app.tpdf import TPdf, registry
+
+
+class PreviewUnavailable(Exception):
+    """Нет средства растеризации pdf в png"""
+
+
+def load_pymupdf():
+    """PyMuPDF или None: импортируется только при первой растеризации, он
+    крупный, а png нужен не всем"""
+    try:
+        import pymupdf
+    except ImportError:
+        try:
+            import fitz as pymupdf
+        except ImportError:
+            return None
+    return pymupdf
+
+
+def rasterize(pdf, dpi=96):
+    """Первая страница pdf в png с разрешением dpi
+
+    Растеризация необязательна: PyMuPDF, если установлен, иначе pdftoppm из
+    poppler-utils, если есть в PATH
+    """
+    pymupdf = load_pymupdf()
+    if pymupdf is not None:
+        with pymupdf.open(stream=pdf, filetype="pdf") as doc:
+            return doc[0].get_pixmap(dpi=dpi).tobytes("png")
+    if shutil.which("pdftoppm"):
+        return subprocess.run(
+            ["pdftoppm", "-png", "-r", str(dpi), "-singlefile", "-"],
+            input=pdf, stdout=subprocess.PIPE, check=True).stdout
+    raise PreviewUnavailable("Для png нужен PyMuPDF или pdftoppm (poppler-utils)")
+
+
+def render_page(dir_name, page_number, fmt="pdf", dpi=96):
+    """Одна страница шаблона с именами полей вместо значений (как get_file)
+
+    :param page_number: номер страницы, с 0
+    :param fmt: "pdf" или "png"
+    """
+    page = TPdf().render_page(dir_name, page_number, fill_x=True)
+    output = io.BytesIO()
+    pdf_writer = PdfStreamWriter(output)
+    pdf_writer.add_page(page)
+    pdf_writer.close()
+    if fmt == "png":
+        return rasterize(output.getvalue(), dpi)
+    return output.getvalue()
+
+
+class PreviewCache:
+    """Небольшой LRU кэш страниц предпросмотра
+
+    Ключ - страница, формат и отпечатки файлов шаблона и его шрифтов:
+    сохранение полей или замена формы меняют ключ, старая запись вытесняется.
+    """
+
+    def __init__(self, max_items=32):
+        self.max_items = max_items
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, dir_name, page_number, fmt="pdf", dpi=96):
+        template = registry.get(dir_name)
+        if not 0 <= page_number < len(template.pages):
+            raise IndexError("В шаблоне {} нет страницы {}".format(dir_name, page_number + 1))
+        key = (dir_name, page_number, fmt, dpi if fmt == "png" else None,
+               template.stamp, registry.font_stamps(template.fonts))
+        with self._lock:
+            body = self._items.get(key)
+            if body is not None:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return body
+            self.misses += 1
+        body = render_page(dir_name, page_number, fmt, dpi)
+        with self._lock:
+            self._items[key] = body
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+        return body
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def stats(self):
+        return {"items": len(self._items), "hits": self.hits, "misses": self.misses}
+
+
+preview_cache = PreviewCache()
@@ -0,0 +1,253 @@
+"""Запуск веб сервера: один процесс или несколько рабочих процессов
+
+С workers > 1 родительский процесс один раз импортирует библиотеки,
+компилирует все шаблоны и регистрирует шрифты (registry), затем открывает
+сокет и запускает fork рабочих процессов. Процессы получают прогретый реестр
+готовым (страницы памяти общие, copy-on-write) и принимают соединения с
+общего сокета родителя или, с reuse_port, каждый со своего (SO_REUSEPORT).
+Упавший процесс, а также отработавший max_requests запросов, родитель
+запускает заново.
+"""
+import gc
+import logging
+import os
+import resource
+import signal
+import socket
+import time
+
+from aiohttp import web
+
+from app.catalog import create_default_fields
+from app.config import load_section
+from app.tpdf import FILES, registry
+
+log = logging.getLogger(__name__)
+
+# настройки сервера по умолчанию (config.load_section), например
+# TPDF_SERVER_WORKERS=4
+CONFIG = {
+    "host": "0.0.0.0",
+    "port": 8001,
+    # рабочих процессов; 1 - один процесс без fork, как web.run_app
+    "workers": 1,
+    # после стольких запросов процесс перезапускается (0 - без ограничения),
+    # чтобы не копились утечки и фрагментация памяти
+    "max_requests": 0,
+    # у каждого процесса свой сокет с SO_REUSEPORT (соединения распределяет
+    # ядро), иначе - общий сокет, открытый родителем
+    "reuse_port": False,
+    # секунд на завершение начатых запросов при остановке процесса
+    "shutdown_timeout": 60,
+}
+
+# упавший быстрее этого процесс перезапускается с такой же задержкой
+RESPAWN_DELAY = 1.0
+
+
+def load_config():
+    """Настройки сервера с учётом переменных окружения"""
+    return load_section("server", CONFIG)
+
+
+def preload():
+    """Компилирует все шаблоны и регистрирует шрифты в реестре процесса.
+    Настройки полей по умолчанию формируются здесь же, до fork, чтобы рабочие
+    процессы не создавали их одновременно
+
+    :return: количество загруженных шаблонов
+    """
+    registry.register_fonts()
+    count = 0
+    for dir_name in sorted(os.listdir(FILES)):
+        dir_path = os.path.join(FILES, dir_name)
+        if not os.path.isdir(dir_path):
+            continue
+        try:
+            create_default_fields(dir_name, dir_path)
+        except Exception:
+            log.exception("настройки полей шаблона %s не созданы", dir_name)
+        if not os.path.isfile(os.path.join(FILES, dir_name, "fields.json")):
+            continue
+        try:
+            registry.get(dir_name)
+        except Exception:
+            log.exception("шаблон %s не загружен", dir_name)
+            continue
+        count += 1
+    return count
+
+
+def memory_usage():
+    """Память процесса в МБ: rss - вся, pss - с долей общих с другими
+    процессами страниц, private - только своя (linux), иначе - пиковая rss"""
+    try:
+        with open("/proc/self/smaps_rollup") as f:
+            values = dict(line.split()[:2] for line in f if line.endswith("kB\n"))
+    except OSError:
+        return {"max_rss": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)}
+    mb = {key.rstrip(":"): int(value) / 1024 for key, value in values.items()}
+    return {
+        "rss": round(mb["Rss"], 1),
+        "pss": round(mb["Pss"], 1),
+        "private": round(mb["Private_Clean"] + mb["Private_Dirty"], 1),
+    }
+
+
+def format_memory(memory):
+    return ", ".join("{} {} МБ".format(key, value) for key, value in memory.items())
+
+
+def listen(host, port, backlog=128):
+    """Слушающий сокет, общий для рабочих процессов (наследуется при fork)"""
+    sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+
+def request_limit(max_requests):
+    """Middleware: после max_requests запросов процесс завершается, как по
+    SIGTERM (дорабатывает начатые запросы), и родитель запускает новый"""
+    count = 0
+
+    @web.middleware
+    async def middleware(request, handler):
+        nonlocal count
+        try:
+            return await handler(request)
+        finally:
+            count += 1
+            if count == max_requests:
+                log.info("pid %s: обработано запросов: %s, перезапуск", os.getpid(), count)
+                os.kill(os.getpid(), signal.SIGTERM)
+
+    return middleware
+
+
+def run_worker(make_app, number, sock, config, started):
+    """Рабочий процесс: приложение make_app() на сокете sock родителя
+
+    :param started: время запуска сервера (time.monotonic) для отчёта
+    """
+    forked = time.monotonic()
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    app = make_app()
+    app["worker"] = number
+    if number and "jobs" in app:
+        # фоновые задания выполняет процесс 0, остальные их только принимают
+        app["jobs"].workers = 0
+    if config["max_requests"]:
+        app.middlewares.append(request_limit(config["max_requests"]))
+
+    async def on_startup(app):
+        now = time.monotonic()
+        log.info("процесс %s (pid %s) готов за %.2f с (от запуска сервера %.2f с), память: %s",
+                 number, os.getpid(), now - forked, now - started, format_memory(memory_usage()))
+
+    app.on_startup.append(on_startup)
+    if config["reuse_port"]:
+        address = {"host": config["host"], "port": config["port"], "reuse_port": True}
+    else:
+        address = {"sock": sock}
+    web.run_app(app, shutdown_timeout=config["shutdown_timeout"], print=None, **address)
+
+
+def exit_reason(status):
+    if os.WIFSIGNALED(status):
+        return "сигнал {}".format(signal.Signals(os.WTERMSIG(status)).name)
+    return "код {}".format(os.WEXITSTATUS(status))
+
+
+class Supervisor:
+    """Родительский процесс: запускает workers рабочих процессов и
+    перезапускает завершившиеся, по SIGTERM/SIGINT останавливает все"""
+
+    def __init__(self, make_app, config, sock=None, started=None):
+        self.make_app = make_app
+        self.config = config
+        self.sock = sock
+        self.started = started or time.monotonic()
+        self.children = {}  # pid -> (номер процесса, время запуска)
+        self.stopping = False
+
+    def spawn(self, number):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                run_worker(self.make_app, number, self.sock, self.config, self.started)
+            except SystemExit as e:
+                code = e.code if isinstance(e.code, int) else int(e.code is not None)
+            except BaseException:
+                log.exception("процесс %s (pid %s) упал", number, os.getpid())
+                code = 1
+            finally:
+                logging.shutdown()
+                os._exit(code)
+        self.children[pid] = (number, time.monotonic())
+
+    def stop(self, signum=None, frame=None):
+        self.stopping = True
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for number in range(self.config["workers"]):
+            self.spawn(number)
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            number, spawned = self.children.pop(pid)
+            if self.stopping:
+                continue
+            if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0:
+                log.info("процесс %s (pid %s) завершился, перезапуск", number, pid)
+            else:
+                log.warning("процесс %s (pid %s) упал (%s), перезапуск",
+                            number, pid, exit_reason(status))
+                # падает сразу при запуске - не перезапускаем в цикле
+                if time.monotonic() - spawned < RESPAWN_DELAY:
+                    time.sleep(RESPAWN_DELAY)
+                    if self.stopping:
+                        continue
+            self.spawn(number)
+
+
+def serve(make_app, **overrides):
+    """Запускает сервер с настройками CONFIG, overrides - поверх них
+
+    :param make_app: функция, создающая веб приложение (index.make_app),
+        вызывается в каждом рабочем процессе
+    """
+    config = load_config()
+    config.update((key, value) for key, value in overrides.items() if value is not None)
+    if config["workers"] <= 1 or not hasattr(os, "fork"):
+        if config["max_requests"]:
+            # перезапускает процессы родитель, а в одном процессе его нет
+            log.warning("max_requests=%s не действует без рабочих процессов (workers > 1)",
+                        config["max_requests"])
+        web.run_app(make_app(), host=config["host"], port=config["port"],
+                    shutdown_timeout=config["shutdown_timeout"])
+        return
+    started = time.monotonic()
+    templates = preload()
+    sock = None if config["reuse_port"] else listen(config["host"], config["port"])
+    # загруженное - в постоянное поколение gc: сборщик мусора рабочих
+    # процессов не обходит эти объекты и не копирует их страницы памяти
+    gc.collect()
+    gc.freeze()
+    log.info("предзагрузка: шаблонов %s за %.2f с, память: %s; %s процессов на %s:%s",
+             templates, time.monotonic() - started, format_memory(memory_usage()),
+             config["workers"], config["host"], config["port"])
+    Supervisor(make_app, config, sock, started).run()
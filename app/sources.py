@@ -0,0 +1,166 @@
+import csv
+import json
+import os
+import zipfile
+from itertools import chain
+from typing import Generator
+
+import openpyxl
+from openpyxl.utils.exceptions import InvalidFileException
+
+# строк, читаемых за раз из parquet и arrow
+BATCH_ROWS = 1024
+
+# форматы файлов данных по типу тела запроса
+CONTENT_TYPES = {
+    "text/csv": "csv",
+    "application/x-ndjson": "jsonl",
+    "application/jsonl": "jsonl",
+    "application/jsonlines": "jsonl",
+    "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet": "xlsx",
+    "application/vnd.apache.parquet": "parquet",
+    "application/x-parquet": "parquet",
+    "application/vnd.apache.arrow.file": "arrow",
+}
+
+
+class UnsupportedSource(ValueError):
+    """Неизвестный формат файла данных или не установлен pyarrow"""
+
+
+class InvalidSource(ValueError):
+    """Файл данных повреждён или не в своём формате"""
+
+
+def iter_xlsx(path) -> Generator[dict, None, None]:
+    """Построчно читает xlsx файл path в формате data.xlsx
+
+    Первая строка файла - номера страниц, вторая - имена полей, далее данные
+    """
+    try:
+        wb_obj = openpyxl.load_workbook(path, read_only=True)
+    except (zipfile.BadZipFile, InvalidFileException, KeyError) as e:
+        raise InvalidSource("Файл данных - не xlsx: {}".format(e))
+    try:
+        rows = wb_obj.active.iter_rows(values_only=True)
+        next(rows, None)  # номера страниц
+        field_names = next(rows, ())
+        for row in rows:
+            yield dict(zip(field_names, row))
+    finally:
+        wb_obj.close()
+
+
+def is_pages_row(row):
+    """Строка номеров страниц (как первая строка data.xlsx)?"""
+    values = [value for value in row if value not in (None, "")]
+    return bool(values) and all(
+        isinstance(value, int) or isinstance(value, str) and value.strip().isdigit()
+        for value in values)
+
+
+def iter_table(rows) -> Generator[dict, None, None]:
+    """Словари из строк-списков: как в data.xlsx, но строка номеров страниц
+    необязательна (страницы полей и так известны из fields.json)"""
+    rows = iter(rows)
+    field_names = next(rows, None)
+    if field_names is not None and is_pages_row(field_names):
+        field_names = next(rows, None)
+    if field_names is None:
+        return
+    for row in rows:
+        yield dict(zip(field_names, row))
+
+
+def iter_csv(path) -> Generator[dict, None, None]:
+    """Построчно читает csv (разделитель - запятая, точка с запятой или
+    табуляция, определяется по началу файла)"""
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        try:
+            dialect = csv.Sniffer().sniff(f.read(64 * 1024), delimiters=",;\t")
+        except csv.Error:
+            dialect = csv.excel
+        f.seek(0)
+        yield from iter_table(csv.reader(f, dialect))
+
+
+def iter_jsonl(path) -> Generator[dict, None, None]:
+    """Построчно читает json lines: объект {поле: значение} в строке или, как
+    в csv, списки - номера страниц (необязательно), имена полей и значения"""
+    with open(path, encoding="utf-8") as f:
+        rows = (json.loads(line) for line in f if line.strip())
+        first = next(rows, None)
+        if isinstance(first, dict):
+            yield first
+            yield from rows
+        elif first is not None:
+            yield from iter_table(chain([first], rows))
+
+
+def load_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        raise UnsupportedSource("Для parquet и arrow нужен pyarrow (pip install pyarrow)")
+    return pyarrow
+
+
+def iter_parquet(path) -> Generator[dict, None, None]:
+    """Читает parquet пачками по BATCH_ROWS строк, имена полей - имена столбцов"""
+    pyarrow = load_pyarrow()
+    for batch in pyarrow.parquet.ParquetFile(path).iter_batches(BATCH_ROWS):
+        yield from batch.to_pylist()
+
+
+def iter_arrow(path) -> Generator[dict, None, None]:
+    """Читает файл arrow (feather v2) по record batch, не загружая целиком"""
+    pyarrow = load_pyarrow()
+    with pyarrow.memory_map(path) as source:
+        reader = pyarrow.ipc.open_file(source)
+        for i in range(reader.num_record_batches):
+            yield from reader.get_batch(i).to_pylist()
+
+
+# чтение строк данных по расширению файла, порядок - порядок поиска data.*
+# в папке шаблона
+READERS = {
+    "xlsx": iter_xlsx,
+    "csv": iter_csv,
+    "jsonl": iter_jsonl,
+    "parquet": iter_parquet,
+    "arrow": iter_arrow,
+}
+
+
+def source_format(path):
+    fmt = os.path.splitext(path)[1][1:].lower()
+    if fmt not in READERS:
+        raise UnsupportedSource("Неизвестный формат данных: {}".format(path))
+    return fmt
+
+
+def iter_rows(path) -> Generator[dict, None, None]:
+    """Строки файла данных path словарями {имя поля: значение}, лениво"""
+    return READERS[source_format(path)](path)
+
+
+def find_data_file(dir_path):
+    """Файл данных шаблона: data.xlsx, data.csv, data.jsonl, ... или None"""
+    for fmt in READERS:
+        path = os.path.join(dir_path, "data." + fmt)
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def upload_format(content_type, fmt=None):
+    """Формат загружаемых данных: явный fmt (?format=), иначе по типу тела
+    запроса, по умолчанию - xlsx"""
+    fmt = fmt or CONTENT_TYPES.get(content_type, "xlsx")
+    if fmt not in READERS:
+        raise UnsupportedSource("Неизвестный формат данных: {}".format(fmt))
+    if fmt in ("parquet", "arrow"):
+        load_pyarrow()
+    return fmt
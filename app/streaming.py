@@ -0,0 +1,250 @@
+import asyncio
+import base64
+import os
+import tempfile
+import threading
+from collections import deque
+from urllib.parse import quote
+
+from aiohttp import web
+
+from app.metrics import stage
+
+CHUNK_SIZE = 64 * 1024
+# сколько готовых кусков может ждать отправки клиенту в памяти, следующие -
+# во временном файле
+MAX_CHUNKS = 8
+# сколько байт может ждать отправки во временном файле, дальше генерация pdf
+# приостанавливается, пока клиент не заберёт данные
+MAX_SPILL = 512 * 1024 * 1024
+
+# get: готовых кусков пока нет
+_EMPTY = object()
+
+
+class StreamAborted(Exception):
+    """Клиент отключился, генерацию pdf нужно прервать"""
+
+
+class QueueWriter:
+    """Файловый объект для записи из потока пула, event loop забирает
+    записанное (get) и отдаёт клиенту
+
+    Данные копятся до CHUNK_SIZE и отдаются кусками. В памяти ждут отправки
+    не больше MAX_CHUNKS кусков; если клиент читает медленнее, чем
+    генерируется pdf, следующие куски дописываются во временный файл, и
+    генерация не ждёт клиента: поток и место в пуле освобождаются, как только
+    pdf готов. Только если и в файле больше MAX_SPILL байт, write блокирует
+    поток пула, пока клиент не заберёт данные.
+    """
+
+    def __init__(self, loop, chunk_size=CHUNK_SIZE, max_chunks=MAX_CHUNKS,
+                 max_spill=MAX_SPILL):
+        self.loop = loop
+        self.chunk_size = chunk_size
+        self.max_chunks = max_chunks
+        self.max_spill = max_spill
+        self.aborted = False
+        self._buffer = bytearray()
+        self._chunks = deque()  # куски в памяти
+        self._spill = None  # временный файл для кусков сверх max_chunks
+        self._spilled = deque()  # размеры кусков в файле по порядку
+        self._spill_bytes = 0
+        self._read_pos = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        self._ready = asyncio.Event()
+
+    def write(self, data):
+        self._buffer += data
+        if len(self._buffer) >= self.chunk_size:
+            self._put(bytes(self._buffer))
+            self._buffer.clear()
+
+    def flush(self):
+        """Отдаёт накопленное, не дожидаясь CHUNK_SIZE (например, после
+        очередного файла в zip архиве)"""
+        if self._buffer:
+            self._put(bytes(self._buffer))
+            self._buffer.clear()
+
+    def close(self):
+        self.flush()
+        self._finish()
+
+    def fail(self):
+        """Завершает поток без отправки недописанного: генерация упала, и если
+        клиенту ещё ничего не ушло, он получит обычную ошибку"""
+        self._buffer.clear()
+        if not self.aborted:
+            self._finish()
+
+    def _finish(self):
+        with self._cond:
+            self._closed = True
+        self.loop.call_soon_threadsafe(self._ready.set)
+
+    def _put(self, chunk):
+        with self._cond:
+            while True:
+                if self.aborted:
+                    raise StreamAborted()
+                # пока в файле что-то есть, новые куски - за ним, по порядку
+                if not self._spilled and len(self._chunks) < self.max_chunks:
+                    self._chunks.append(chunk)
+                    break
+                if self._spill_bytes + len(chunk) <= self.max_spill:
+                    if self._spill is None:
+                        self._spill = tempfile.TemporaryFile()
+                    self._spill.seek(0, os.SEEK_END)
+                    self._spill.write(chunk)
+                    self._spilled.append(len(chunk))
+                    self._spill_bytes += len(chunk)
+                    break
+                # и память, и файл заполнены - ждём клиента
+                self._cond.wait(1)
+        self.loop.call_soon_threadsafe(self._ready.set)
+
+    def _take(self):
+        """Следующий кусок: сначала из памяти, затем из файла; None - pdf
+        закончился, _EMPTY - готовых кусков пока нет"""
+        with self._cond:
+            if self._chunks:
+                chunk = self._chunks.popleft()
+            elif self._spilled:
+                size = self._spilled.popleft()
+                self._spill.seek(self._read_pos)
+                chunk = self._spill.read(size)
+                self._read_pos += size
+                self._spill_bytes -= size
+                if not self._spilled:
+                    # файл отправлен целиком, следующие куски - снова в память
+                    self._spill.close()
+                    self._spill = None
+                    self._read_pos = 0
+            else:
+                return None if self._closed else _EMPTY
+            self._cond.notify()
+            return chunk
+
+    async def get(self):
+        """Следующий кусок для отправки клиенту, None - pdf закончился"""
+        while True:
+            self._ready.clear()
+            with self._cond:
+                from_file = not self._chunks and bool(self._spilled)
+            if from_file:
+                chunk = await self.loop.run_in_executor(None, self._take)
+            else:
+                chunk = self._take()
+            if chunk is not _EMPTY:
+                return chunk
+            await self._ready.wait()
+
+    def abort(self):
+        """Прерывает запись: вызывается из event loop при отключении клиента"""
+        with self._cond:
+            self.aborted = True
+            self._chunks.clear()
+            self._spilled.clear()
+            if self._spill is not None:
+                self._spill.close()
+                self._spill = None
+            self._cond.notify_all()
+
+
+class Base64Writer:
+    """Обёртка над файловым объектом, кодирующая данные в base64 по частям
+
+    Кодируются только куски кратные 3 байтам, остаток ждёт следующей записи,
+    поэтому результат совпадает с base64 всего файла целиком
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self._tail = b""
+
+    def write(self, data):
+        data = self._tail + data
+        cut = len(data) - len(data) % 3
+        self._tail = data[cut:]
+        if cut:
+            with stage("base64"):
+                data = base64.b64encode(data[:cut])
+            self.f.write(data)
+
+    def flush(self):
+        # остаток меньше 3 байт ждёт следующей записи или close
+        self.f.flush()
+
+    def close(self):
+        if self._tail:
+            self.f.write(base64.b64encode(self._tail))
+            self._tail = b""
+        self.f.close()
+
+
+def _write_all(fn, args, kwargs, queue_writer, writer):
+    try:
+        result = fn(*args, output=writer, **kwargs)
+    except BaseException:
+        queue_writer.fail()
+        raise
+    writer.close()
+    return result
+
+
+async def stream_pdf(request, file_name, fn, *args, executor="render", b64=False,
+                     headers=None, content_type="application/pdf", **kwargs):
+    """Отдаёт pdf клиенту по мере генерации (chunked transfer encoding)
+
+    fn(*args, output=..., **kwargs) выполняется в потоке пула executor и
+    пишет pdf в output. Место в пуле занято только на время генерации:
+    то, что клиент не успел забрать, ждёт отправки в QueueWriter. Заголовки отправляются с первым готовым куском,
+    поэтому ошибки до него (в т.ч. 503 при заполненной очереди пула)
+    возвращаются клиенту обычным ответом.
+    :param b64: отдавать base64 вместо бинарного pdf
+    :param headers: дополнительные заголовки ответа
+    :param content_type: тип ответа, если это не pdf (например, zip архив)
+    """
+    queue_writer = QueueWriter(asyncio.get_running_loop())
+    writer = Base64Writer(queue_writer) if b64 else queue_writer
+    task = asyncio.ensure_future(request.app["executors"][executor].run(
+        _write_all, fn, args, kwargs, queue_writer, writer, in_thread=True))
+    response = get = None
+    try:
+        while True:
+            get = asyncio.ensure_future(queue_writer.get())
+            if not task.done():
+                await asyncio.wait([get, task], return_when=asyncio.FIRST_COMPLETED)
+            if not get.done() and (task.cancelled() or task.exception() is not None):
+                # генерация упала (или не началась), не отдав данных
+                await task
+            # генерация закончилась, но отдать клиенту осталось всё
+            # дописанное: место в пуле уже свободно
+            chunk = await get
+            if chunk is None:
+                break
+            if response is None:
+                response = web.StreamResponse(headers=dict(headers or {}, **{
+                    "Content-Type": "text/plain; charset=utf-8" if b64 else content_type,
+                    "Content-Disposition": "inline; filename*=UTF-8''{}".format(
+                        quote(file_name, encoding="utf-8")),
+                }))
+                response.enable_chunked_encoding()
+                await response.prepare(request)
+            await response.write(chunk)
+        await task
+    except BaseException:
+        # клиент отключился или генерация упала: останавливаем поток пула,
+        # его ошибку (StreamAborted) забирать уже некому
+        queue_writer.abort()
+        if get is not None:
+            get.cancel()
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        raise
+    if response is None:
+        # пустой pdf не бывает, но на всякий случай отвечаем корректно
+        return web.Response(status=204)
+    await response.write_eof()
+    return response
@@ -0,0 +1,53 @@
+from collections import namedtuple
+
+from pdfrw import PdfArray, PdfDict, PdfName
+from reportlab.lib.rl_accel import escapePDF, fp_str
+
+# наложение страницы только с текстом: поток содержимого и шрифты, на которые
+# он ссылается, - пары (номер шрифта, номер подмножества) в FontSubsets
+TextOverlay = namedtuple("TextOverlay", "stream fonts")
+
+
+class TextLayer:
+    """Наложение только с текстом, без reportlab canvas
+
+    Строки выводятся теми же операторами, что и canvas.drawString (BT, Tm,
+    Tf, Tj, ET), коды символов назначает общее состояние шрифтов
+    (fonts.FontSubsets), поэтому текст на странице тот же, что и у наложения
+    reportlab. Результат - TextOverlay: его не нужно сохранять в pdf и
+    разбирать обратно, страница собирается сразу (text_overlay_page).
+    :param fonts: общие подмножества шрифтов (fonts.FontSubsets)
+    """
+
+    def __init__(self, fonts):
+        self.fonts = fonts
+        self.ops = []
+        self.used = set()
+
+    def draw_string(self, x, y, text, font_name, font_size):
+        """Строка text в точке x, y (от левого нижнего угла страницы)"""
+        if not text:
+            return
+        index, parts = self.fonts.split(font_name, text)
+        size = "%s Tf %s TL" % (fp_str(font_size), fp_str(font_size * 1.2))
+        ops = ["BT 1 0 0 1 %s Tm" % fp_str(x, y)]
+        for subset, chars in parts:
+            self.used.add((index, subset))
+            ops.append("/F%d+%d %s (%s) Tj" % (index, subset, size, escapePDF(chars)))
+        ops.append("ET")
+        self.ops.append(" ".join(ops))
+
+    def overlay(self):
+        return TextOverlay("\n".join(self.ops) + "\n", tuple(sorted(self.used)))
+
+
+def text_overlay_page(overlay, fonts, page_size):
+    """Страница pdfrw из TextOverlay: шрифты - общие объекты fonts, как у
+    наложений reportlab после FontSubsets.replace"""
+    return PdfDict(
+        Type=PdfName.Page,
+        MediaBox=PdfArray([0, 0, page_size[0], page_size[1]]),
+        Resources=PdfDict(Font=PdfDict({
+            PdfName("F%d+%d" % key): fonts.font(*key) for key in overlay.fonts})),
+        Contents=PdfDict(stream=overlay.stream),
+    )
@@ -1,38 +1,110 @@
 import base64
+import hashlib
 import io
 import json
 import os
+import tempfile
+import threading
 from collections import namedtuple
+from contextlib import contextmanager
 from datetime import datetime as dt
-from functools import cached_property
 from glob import glob
+from itertools import islice
 from typing import Generator
 
-import openpyxl
-from pdfrw import PageMerge, PdfFileReader, PdfFileWriter
+try:
+    import fcntl
+except ImportError:  # windows: процессы сервера только на unix (fork)
+    fcntl = None
+
+from pdfrw import PageMerge, PdfDict, PdfFileReader, PdfName
+from pdfrw.buildxobj import pagexobj
+from pdfrw.compress import compress
+from pdfrw.errors import PdfNotImplementedError
 from reportlab.lib.pagesizes import A4
-from reportlab.lib.utils import ImageReader
 from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
 from reportlab.pdfgen import canvas
 
+from app.binding import ImageValue, computed_field, format_date, plans
+from app.fonts import FontSubsets, is_shared
+from app.glyphs import fit_text, reset_glyph_widths, wrap_text
+from app.images import dedup_images, draw_image
+from app.metrics import stage
+from app.output import PdfOutput
+from app.pdfstream import Progress
+from app.sources import find_data_file, iter_rows, iter_xlsx
+from app.textlayer import TextLayer, TextOverlay, text_overlay_page
+
 CUR_PATH = os.path.dirname(os.path.abspath(__file__))
 FILES = os.path.join(CUR_PATH, "tpdf_templates")
+FONTS = os.path.abspath(os.path.join(CUR_PATH, "../static/fonts"))
+
+# max_lines, min_font_size и fmt необязательны (задаются в fields.json
+# вручную): обрезка текста до max_lines строк и уменьшение шрифта, чтобы текст
+# влез в поле, форматтер значения ("text", "date", "number", см. binding.py)
+FieldParams = namedtuple(
+    "FieldParams", "x y name font_name font_size width max_lines min_font_size fmt",
+    defaults=(None, None, None),
+)
+
+# сколько строк данных готовится за раз при массовом впечатывании: план
+# подстановки и форматирование значений - один раз на пачку
+BATCH_ROWS = 32
+
+
+class Template(namedtuple("Template", "dir_name pages forms fields fonts stamp digest")):
+    """Скомпилированный шаблон: разобранные страницы формы, они же в виде
+    Form XObject (None, если страницу нельзя так представить), поля
+    постранично, используемые шрифты, отпечаток файлов, по которому шаблон
+    устаревает, и хэш содержимого файлов (для ключей кэша результатов)"""
+    __slots__ = ()
+
+    @property
+    def shared(self):
+        """Объекты формы, общие для всех документов по этому шаблону"""
+        return self.pages + tuple(form for form in self.forms if form is not None)
+
 
-FieldParams = namedtuple("FieldParams", "x y name font_name font_size width")
 page_size = A4
 page_width = page_size[0]
 page_height = page_size[1]
 # https://stackoverflow.com/questions/139655/convert-pixels-to-points
 corr = {"x": 205.0, "y": 11.0, "px_to_pt": 3/4, "pt_to_px": 4/3}
+# запись fields.json: одновременные сохранения не должны перемешаться
+fields_lock = threading.Lock()
+
+
+@contextmanager
+def fields_file_lock(dir_name):
+    """Блокировка изменения fields.json шаблона: между потоками - fields_lock,
+    между процессами сервера - flock на папку шаблона"""
+    with fields_lock:
+        if fcntl is None:
+            yield
+            return
+        fd = os.open(os.path.join(FILES, dir_name), os.O_RDONLY)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
 
 
 class TPdf:
 
-    def __init__(self):
-        self.fields = {}
+    def __init__(self, font_subsets=True):
+        """
+        :param font_subsets: общие для всех наложений подмножества шрифтов
+            (fonts.FontSubsets): каждый шрифт попадает в pdf один раз, а не в
+            каждое наложение. Можно передать готовый экземпляр, например с
+            состоянием из другого процесса
+        """
         self.documents = {}
-        self.FONTS = os.path.abspath(os.path.join(CUR_PATH, "../static/fonts"))
+        if font_subsets is True:
+            font_subsets = FontSubsets()
+        self.font_subsets = font_subsets or None
+        self.FONTS = FONTS
 
     @staticmethod
     def load_fields_from_file(name="", to_front=False):
@@ -62,29 +134,91 @@ class TPdf:
         :return: успех или не успех
         """
         dir_name = new_pos.pop("dir_name")
+        with fields_file_lock(dir_name):
+            return TPdf._save_fields(dir_name, new_pos)
+
+    @staticmethod
+    def create_fields_file(dir_name, fields):
+        """Создаёт fields.json шаблона из полей в pdf координатах, если файла
+        ещё нет. Существующий файл (например, только что записанный другим
+        процессом сервера) не меняется
+
+        :return: True - файл создан
+        """
+        with fields_file_lock(dir_name):
+            if os.path.isfile(os.path.join(FILES, dir_name, "fields.json")):
+                return False
+            TPdf._write_fields(dir_name, fields)
+            return True
+
+    @staticmethod
+    def _save_fields(dir_name, new_pos):
         pdf_fields_path = os.path.join(FILES, dir_name, "fields.json")
         if os.path.isfile(pdf_fields_path):
             res_positions = json.load(open(pdf_fields_path, "r"))
             for page in new_pos:
+                # веб форма не знает о необязательных параметрах полей,
+                # переносим их из файла для тех же полей на тех же местах
+                old_fields = res_positions.get(page, [])
                 new_pos[page] = [
-                    TPdf.convert_coord_from_front(FieldParams(*f))
-                    for f in new_pos[page]
+                    TPdf.convert_coord_from_front(FieldParams(*f))._replace(
+                        **TPdf.field_extras(old_fields, i, f[2]))
+                    for i, f in enumerate(new_pos[page])
                 ]
             res_positions.update(new_pos)
         else:
             res_positions = new_pos
+        TPdf._write_fields(dir_name, res_positions)
+        return True
+
+    @staticmethod
+    def _write_fields(dir_name, res_positions):
+        pdf_fields_path = os.path.join(FILES, dir_name, "fields.json")
         # форматируем строку с данными, для красивого отображения в файле
         for page in res_positions:
             res_positions[page].sort(key=lambda field: field[1], reverse=True)
-            res_positions[page] = [json.dumps(f, ensure_ascii=False) for f in res_positions[page]]
+            res_positions[page] = [
+                json.dumps(TPdf.field_to_list(f), ensure_ascii=False)
+                for f in res_positions[page]
+            ]
         # преобразовываем итоговый словарь с координатами в json-строку с
         # нужными переносами строк, убираем лишние кавычки и слэши и сохраняем
         # итоговую (параметры одного поля в одной строке) json-строку в файл
         new_pos_str = json.dumps(res_positions, indent=4, ensure_ascii=False).\
             replace("\"[", "[").replace("]\"", "]").replace("\\", "")
-        with open(pdf_fields_path, "w") as outfile:
-            outfile.write(new_pos_str)
-        return True
+        # пишем в свой временный файл (O_EXCL) и переименовываем: читатели не
+        # увидят недописанный файл
+        fd, tmp_path = tempfile.mkstemp(suffix=".tmp", prefix="fields.",
+                                        dir=os.path.dirname(pdf_fields_path))
+        try:
+            os.chmod(tmp_path, 0o644)
+            with open(fd, "w") as outfile:
+                outfile.write(new_pos_str)
+            os.replace(tmp_path, pdf_fields_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        registry.invalidate(dir_name)
+
+    @staticmethod
+    def field_extras(old_fields, index, name):
+        """Необязательные параметры поля name из старого списка полей страницы
+
+        Ищем поле на той же позиции, иначе - первое поле с тем же именем
+        """
+        if index < len(old_fields) and old_fields[index][2] == name:
+            old = old_fields[index]
+        else:
+            old = next((f for f in old_fields if f[2] == name), [])
+        return dict(zip(FieldParams._fields[6:], old[6:]))
+
+    @staticmethod
+    def field_to_list(field):
+        """Параметры поля списком для fields.json, без незаданных необязательных"""
+        field = list(field)
+        while len(field) > 6 and field[-1] is None:
+            field.pop()
+        return field
 
     @staticmethod
     def convert_coord_to_front(field: "FieldParams") -> "FieldParams":
@@ -95,11 +229,9 @@ class TPdf:
         """
         scale = corr["pt_to_px"]
         font_size = int(field.font_size * scale + 0.5)
-        return FieldParams(
+        return field._replace(
             x=field.x * scale + corr["x"],
             y=(page_height - field.y - field.font_size) * scale + corr["y"],
-            name=field.name,
-            font_name=field.font_name,
             font_size=font_size,
             width=field.width * scale,
         )
@@ -109,121 +241,355 @@ class TPdf:
         """Конвертирует координаты с фронта в координаты pdf"""
         scale = corr["px_to_pt"]
         font_size = int(field.font_size * scale + 0.5)
-        return FieldParams(
+        return field._replace(
             x=round((field.x - corr["x"]) * scale, 2),
             y=round(page_height - (field.y - corr["y"]) * scale - font_size, 2),
-            name=field.name,
-            font_name=field.font_name,
             font_size=font_size,
             width=round(field.width * scale),
         )
 
     def add_document(self, dir_name, data, fill_x=False):
-        # подгружаем из файла параметры полей (координаты, размер шрифта и др.)
-        pdf_fields = self.load_fields_from_file(dir_name)
-        data = self.format_for_pdf(data)
+        # добавляем полученные страницы в свойство для отложенной сборки
+        self.documents.setdefault(dir_name, []).extend(
+            self.render_document(dir_name, data, fill_x))
 
-        # регистрируем все шрифты, имеющиеся в папке со шрифтами
-        for filename in glob(os.path.join(self.FONTS, "*.ttf")):
-            pdfmetrics.registerFont(TTFont(os.path.basename(filename)[:-4], filename))
-        last_font = ["DejaVuSans", 10]
+    def render_document(self, dir_name, data, fill_x=False):
+        """Заполняет шаблон dir_name данными data, возвращает список страниц"""
+        return self.merge_overlays(
+            dir_name, self.render_overlays(dir_name, data, fill_x), fonts=self.font_subsets)
 
-        pdf_form_path = os.path.join(FILES, dir_name, "form.pdf")
-        D_IMAGES = os.path.join(FILES, dir_name, "images")
-        pdf_form = PdfFileReader(open(pdf_form_path, "rb"))
-        self.documents.setdefault(dir_name, [])
+    def render_page(self, dir_name, page_number, data=None, fill_x=False):
+        """Одна страница документа (номер с 0): рисуется только её наложение
+
+        :return: страница pdfrw
+        """
+        overlays = self.render_overlays(dir_name, data or {}, fill_x,
+                                        pages=[str(page_number)])
+        return self.merge_overlays(dir_name, overlays, fonts=self.font_subsets)[page_number]
+
+    def render_documents(self, dir_name, rows, fill_x=False):
+        """Заполняет шаблон dir_name строками rows, пачками по BATCH_ROWS
+
+        :return: генератор списков страниц, по одному на строку
+        """
+        rows = iter(rows)
+        while True:
+            batch = list(islice(rows, BATCH_ROWS))
+            if not batch:
+                return
+            for overlays in self.render_overlays_batch(dir_name, batch, fill_x):
+                yield self.merge_overlays(dir_name, overlays, fonts=self.font_subsets)
+
+    def render_overlays(self, dir_name, data, fill_x=False, pages=None):
+        """Рисует значения полей документа на прозрачных страницах-наложениях
+
+        Это основная вычислительная работа (reportlab), не зависящая от pdfrw
+        объектов формы, поэтому её можно выполнять в других процессах.
+        :param pages: номера страниц (строки, с 0), которые нужно нарисовать,
+            по умолчанию - все
+        :return: словарь {номер страницы: pdf наложения в байтах}
+        """
+        return self.render_overlays_batch(dir_name, [data], fill_x, pages)[0]
+
+    def render_overlays_batch(self, dir_name, rows, fill_x=False, pages=None):
+        """render_overlays для пачки строк данных
+
+        План подстановки значений берётся один на шаблон и набор столбцов,
+        значения форматируются по столбцам сразу для всей пачки.
+        :return: список результатов render_overlays, по одному на строку
+        """
+        # берём из реестра скомпилированный шаблон: страницы формы, параметры
+        # полей (координаты, размер шрифта и др.), шрифты уже зарегистрированы
+        template = registry.get(dir_name)
+        plan = plans.get(template, set().union(*rows), fill_x,
+                         registry.font_stamps(template.fonts) if fill_x else ())
+        return [self.draw_overlays(dir_name, plan, values, pages, self.font_subsets)
+                for values in plan.resolve(rows)]
+
+    def assign_codes(self, dir_name, rows, fill_x=False):
+        """Назначает символам строк rows коды общего состояния шрифтов, не
+        рисуя наложений: поля перебираются и переносятся так же и в том же
+        порядке, что и в render_overlays_batch, поэтому коды - те же. Наложения
+        этих строк, нарисованные потом с этим состоянием (например в других
+        процессах), новых кодов не добавляют"""
+        template = registry.get(dir_name)
+        plan = plans.get(template, set().union(*rows), fill_x,
+                         registry.font_stamps(template.fonts) if fill_x else ())
+        fonts = self.font_subsets
+        shared = [name for name in plan.fonts if is_shared(pdfmetrics.getFont(name))]
+        text_fonts = len(shared) == len(plan.fonts)
+        for values in plan.resolve(rows):
+            for page_num in sorted(plan.pages, key=int):
+                page_fields = plan.pages[page_num]
+                if not text_fonts or any(
+                        isinstance(values[slot], ImageValue) for field, slot in page_fields):
+                    # страница рисуется через canvas: состояния всех шрифтов
+                    # заводятся сразу (FontSubsets.install)
+                    for name in shared:
+                        fonts.state(name)
+                for field, slot in page_fields:
+                    text = values[slot]
+                    if isinstance(text, ImageValue) or field.font_name not in shared:
+                        continue
+                    for line in TPdf.layout_field(dir_name, field, text)[1]:
+                        if line:
+                            fonts.split(field.font_name, line)
+
+    @staticmethod
+    def draw_overlays(dir_name, plan, values, pages=None, fonts=None):
+        """Рисует наложения одной строки данных
+
+        Страницы только с текстом при общих шрифтах пишутся сразу потоком
+        содержимого (textlayer.TextLayer), reportlab canvas нужен только
+        страницам с картинками.
+        :param plan: план подстановки (binding.BindingPlan)
+        :param values: значения ячеек плана для этой строки
+        :param fonts: общие подмножества шрифтов (fonts.FontSubsets), если
+            не заданы - шрифты встраиваются в каждое наложение
+        :return: словарь {номер страницы: pdf наложения в байтах или
+            textlayer.TextOverlay}
+        """
+        text_fonts = fonts is not None and all(
+            is_shared(pdfmetrics.getFont(name)) for name in plan.fonts)
+        overlays = {}
         # накладываем значения полей на страницы формы
-        for page_number in range(len(pdf_form.pages)):
-            page = pdf_form.getPage(page_number)
-            page_num = str(page_number)
-            # если на данной странице нужно впечатать какие-то поля
-            if page_num in pdf_fields and pdf_fields[page_num]:
-                # создаём объект бинарного файла в памяти
-                packet = io.BytesIO()
-                # create a new PDF with Reportlab
-                # bottomup=0 - отсчёт Y делаем сверху вниз, как на фронте
-                can = canvas.Canvas(packet, pagesize=page_size)
-                can.setFont(*last_font)  # в момент создания страницы нужно
-                # перебираем поля и заполняем их в pdf canvas
-                for field in pdf_fields[page_num]:
-                    # если шрифт изменился, то устанавливаем новое значение
-                    new_font = [field.font_name, field.font_size]
-                    if last_font != new_font:
-                        last_font = new_font
-                        can.setFont(*last_font)
-                    if fill_x:
-                        # заполняем именем поля, если требуется для настройки
-                        val = field.name
-                        while can.stringWidth(val) > field.width and len(val):
-                            val = val[:-1]
-                    elif field.name in data:
-                        # если значение поля имеются, то берём его
-                        val = str(data[field.name])
-                        # если это картинка, то рисуем её
-                        ext = val.split(".")[-1]
-                        if ext in ["jpg", "JPG", "png", 'PNG']:
-                            img = ImageReader(os.path.join(D_IMAGES, val))
-                            can.drawImage(img, field.x, field.y,
-                                          width=field.width, mask="auto",
-                                          preserveAspectRatio=True,
-                                          anchor="se")
-                            val = None
-                    else:
-                        # в крайнем случае, пытаемся вычислить поле из property
-                        val = getattr(self, field.name, "")
-                    text = val if val else ""
-                    # выводим данные (текст) в нужную позицию
-                    y_margin = 0
-                    for txt in self.text_wrap(text, field.width, can):
-                        # есть не вместившийся текст, печатаем его на след строке
-                        can.drawString(field.x, field.y - y_margin, txt)
-                        y_margin += field.font_size * 1.2
-                # сохраняем canvas и мерджим его на страницу шаблона (формы)
-                can.save()
-                packet.seek(0)
-                PageMerge(page).add(PdfFileReader(packet).getPage(0)).render()
-            # добавляем полученную страницу в свойство для отложенной сборки
-            self.documents[dir_name].append(page)
+        for page_num in sorted(plan.pages, key=int):
+            page_fields = plan.pages[page_num]
+            # на странице без полей впечатывать нечего
+            if not page_fields or pages is not None and page_num not in pages:
+                continue
+            if text_fonts and not any(
+                    isinstance(values[slot], ImageValue) for field, slot in page_fields):
+                with stage("text_layer", dir_name):
+                    overlays[page_num] = TPdf.draw_text_page(dir_name, page_fields, values, fonts)
+            else:
+                # рисование страницы, в том числе перенос текста и картинки
+                with stage("canvas_draw", dir_name):
+                    overlays[page_num] = TPdf.draw_canvas_page(
+                        dir_name, page_fields, values, plan.fonts, fonts)
+        return overlays
+
+    @staticmethod
+    def layout_field(dir_name, field, text):
+        """Размер шрифта и строки текста поля после переноса и вписывания"""
+        with stage("text_wrap", dir_name):
+            if field.max_lines or field.min_font_size:
+                # вписываем текст в поле: меньше шрифт, меньше строк
+                return fit_text(text, field.width, field.font_name, field.font_size,
+                                field.max_lines, field.min_font_size)
+            return field.font_size, list(
+                wrap_text(text, field.width, field.font_name, field.font_size))
+
+    @staticmethod
+    def draw_text_page(dir_name, page_fields, values, fonts):
+        """Наложение страницы без картинок: textlayer.TextOverlay"""
+        layer = TextLayer(fonts)
+        for field, slot in page_fields:
+            font_size, lines = TPdf.layout_field(dir_name, field, values[slot])
+            y_margin = 0
+            for txt in lines:
+                # есть не вместившийся текст, печатаем его на след строке
+                layer.draw_string(field.x, field.y - y_margin, txt, field.font_name, font_size)
+                y_margin += font_size * 1.2
+        return layer.overlay()
 
     @staticmethod
-    def get_res(pdf_writer, b64="True"):
+    def draw_canvas_page(dir_name, page_fields, values, font_names, fonts=None):
+        """Наложение страницы через reportlab canvas: pdf в байтах"""
+        last_font = ["DejaVuSans", 10]
+        D_IMAGES = os.path.join(FILES, dir_name, "images")
+        # создаём объект бинарного файла в памяти
+        packet = io.BytesIO()
+        # create a new PDF with Reportlab
+        # bottomup=0 - отсчёт Y делаем сверху вниз, как на фронте
+        # без сжатия: потоки сжимаются при записи, если это включено
+        # в параметрах вывода (output.OutputOptions)
+        can = canvas.Canvas(packet, pagesize=page_size, invariant=True,
+                            pageCompression=0)
+        if fonts is not None:
+            fonts.install(can, font_names)
+        can.setFont(*last_font)  # в момент создания страницы нужно
+        # перебираем поля и заполняем их в pdf canvas
+        for field, slot in page_fields:
+            # если шрифт изменился, то устанавливаем новое значение
+            new_font = [field.font_name, field.font_size]
+            if last_font != new_font:
+                last_font = new_font
+                can.setFont(*last_font)
+            text = values[slot]
+            if isinstance(text, ImageValue):
+                # если это картинка, то рисуем её
+                draw_image(can, os.path.join(D_IMAGES, text.name),
+                           field.x, field.y, field.width)
+                text = ""
+            font_size, lines = TPdf.layout_field(dir_name, field, text)
+            if font_size != field.font_size:
+                last_font = [field.font_name, font_size]
+                can.setFont(*last_font)
+            # выводим данные (текст) в нужную позицию
+            y_margin = 0
+            for txt in lines:
+                # есть не вместившийся текст, печатаем его на след строке
+                can.drawString(field.x, field.y - y_margin, txt)
+                y_margin += font_size * 1.2
+        # сохраняем canvas, мерджить его будем на страницу формы
+        if fonts is not None:
+            fonts.stub(can)
+        can.save()
+        return packet.getvalue()
+
+    @staticmethod
+    def merge_overlays(dir_name, overlays, images=None, fonts=None):
+        """Накладывает страницы-наложения на страницы формы
+
+        :param overlays: результат render_overlays
+        :param images: словарь для замены одинаковых картинок наложений одной;
+            для записи через output.PdfOutput не нужен - одинаковые картинки
+            пишет один раз PdfStreamWriter, а словарь держал бы в памяти все
+            картинки до конца работы
+        :param fonts: общие подмножества шрифтов, которыми рисовались
+            наложения (заглушки шрифтов заменяются ими), для наложений
+            textlayer.TextOverlay обязательны
+        :return: список страниц документа
+        """
+        template = registry.get(dir_name)
+        pages = []
+        for page_number, form_page in enumerate(template.pages):
+            overlay = overlays.get(str(page_number))
+            if overlay is None:
+                # страницу без полей не меняем, поэтому можно отдать общую
+                pages.append(form_page)
+                continue
+            with stage("page_merge", dir_name):
+                if isinstance(overlay, TextOverlay):
+                    overlay_page = text_overlay_page(overlay, fonts, page_size)
+                else:
+                    overlay_page = PdfFileReader(io.BytesIO(overlay)).getPage(0)
+                    if images is not None:
+                        dedup_images(overlay_page.Resources.XObject, images)
+                    if fonts is not None:
+                        fonts.replace(overlay_page.Resources.Font)
+                form = template.forms[page_number]
+                if form is not None:
+                    # форма одна на все копии, к ней добавляется только наложение
+                    page = overlay_form_page(form_page, form, overlay_page)
+                else:
+                    # страница шаблона общая для всех запросов, работаем с копией
+                    page = copy_page(form_page)
+                    PageMerge(page).add(overlay_page).render()
+            pages.append(page)
+        return pages
+
+    @staticmethod
+    def get_res(pages, b64="True", options=None):
         """ Вывод результата используется в двух местах, поэтому вынес этот
-        кусок кода в отдельную функцию """
+        кусок кода в отдельную функцию
+        :param pages: страницы pdf
+        :param options: параметры вывода (output.OutputOptions)
+        """
 
         # результирующий pdf сохраняем также в бинайрный файл в памяти
         output_file = io.BytesIO()
-        pdf_writer.write(output_file)
+        with stage("pdf_write"), PdfOutput(output_file, options) as pdf_writer:
+            # страницы уже в памяти, общие объекты (формы, копии документов)
+            # пишутся один раз
+            pdf_writer.share(*pages)
+            for page in pages:
+                pdf_writer.add_page(page)
         output_file.seek(0)
 
         # преобразуем готовый pdf файл в base64, если необходимо
         if b64 == "True":
-            res = base64.b64encode(output_file.read()).decode("utf-8")
+            with stage("base64"):
+                res = base64.b64encode(output_file.read()).decode("utf-8")
         else:
             res = output_file.read()
         return res
 
-    def get_pdf(self, name, b64="True", fill_x=False):
-        return self.get_complete([(name, 1), ], {}, b64, fill_x)
+    def get_pdf(self, name, b64="True", fill_x=False, options=None):
+        return self.get_complete([(name, 1), ], {}, b64, fill_x, options)
 
-    def get_pdf_with_data(self, dir_name, b64="True", fill_x=False):
-        pdf_fields_path = os.path.join(FILES, dir_name, "fields.json")
-        pdf_fields = json.load(open(pdf_fields_path, "r"))
-        pdf_writer = PdfFileWriter()
-        wb_obj = openpyxl.load_workbook(os.path.join(FILES, dir_name, "data.xlsx"))
-        sheet_obj = wb_obj.active
-        field_name_by_index = [sheet_obj.cell(row=2, column=i).value for i in range(1, sheet_obj.max_column + 1)]
-        for i in range(3, sheet_obj.max_row + 1):
-            data = {
-                field_name_by_index[j-1]: sheet_obj.cell(row=i, column=j).value for j in range(1, sheet_obj.max_column + 1)
-            }
-            self.add_document(dir_name, data, fill_x)
-        # перебираем страницы документа и добавляем их в итоговый pdf
-        for page in self.documents[dir_name]:
-            pdf_writer.addPage(page)
-        self.documents = []
-        return self.get_res(pdf_writer, b64)
-
-    def get_complete(self, complete, data, b64="True", fill_x=False):
+    def write_pdf(self, name, output, fill_x=False, options=None):
+        """Потоковый вариант get_pdf: pdf пишется в output по частям"""
+        return self.write_complete([(name, 1), ], {}, output, fill_x, options)
+
+    def get_pdf_with_data(self, dir_name, b64="True", fill_x=False, rows=None, options=None):
+        """
+        :param rows: строки данных (словари), по умолчанию - из файла данных
+            шаблона (см. iter_data_rows)
+        :param options: параметры вывода (output.OutputOptions): сжатие,
+            потоки объектов, линеаризация; по умолчанию - output.CONFIG
+        """
+        if rows is None:
+            rows = self.iter_data_rows(dir_name)
+        for pages in self.render_documents(dir_name, rows, fill_x):
+            self.documents.setdefault(dir_name, []).extend(pages)
+        return self.get_res(self.documents.pop(dir_name, []), b64, options)
+
+    def write_pdf_with_data(self, dir_name, output, fill_x=False, progress=None, rows=None,
+                            options=None, render=None):
+        """Потоковое впечатывание строк данных с постоянным расходом памяти
+
+        Строки читаются по одной, готовые страницы сразу пишутся в output, в
+        памяти не копятся ни строки, ни страницы. Общие объекты формы пишутся
+        в output один раз.
+        :param dir_name: имя документа
+        :param output: объект с методом write(bytes) - файл, сокет и т.п.
+        :param fill_x: bool заполнять значения полей их именами
+        :param progress: callback(rows, rows_per_sec), вызывается по ходу работы
+        :param rows: итератор строк данных (словарей), по умолчанию - файл
+            данных шаблона (см. iter_data_rows)
+        :param options: параметры вывода (output.OutputOptions), как у
+            get_pdf_with_data
+        :param render: функция (complete, rows, fill_x) -> пары (строка,
+            страницы), например batch.iter_records с пулом процессов, по
+            умолчанию страницы рисуются в этом потоке
+        :return: статистика: строки, страницы, время, строк в секунду, размер
+            pdf и параметры вывода
+        """
+        if rows is None:
+            rows = self.iter_data_rows(dir_name)
+        if render is None:
+            documents = self.render_documents(dir_name, rows, fill_x)
+        else:
+            documents = (pages for row, pages in render([(dir_name, 1)], rows, fill_x))
+        pdf_output = PdfOutput(output, options)
+        counter = Progress(progress)
+        pages = 0
+        with pdf_output as pdf_writer:
+            pdf_writer.share(*registry.get(dir_name).shared)
+            for document in documents:
+                for page in document:
+                    pdf_writer.add_page(page)
+                    pages += 1
+                counter.step()
+        counter.report()
+        return dict(counter.stats(), pages=pages, **pdf_output.stats())
+
+    @staticmethod
+    def iter_data_rows(dir_name) -> Generator[dict, None, None]:
+        """Построчно читает файл данных шаблона: data.xlsx, data.csv,
+        data.jsonl, data.parquet или data.arrow (см. sources.py)"""
+        path = find_data_file(os.path.join(FILES, dir_name))
+        if path is None:
+            raise FileNotFoundError("У шаблона {} нет файла данных".format(dir_name))
+        return iter_rows(path)
+
+    @staticmethod
+    def iter_xlsx_rows(dir_name) -> Generator[dict, None, None]:
+        """Построчно читает data.xlsx шаблона, не загружая его целиком
+
+        Первая строка файла - номера страниц, вторая - имена полей, далее данные
+        :return: словари {имя поля: значение} по одному на строку данных
+        """
+        return TPdf.iter_xlsx_file(os.path.join(FILES, dir_name, "data.xlsx"))
+
+    @staticmethod
+    def iter_xlsx_file(path) -> Generator[dict, None, None]:
+        """Построчно читает xlsx файл path в формате data.xlsx"""
+        return iter_xlsx(path)
+
+    def get_complete(self, complete, data, b64="True", fill_x=False, options=None):
         """ Собираем несколько pdf файлов в один комплект документов
         :param complete: list of tuples список кортежей, каждый из кортежей
             содержит на первой позиции имя документа, на второй позиции
@@ -232,11 +598,14 @@ class TPdf:
             которой нужно напечатать документы
         :param data: словарь с данными
         :param fill_x: bool заполнять значения полей их именами
-        :param b64: in ["True", "False", "Stream", ] - тип возвращаемых данных
+        :param b64: in ["True", "False", ] - тип возвращаемых данных
             "True" - формат данных base64
             "False" - бинарные данные файла pdf
+            (потоковая выдача по частям - write_complete)
+        :param options: параметры вывода (output.OutputOptions): сжатие,
+            потоки объектов, линеаризация; по умолчанию - output.CONFIG
         """
-        pdf_writer = PdfFileWriter()
+        pages = []
         # перебираем документы из комплекта по именам
         for doc in complete:
             name = doc[0]  # имя документа
@@ -246,10 +615,30 @@ class TPdf:
                 self.add_document(name, data, fill_x)
             # добавляем нужное количество копий документа с именем name
             for i in range(count):
-                # перебираем страницы документа и добавляем их в итоговый pdf
-                for page in self.documents[name]:
-                    pdf_writer.addPage(page)
-        return self.get_res(pdf_writer, b64)
+                # добавляем страницы документа в итоговый pdf
+                pages.extend(self.documents[name])
+        return self.get_res(pages, b64, options)
+
+    def write_complete(self, complete, data, output, fill_x=False, options=None):
+        """Потоковый вариант get_complete: страницы пишутся в output сразу
+
+        Параметры как у get_complete, output - объект с методом write(bytes).
+        Страницы документа, печатаемого в нескольких копиях, пишутся один раз,
+        копии ссылаются на них.
+        :return: количество страниц
+        """
+        pages = 0
+        with PdfOutput(output, options) as pdf_writer:
+            for name, count in complete:
+                # если документ ещё не сформирован, то формируем его
+                if name not in self.documents:
+                    self.add_document(name, data, fill_x)
+                    pdf_writer.share(*registry.get(name).shared, *self.documents[name])
+                for i in range(count):
+                    for page in self.documents[name]:
+                        pdf_writer.add_page(page)
+                        pages += 1
+        return pages
 
     @staticmethod
     def text_wrap(text: str, width: int, canvas: "canvas.Canvas") -> \
@@ -262,88 +651,225 @@ class TPdf:
             canvas: canvas
 
         Возвращает подстроки максимальной длины, не превышающей заданную ширину
-            width, разбиение на подстроки по пробелам
+            width, разбиение на подстроки по пробелам. Ширины символов текущего
+            шрифта canvas берутся из общего кэша (см. glyphs.wrap_text)
         """
-        last_space = 0
-        text_start = 0
-        word_len = 0
-        cur_text_len = 0
-        for i in range(len(text)):
-            # длина очередного символа нужна заранее
-            symbol_len = canvas.stringWidth(text[i])
-            # запоминаем позицию пробела или вычисляем длину очередного слова
-            if text[i] == " ":
-                last_space = i
-                word_len = 0
-            else:
-                word_len += symbol_len
-
-            # если длина части текста превысила допустимое значение, то возвращаем текст
-            cur_text_len += symbol_len
-            if cur_text_len > width:
-                cur_text_len = word_len
-                # если слово поместилось, то перенос по пробелу
-                if text_start < last_space:
-                    yield text[text_start:last_space]
-                    text_start = last_space + 1
-                # иначе переносим по буквам
-                else:
-                    yield text[text_start:i]
-                    text_start = i
-                    word_len = symbol_len
-                    cur_text_len = symbol_len
-
-        # возвращаем оставшийся кусочек текста
-        yield text[text_start:]
+        return wrap_text(text, width, canvas._fontname, canvas._fontsize)
 
     @staticmethod
     def format_for_pdf(data):
-        """ Форматируем данные для впечатывания полей в pdf
-        1. None заменяем на пустые строки
-        2. Дату из вида "ГГГГ-ММ-ДД" преобразует в "ДД.ММ.ГГГГ"
-        :param data: словарь значения которого надо отформатировать
+        """Форматирует строку данных, как раньше перед впечатыванием: None -
+        пустая строка, поля со словом date - "ГГГГ-ММ-ДД" в "ДД.ММ.ГГГГ".
+        Сейчас значения форматирует план привязки полей (binding.BindingPlan)
+        по столбцам, функция оставлена для совместимости
+
+        :param data: словарь, значения которого надо отформатировать
         :return: изменённый словарь
         """
-        for key in data.keys():
-            # 1. Заменяем None на пустые строки
-            if data[key] is None:
+        for key, value in data.items():
+            if value is None:
                 data[key] = ""
-            # 2. Форматируем дату и время
-            if key.find("date") > -1:
-                try:
-                    data[key] = dt.strftime(
-                        dt.strptime(data[key], "%Y-%m-%d"),
-                        "%d.%m.%Y"
-                    )
-                except:
-                    pass  # если формат даты другой, то не надо паниковать.
-
+            elif "date" in key:
+                data[key] = format_date([value])[0]
         return data
 
-    @cached_property
-    def fio(self):
-        return " ".join([
-            self.fields.get("last_name", ""),
-            self.fields.get("first_name", ""),
-            self.fields.get("middle_name", ""),
-        ])
-
-    @cached_property
-    def fio_short(self):
-        return "{} {}.{}.".format(
-            self.fields.get("last_name", ""),
-            self.fields.get("first_name", "")[:1],
-            self.fields.get("middle_name", "")[:1],
-        )
 
-    @cached_property
-    def now(self):
-        return dt.now().strftime("%d.%m.%Y")
+# вычисляемые поля: значение для поля, которого нет в данных (см.
+# binding.computed_field)
+@computed_field("fio")
+def fio(row):
+    return " ".join([
+        row.get("last_name") or "",
+        row.get("first_name") or "",
+        row.get("middle_name") or "",
+    ])
 
-    @property
-    def x(self):
-        return "X"
 
-    @property
-    def doc_type(self):
-        return "Паспорт РФ"
+@computed_field("fio_short")
+def fio_short(row):
+    return "{} {}.{}.".format(
+        row.get("last_name") or "",
+        (row.get("first_name") or "")[:1],
+        (row.get("middle_name") or "")[:1],
+    )
+
+
+@computed_field("now", constant=True)
+def now(row):
+    return dt.now().strftime("%d.%m.%Y")
+
+
+@computed_field("x", constant=True)
+def mark_x(row):
+    return "X"
+
+
+@computed_field("doc_type", constant=True)
+def doc_type(row):
+    return "Паспорт РФ"
+
+
+def file_stamp(*paths):
+    """Отпечаток файлов (время изменения и размер) для инвалидации кэшей
+
+    Для отсутствующего файла в отпечаток попадает None
+    """
+    stamp = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            stamp.append(None)
+        else:
+            stamp.append((st.st_mtime_ns, st.st_size))
+    return tuple(stamp)
+
+
+def copy_page(page):
+    """Копия страницы шаблона, которую можно менять через PageMerge
+
+    PageMerge.render меняет саму страницу и словарь её ресурсов (добавляет
+    XObject), поэтому копируем только их, а содержимое страницы (потоки,
+    шрифты, картинки формы) остаётся общим и попадает в итоговый pdf один раз
+    """
+    inheritable = page.inheritable
+    resources = PdfDict(inheritable.Resources or PdfDict())
+    if resources.XObject is not None:
+        resources.XObject = PdfDict(resources.XObject)
+    return PdfDict(
+        page,
+        Resources=resources,
+        MediaBox=inheritable.MediaBox,
+        CropBox=inheritable.CropBox,
+        Rotate=inheritable.Rotate,
+    )
+
+
+def page_form(page):
+    """Form XObject со всем содержимым страницы формы или None
+
+    Повёрнутые страницы и страницы с неподдерживаемым сжатием содержимого
+    так не представить, для них поля накладываются на копию страницы
+    """
+    if page.inheritable.Rotate and int(page.inheritable.Rotate) % 360:
+        return None
+    try:
+        form = pagexobj(page)
+    except PdfNotImplementedError:
+        return None
+    # несколько потоков содержимого pdfrw склеивает распакованными
+    compress([form])
+    return form
+
+
+def overlay_form_page(form_page, form, overlay_page):
+    """Новая страница из общей формы form (Form XObject) и наложения полей
+
+    Содержимое и ресурсы формы не копируются, на них ссылаются все страницы,
+    сама страница - это только ссылки и короткий поток "нарисуй форму, затем
+    поля"
+    """
+    inheritable = form_page.inheritable
+    page = PdfDict(
+        Type=PdfName.Page,
+        MediaBox=inheritable.MediaBox,
+        CropBox=inheritable.CropBox,
+        Annots=form_page.Annots,
+        Resources=PdfDict(XObject=PdfDict(
+            Form=form,
+            Fields=pagexobj(overlay_page),
+        )),
+        Contents=PdfDict(stream="q /Form Do Q\nq /Fields Do Q\n"),
+    )
+    page.indirect = True
+    return page
+
+
+class TemplateRegistry:
+    """Процессный реестр скомпилированных шаблонов из tpdf_templates
+
+    Каждый шаблон (form.pdf + fields.json) разбирается один раз и
+    переиспользуется всеми запросами, пока не изменятся его файлы. Шрифты
+    из папки со шрифтами регистрируются в reportlab один раз, повторно -
+    только новые или изменённые.
+    """
+
+    def __init__(self, root=FILES, fonts=FONTS):
+        self.root = root
+        self.fonts_dir = fonts
+        self._templates = {}
+        self._fonts = {}  # имя шрифта -> отпечаток файла шрифта
+        self._lock = threading.RLock()
+
+    def register_fonts(self):
+        """Регистрирует новые и изменённые шрифты, возвращает имена всех"""
+        with self._lock:
+            for filename in glob(os.path.join(self.fonts_dir, "*.ttf")):
+                name = os.path.basename(filename)[:-4]
+                stamp = file_stamp(filename)
+                if self._fonts.get(name) != stamp:
+                    with stage("font_register"):
+                        pdfmetrics.registerFont(TTFont(name, filename))
+                    reset_glyph_widths(name)
+                    self._fonts[name] = stamp
+            return tuple(sorted(self._fonts))
+
+    def get(self, dir_name) -> "Template":
+        """Скомпилированный шаблон, при изменении файлов - перечитанный"""
+        stamp = file_stamp(
+            os.path.join(self.root, dir_name, "form.pdf"),
+            os.path.join(self.root, dir_name, "fields.json"),
+        )
+        with self._lock:
+            template = self._templates.get(dir_name)
+            if template is None or template.stamp != stamp:
+                template = self._compile(dir_name, stamp)
+                self._templates[dir_name] = template
+        return template
+
+    def font_stamps(self, names):
+        """Отпечатки файлов зарегистрированных шрифтов names"""
+        with self._lock:
+            return tuple(self._fonts.get(name) for name in names)
+
+    def invalidate(self, dir_name=None):
+        """Сбрасывает шаблон dir_name или весь реестр"""
+        with self._lock:
+            if dir_name is None:
+                self._templates.clear()
+            else:
+                self._templates.pop(dir_name, None)
+
+    def _compile(self, dir_name, stamp):
+        # новые шрифты, которые могут понадобиться шаблону; дальше изменения
+        # папки шрифтов подхватывает каталог шаблонов (catalog.py)
+        self.register_fonts()
+        with stage("template_load", dir_name):
+            return self._load(dir_name, stamp)
+
+    def _load(self, dir_name, stamp):
+        with open(os.path.join(self.root, dir_name, "form.pdf"), "rb") as f:
+            form_data = f.read()
+        with open(os.path.join(self.root, dir_name, "fields.json"), "rb") as f:
+            fields_data = f.read()
+        pdf_form = PdfFileReader(fdata=form_data)
+        # читаем все объекты сразу, чтобы не держать ленивую подгрузку
+        pdf_form.read_all()
+        fields = {
+            page: tuple(FieldParams(*field) for field in page_fields)
+            for page, page_fields in json.loads(fields_data.decode("utf-8")).items()
+        }
+        fonts = {"DejaVuSans"}
+        fonts.update(f.font_name for page_fields in fields.values() for f in page_fields)
+        return Template(
+            dir_name=dir_name,
+            pages=tuple(pdf_form.pages),
+            forms=tuple(page_form(page) for page in pdf_form.pages),
+            fields=fields,
+            fonts=tuple(sorted(fonts)),
+            stamp=stamp,
+            digest=hashlib.sha256(form_data + b"\0" + fields_data).hexdigest(),
+        )
+
+
+registry = TemplateRegistry()
@@ -1,84 +1,454 @@
+import asyncio
+import base64
+import json
 import os
-from collections import defaultdict
-from glob import glob
+import tempfile
+import uuid
+from functools import partial
 from urllib.parse import quote
 
 import aiohttp_jinja2
-import openpyxl
 from aiohttp import web
 
-from app.tpdf import FILES, TPdf
+from app.archive import check_name_template, write_zip
+from app.batch import iter_records
+from app.cache import result_key, write_cached
+from app.jobs import DONE, FAILED, job_status
+from app.output import OutputUnavailable, check_linearize, parse_options
+from app.preview import PreviewUnavailable, preview_cache
+from app.sources import UnsupportedSource, find_data_file, iter_rows, upload_format
+from app.streaming import stream_pdf
+from app.tpdf import FILES, TPdf, registry
 
 
 class ResponseFile(web.Response):
-    def __new__(cls, file_name, file_body):
+    def __new__(cls, file_name, file_body, etag=None, request=None, b64=False):
+        """
+        :param etag: ETag файла (в кавычках), если у клиента файл с тем же
+            ETag (заголовок If-None-Match запроса request), отвечаем 304
+        :param b64: file_body - base64 текст, а не pdf
+        """
+        if etag is not None and cls.not_modified(request, etag):
+            return web.Response(status=304, headers={"ETag": etag})
         headers = {
-            "Content-Type": "application/pdf; charset='utf-8'",
+            "Content-Type": "text/plain; charset=utf-8" if b64 else "application/pdf; charset='utf-8'",
             "Content-Disposition": "inline; filename*=UTF-8''{}".format(
                 quote(file_name, encoding="utf-8"))
         }
+        if etag is not None:
+            headers["ETag"] = etag
         return web.Response(body=file_body, headers=headers)
 
+    @staticmethod
+    def not_modified(request, etag):
+        """Есть ли у клиента актуальная версия файла с ETag etag"""
+        if request is None:
+            return False
+        if_none_match = request.headers.get("If-None-Match", "")
+        return if_none_match.strip() == "*" or etag in (
+            tag.strip() for tag in if_none_match.split(","))
+
+
+def front_fields(dir_name):
+    """Поля шаблона из реестра в координатах веб-интерфейса"""
+    template = registry.get(dir_name)
+    return {
+        page: [TPdf.convert_coord_to_front(field) for field in page_fields]
+        for page, page_fields in template.fields.items()
+    }
+
+
+def save_fields(catalog, new_pos):
+    """Сохраняет настройки полей и сразу обновляет шаблон в каталоге"""
+    dir_name = new_pos["dir_name"]
+    res = TPdf.save_fields_to_file(new_pos)
+    catalog.refresh(dir_name)
+    return res
+
+
+def write_pdf_with_data(dir_name, output, path=None, options=None, render=None):
+    rows = iter_rows(path) if path is not None else None
+    return TPdf().write_pdf_with_data(dir_name, output, rows=rows, options=options,
+                                      render=render)
+
+
+def write_zip_with_data(complete, output, path=None, rows=None, **kwargs):
+    """zip архив по строкам: из rows, загруженного файла path или файла
+    данных единственного шаблона комплекта"""
+    if rows is None:
+        rows = iter_rows(path) if path is not None else TPdf.iter_data_rows(complete[0][0])
+    return write_zip(complete, rows, output, **kwargs)
+
+
+def write_complete(complete, data, output, fill_x=False, options=None):
+    return TPdf().write_complete(complete, data, output, fill_x=fill_x, options=options)
+
+
+def cache_lookup(cache, complete, data, fill_x=False, options=None):
+    """Ключ комплекта в кэше результатов и готовый pdf, если он есть"""
+    key = result_key(complete, data, fill_x, options)
+    return key, cache.get(key)
+
+
+def batch_render(request):
+    """Рисование записей массового впечатывания (параметр render у
+    TPdf.write_pdf_with_data и archive.write_zip): при TPDF_BATCH_KIND=process
+    наложения рисуют процессы пула batch, иначе - None, всё в потоке пула"""
+    executor = request.app["executors"]["batch"]
+    if executor.kind != "process":
+        return None
+    return partial(iter_records, executor.pool, window=executor.workers * 2)
+
+
+async def run(request, fn, *args, executor="render", **kwargs):
+    """Выполняет синхронную функцию fn в пуле executor, а не в event loop"""
+    return await request.app["executors"][executor].run(fn, *args, **kwargs)
+
 
 @aiohttp_jinja2.template("index.html")
 async def index(request):
-    data = {}
-    for f in os.listdir(FILES):
-        sub_dir = os.path.join(FILES, f)
-        if os.path.isfile(sub_dir):
-            continue
-        xlsx_path = os.path.join(sub_dir, "data.xlsx")
-        data[f] = {
-            "has_data_xlsx": os.path.isfile(xlsx_path),
-        }
-        # если нет файла настроек полей и есть файл с данными, то формируем файл настроек
-        if not os.path.isfile(os.path.join(sub_dir, "fields.json")) and data[f]["has_data_xlsx"]:
-            new_pos = defaultdict(list)
-            wb_obj = openpyxl.load_workbook(xlsx_path)
-            sheet_obj = wb_obj.active
-            y_by_page_num = dict()
-            for i in range(1, sheet_obj.max_column + 1):
-                page_num = str(int(sheet_obj.cell(row=1, column=i).value) - 1)
-                field_name = sheet_obj.cell(row=2, column=i).value
-                y_by_page_num.setdefault(page_num, 720)
-                new_pos[page_num].append([50, y_by_page_num[page_num], field_name, "Times New Roman", 10, 400])
-                y_by_page_num[page_num] -= 30
-            TPdf.save_fields_to_file(dict(new_pos, **{"dir_name": f}))
-    return {"data": data}
+    # список шаблонов - из каталога, папка шаблонов здесь не читается
+    return {"data": {
+        info.dir_name: info._asdict() for info in request.app["catalog"].items()
+    }}
 
 
 @aiohttp_jinja2.template("positioning.html")
 async def positioning(request):
-    tpdf = TPdf()
     # дефолтные параметры
     in_data = {
         "dir_name": "ClearPage",
         "page_num": "1",
     }
     in_data.update(dict(request.query))
-    fields = tpdf.load_fields_from_file(name=in_data["dir_name"], to_front=True)
-    fonts = [os.path.basename(filename)[:-4] for filename in glob(os.path.join(tpdf.FONTS, "*.ttf"))]
-    in_data.update({"fields": fields, "fonts": fonts})
+    check_template(in_data["dir_name"])
+    # поля берём из реестра шаблонов в координатах веб-интерфейса,
+    # шрифты - из каталога
+    fields = await run(request, front_fields, in_data["dir_name"])
+    in_data.update({"fields": fields, "fonts": request.app["catalog"].fonts})
     return in_data
 
 
 async def save_form_fields(request):
-    rq = await request.json()
-    return TPdf.save_fields_to_file(rq["pos"])
+    try:
+        rq = await request.json()
+        new_pos = rq["pos"]
+        dir_name = new_pos["dir_name"]
+    except (ValueError, KeyError, TypeError):
+        raise web.HTTPBadRequest(text="Тело запроса - json {\"pos\": {\"dir_name\": ..., ...}}")
+    check_template(dir_name)
+    return web.json_response(await run(request, save_fields, request.app["catalog"],
+                                       new_pos, in_thread=True))
+
+
+def is_b64(request):
+    """Запрошен ли pdf в base64 (?b64=True), как параметр b64 у TPdf"""
+    return request.query.get("b64") == "True"
+
+
+def output_options(request):
+    """Параметры вывода pdf (output.OutputOptions) из запроса: ?compress=,
+    ?object_streams=, ?linearize= (1 или 0), не указанные - из настроек
+    приложения. Линеаризовать нечем - 501 до начала генерации"""
+    try:
+        options = parse_options(request.query, request.app["output"])
+        if options.linearize:
+            check_linearize()
+    except ValueError as e:
+        raise web.HTTPBadRequest(text=str(e))
+    except OutputUnavailable as e:
+        raise web.HTTPNotImplemented(text=str(e))
+    return options
+
+
+async def complete_file(request, file_name, complete, data, fill_x=False):
+    """Комплект документов: из кэша результатов, если он там есть, иначе
+    генерируется и отдаётся клиенту по мере генерации (с сохранением в кэш)
+
+    Ключ кэша зависит только от шаблонов и данных, поэтому он же ETag: на
+    повторный запрос с If-None-Match отвечаем 304 без генерации.
+    """
+    b64 = is_b64(request)
+    options = output_options(request)
+    cache = request.app["result_cache"]
+    if cache is None:
+        return await stream_pdf(request, file_name, write_complete, complete, data,
+                                fill_x=fill_x, options=options, b64=b64)
+    key, body = await run(request, cache_lookup, cache, complete, data, fill_x, options,
+                          in_thread=True)
+    etag = '"{}{}"'.format(key, "-b64" if b64 else "")
+    if ResponseFile.not_modified(request, etag):
+        return web.Response(status=304, headers={"ETag": etag})
+    if body is not None:
+        return ResponseFile(file_name, base64.b64encode(body) if b64 else body,
+                            etag=etag, b64=b64)
+    return await stream_pdf(request, file_name, write_cached, cache, key,
+                            write_complete, complete, data, fill_x=fill_x,
+                            options=options, b64=b64, headers={"ETag": etag})
 
 
 async def get_file(request):
-    dir_name = request.query["dir_name"]
-    tpdf = TPdf()
-    file = tpdf.get_pdf(dir_name, b64="False", fill_x=True)
-    return ResponseFile(dir_name, file)
+    # pdf отдаётся клиенту по мере генерации, не собираясь целиком в памяти
+    dir_name = request.query.get("dir_name")
+    check_template(dir_name)
+    return await complete_file(request, dir_name, [(dir_name, 1), ], {}, fill_x=True)
+
+
+async def preview(request):
+    """Одна страница шаблона с именами полей для редактора полей
+
+    ?page_num= - номер страницы с 1, как в positioning, ?format=png -
+    картинка вместо pdf (?dpi= - разрешение). Повторный просмотр неизменной
+    страницы отдаётся из кэша.
+    """
+    dir_name = request.query.get("dir_name")
+    check_template(dir_name)
+    fmt = request.query.get("format", "pdf")
+    try:
+        page_number = int(request.query.get("page_num", 1)) - 1
+        dpi = min(max(int(request.query.get("dpi", 96)), 36), 300)
+    except ValueError:
+        raise web.HTTPBadRequest(text="page_num и dpi - целые числа")
+    if fmt not in ("pdf", "png"):
+        raise web.HTTPBadRequest(text="format - pdf или png")
+    try:
+        body = await run(request, preview_cache.get, dir_name, page_number, fmt, dpi,
+                         in_thread=True)
+    except IndexError as e:
+        raise web.HTTPNotFound(text=str(e))
+    except PreviewUnavailable as e:
+        raise web.HTTPNotImplemented(text=str(e))
+    if fmt == "png":
+        return web.Response(body=body, content_type="image/png")
+    return ResponseFile("{}_{}.pdf".format(dir_name, page_number + 1), body)
 
 
 async def get_file_with_data(request):
-    dir_name = request.query["dir_name"]
-    tpdf = TPdf()
-    file = tpdf.get_pdf_with_data(dir_name, b64="False")
-    return ResponseFile(dir_name, file)
+    """Впечатывает в шаблон строки его файла данных (data.xlsx, data.csv и
+    т.д.), а в POST запросе - строки из тела запроса: csv, json lines, xlsx,
+    parquet или arrow (по Content-Type или параметру ?format=)"""
+    dir_name = request.query.get("dir_name")
+    check_template(dir_name)
+    options = output_options(request)
+    if request.method != "POST":
+        check_data_file(dir_name)
+        return await stream_pdf(request, dir_name, write_pdf_with_data, dir_name,
+                                options=options, render=batch_render(request),
+                                executor="batch", b64=is_b64(request))
+    path = await save_upload(request, tempfile.gettempdir())
+    try:
+        return await stream_pdf(request, dir_name, write_pdf_with_data, dir_name,
+                                path=path, options=options, render=batch_render(request),
+                                executor="batch", b64=is_b64(request))
+    finally:
+        os.remove(path)
+
+
+async def get_zip_with_data(request):
+    """По pdf на каждую строку данных, файлы отдаются потоком в zip архиве
+
+    Данные - как у get_file_with_data: файл данных шаблона ?dir_name= или
+    тело POST запроса, или json {"complete": [[шаблон, копий], ...],
+    "rows": [{поле: значение}, ...]} - тогда в каждом pdf комплект
+    документов. ?name= - шаблон имени файла записи: {поле}, {n} - номер
+    строки (по умолчанию archive.CONFIG)
+    """
+    options = output_options(request)
+    name = request.query.get("name")
+    path = None
+    if request.content_type == "application/json":
+        try:
+            rq = await request.json()
+            complete = [(doc_name, int(count)) for doc_name, count in rq["complete"]]
+            rows = rq.get("rows") or []
+            name = rq.get("name", name)
+        except (KeyError, TypeError, ValueError, AttributeError):
+            raise web.HTTPBadRequest(
+                text="Тело запроса - json {\"complete\": [[шаблон, копий], ...], \"rows\": [...]}")
+        if not valid_rows(rows):
+            raise web.HTTPBadRequest(text="rows - список объектов {поле: значение}")
+        if not complete:
+            raise web.HTTPBadRequest(text="complete - список [шаблон, копий]")
+    else:
+        complete = [(request.query.get("dir_name"), 1)]
+        rows = None
+    if name is not None and not isinstance(name, str):
+        raise web.HTTPBadRequest(text="name - строка")
+    try:
+        if name:
+            check_name_template(name)
+    except ValueError as e:
+        raise web.HTTPBadRequest(text=str(e))
+    for doc_name, count in complete:
+        check_template(doc_name)
+    if request.method == "POST" and rows is None:
+        path = await save_upload(request, tempfile.gettempdir())
+    elif rows is None:
+        check_data_file(complete[0][0])
+    file_name = complete[0][0] + ".zip" if len(complete) == 1 else "documents.zip"
+    try:
+        return await stream_pdf(request, file_name, write_zip_with_data, complete,
+                                path=path, rows=rows, name=name, options=options,
+                                render=batch_render(request), executor="batch",
+                                content_type="application/zip")
+    finally:
+        if path is not None:
+            os.remove(path)
+
+
+def valid_dir_name(dir_name):
+    return isinstance(dir_name, str) and bool(dir_name) and "/" not in dir_name and not dir_name.startswith(".")
+
+
+def valid_rows(rows):
+    """Строки данных из json запроса: список словарей"""
+    return isinstance(rows, list) and all(isinstance(row, dict) for row in rows)
+
+
+def template_exists(dir_name):
+    return valid_dir_name(dir_name) and os.path.isdir(os.path.join(FILES, dir_name))
+
+
+def check_template(dir_name):
+    """404, если шаблона dir_name нет: имя приходит из запроса и до реестра
+    шаблонов и метрик не доходит"""
+    if not template_exists(dir_name):
+        raise web.HTTPNotFound(text="Нет шаблона {}".format(dir_name))
+
+
+def check_data_file(dir_name):
+    """404, если у шаблона dir_name нет файла данных (data.xlsx, data.csv и т.д.)"""
+    if find_data_file(os.path.join(FILES, dir_name)) is None:
+        raise web.HTTPNotFound(text="У шаблона {} нет файла данных".format(dir_name))
+
+
+def write_chunks(f, chunks):
+    for chunk in chunks:
+        f.write(chunk)
+
+
+async def save_upload(request, directory):
+    """Сохраняет тело запроса в файл в папке directory по частям, не держа
+    его в памяти, расширение файла - формат данных (см. sources.py)
+
+    :return: путь к файлу
+    """
+    try:
+        fmt = upload_format(request.content_type, request.query.get("format"))
+    except UnsupportedSource as e:
+        raise web.HTTPBadRequest(text=str(e))
+    path = os.path.join(directory, "upload_{}.{}".format(uuid.uuid4().hex, fmt))
+    # запись на диск - в пуле event loop по умолчанию, а не в пуле генерации:
+    # большая загрузка не должна занимать места генерации pdf (и получать 503)
+    loop = asyncio.get_running_loop()
+    chunks = []
+    try:
+        with open(path, "wb") as f:
+            async for chunk in request.content.iter_chunked(64 * 1024):
+                chunks.append(chunk)
+                if len(chunks) >= 16:
+                    await loop.run_in_executor(None, write_chunks, f, chunks)
+                    chunks = []
+            await loop.run_in_executor(None, write_chunks, f, chunks)
+    except BaseException:
+        os.remove(path)
+        raise
+    return path
+
+
+async def submit_job(request):
+    """Ставит в очередь задание на массовое впечатывание, возвращает его id
+
+    Тело запроса - json {"dir_name": ..., "rows": [{поле: значение}, ...]}
+    (без rows - данные из файла данных шаблона) или файл данных (xlsx в
+    формате data.xlsx, csv, json lines, parquet, arrow - по Content-Type или
+    параметру ?format=) с именем шаблона в параметре ?dir_name=
+    """
+    runner = request.app["jobs"]
+    dir_name = request.query.get("dir_name")
+    if request.content_type == "application/json":
+        try:
+            rq = await request.json()
+            dir_name, rows = rq["dir_name"], rq.get("rows")
+        except (ValueError, KeyError, TypeError, AttributeError):
+            raise web.HTTPBadRequest(text="Тело запроса - json {\"dir_name\": ..., \"rows\": [...]}")
+        if rows is not None and not valid_rows(rows):
+            raise web.HTTPBadRequest(text="rows - список объектов {поле: значение}")
+        path = None
+    else:
+        # файл данных принимаем в папку заданий
+        rows = None
+        path = await save_upload(request, runner.store.directory)
+    try:
+        if not valid_dir_name(dir_name):
+            raise web.HTTPBadRequest(text="Не указан шаблон dir_name")
+        job_id = await run(request, runner.store.create, dir_name, rows, path,
+                           in_thread=True)
+    except FileNotFoundError as e:
+        raise web.HTTPNotFound(text=str(e))
+    except ValueError as e:
+        # неизвестный формат или битый файл данных
+        raise web.HTTPBadRequest(text=str(e))
+    finally:
+        if path is not None and os.path.exists(path):
+            os.remove(path)
+    runner.notify()
+    return web.json_response({
+        "id": job_id,
+        "status_url": str(request.app.router["job_status"].url_for(job_id=job_id)),
+        "result_url": str(request.app.router["job_result"].url_for(job_id=job_id)),
+    }, status=202)
+
+
+async def get_job(request):
+    """Состояние задания: строк готово, скорость, оставшееся время"""
+    job = await run(request, request.app["jobs"].store.get, request.match_info["job_id"],
+                    in_thread=True)
+    if job is None:
+        raise web.HTTPNotFound()
+    return web.json_response(job_status(job))
+
+
+async def get_job_result(request):
+    """Готовый pdf задания"""
+    store = request.app["jobs"].store
+    job = await run(request, store.get, request.match_info["job_id"], in_thread=True)
+    if job is None:
+        raise web.HTTPNotFound()
+    if job["status"] != DONE:
+        raise web.HTTPConflict(text=json.dumps(job_status(job)),
+                               content_type="application/json")
+    return web.FileResponse(store.path(job["id"], "result.pdf"), headers={
+        "Content-Type": "application/pdf",
+        "Content-Disposition": "inline; filename*=UTF-8''{}".format(
+            quote(job["dir_name"] + ".pdf", encoding="utf-8")),
+    })
+
+
+async def resume_job(request):
+    """Возвращает в очередь задание, завершившееся ошибкой, оно продолжится с
+    последней сохранённой части"""
+    runner = request.app["jobs"]
+    job = await run(request, runner.store.get, request.match_info["job_id"], in_thread=True)
+    if job is None:
+        raise web.HTTPNotFound()
+    if job["status"] == FAILED:
+        await run(request, runner.store.requeue_job, job["id"], in_thread=True)
+        runner.notify()
+        job = await run(request, runner.store.get, job["id"], in_thread=True)
+    return web.json_response(job_status(job))
+
+
+async def executors_status(request):
+    """Загрузка пулов: сколько заданий выполняется и сколько ждёт в очереди,
+    и статистика кэша результатов"""
+    status = {
+        name: executor.stats()
+        for name, executor in request.app["executors"].items()
+    }
+    cache = request.app["result_cache"]
+    status["result_cache"] = cache.stats() if cache is not None else None
+    return web.json_response(status)
 
 
 async def example(request):
@@ -93,7 +463,8 @@ async def example(request):
         "registration": "г.Москва, ул. Полковника Исаева, дом 17, кв 43",
         "1_work": "Радистка 3 категории, в/ч 89031",
         "2_work": "Радистка 1 категории, в/ч 17043",
-        "3_work": "Командир отделения радистов, в/ч 17043 главного управления разведки комитета государственной безопасности республики Беларусь.",
+        "3_work": "Командир отделения радистов, в/ч 17043 главного управления разведки "
+                  "комитета государственной безопасности республики Беларусь.",
     }
 
     # перечень документов в комплекте
@@ -103,10 +474,5 @@ async def example(request):
         ("ZayavlenieNaZagranpasport", 1),
     ]
 
-    # загружаем данные в основной класс и получаем комплект документов в pdf
-    tpdf = TPdf()
-    # можно сгенерировать один файл или комплект документов
-    # file = tpdf.get_pdf("ZayavlenieNaZagranpasport ", b64="False")
-    file = tpdf.get_complete(complete, data, b64="False")
-
-    return ResponseFile("ZayavlenieNaZagranpasport.pdf", file)
+    # комплект отдаётся по мере генерации, повторно - из кэша результатов
+    return await complete_file(request, "ZayavlenieNaZagranpasport.pdf", complete, data)
@@ -1,3 +1,4 @@
+import argparse
 import logging
 import os
 
@@ -6,23 +7,59 @@ import jinja2
 from aiohttp import web
 
 from app import views
+from app.cache import setup_result_cache
+from app.catalog import setup_catalog
+from app.executor import setup_executors
+from app.jobs import setup_jobs
+from app.metrics import setup_metrics
+from app.output import setup_output
+from app.server import serve
 
-app = web.Application()
 
-aiohttp_jinja2.setup(
-    app, loader=jinja2.FileSystemLoader(os.path.join(os.getcwd(), "templates"))
-)
+def make_app():
+    """Веб приложение со всеми маршрутами, пулами и кэшем (его же использует
+    sandbox/bench.py через тестовый клиент aiohttp)"""
+    app = web.Application()
+    setup_executors(app)
+    setup_result_cache(app)
+    setup_jobs(app)
+    setup_catalog(app)
+    setup_metrics(app)
+    setup_output(app)
 
-logging.basicConfig(level=logging.DEBUG)
+    aiohttp_jinja2.setup(
+        app, loader=jinja2.FileSystemLoader(os.path.join(os.getcwd(), "templates"))
+    )
 
-app.add_routes([
-    web.get("/", views.index),
-    web.static("/static", "static", show_index=True),
-    web.get("/tpdf/positioning", views.positioning),
-    web.post("/tpdf/save_form_fields", views.save_form_fields),
-    web.get("/tpdf/get_file", views.get_file),
-    web.get("/tpdf/get_file_with_data", views.get_file_with_data),
-    web.get("/tpdf/example", views.example),
-])
+    app.add_routes([
+        web.get("/", views.index),
+        web.static("/static", "static", show_index=True),
+        web.get("/tpdf/positioning", views.positioning),
+        web.post("/tpdf/save_form_fields", views.save_form_fields),
+        web.get("/tpdf/get_file", views.get_file),
+        web.get("/tpdf/preview", views.preview),
+        web.get("/tpdf/get_file_with_data", views.get_file_with_data),
+        web.post("/tpdf/get_file_with_data", views.get_file_with_data),
+        web.get("/tpdf/get_zip_with_data", views.get_zip_with_data),
+        web.post("/tpdf/get_zip_with_data", views.get_zip_with_data),
+        web.get("/tpdf/example", views.example),
+        web.get("/tpdf/status", views.executors_status),
+        web.post("/tpdf/jobs", views.submit_job),
+        web.get("/tpdf/jobs/{job_id}", views.get_job, name="job_status"),
+        web.get("/tpdf/jobs/{job_id}/result", views.get_job_result, name="job_result"),
+        web.post("/tpdf/jobs/{job_id}/resume", views.resume_job),
+    ])
+    return app
 
-web.run_app(app, port=8001)
+
+if __name__ == "__main__":
+    # по умолчанию - настройки app/server.py (TPDF_SERVER_*)
+    parser = argparse.ArgumentParser(description="Веб сервер tpdf")
+    parser.add_argument("--host")
+    parser.add_argument("--port", type=int)
+    parser.add_argument("-w", "--workers", type=int, help="рабочих процессов")
+    parser.add_argument("--max-requests", type=int,
+                        help="перезапуск процесса после стольких запросов (с --workers > 1)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG)
+    serve(make_app, **vars(args))
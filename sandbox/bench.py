@@ -0,0 +1,356 @@
+"""Замеры производительности генерации pdf
+
+Каждый замер выполняется в отдельном процессе (так пиковая память RSS
+относится только к нему): один прогон для прогрева, затем операция
+повторяется, пока не наберётся --min-time секунд. Результат - json:
+операций в секунду, медиана и 99 перцентиль времени операции, пиковая
+память процесса и размер результата в байтах.
+
+    python -m sandbox.bench                   # все замеры, сравнение с базой
+    python -m sandbox.bench text_wrap http    # только замеры с такими префиксами
+    python -m sandbox.bench --save-baseline   # записать результат как базу
+
+Кроме шаблонов из tpdf_templates используется синтетический шаблон
+_bench_synthetic (много полей, длинный текст, фото, --rows строк data.xlsx),
+он создаётся на время замеров и удаляется после них.
+"""
+import argparse
+import asyncio
+import atexit
+import io
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import time
+from collections import namedtuple
+
+import openpyxl
+from reportlab.lib.pagesizes import A4
+from reportlab.pdfgen import canvas
+
+from app.output import default_options
+from app.tpdf import FILES, TPdf, registry
+
+CUR_PATH = os.path.dirname(os.path.abspath(__file__))
+BASELINE = os.path.join(CUR_PATH, "bench_baseline.json")
+SYNTHETIC = "_bench_synthetic"
+
+Result = namedtuple("Result", "ops_per_sec p50_ms p99_ms peak_rss_mb bytes repeat")
+
+# допустимое ухудшение относительно базы: доля, на которую показатель может
+# стать хуже (для ops_per_sec - меньше, для остальных - больше)
+THRESHOLDS = {"ops_per_sec": 0.2, "p99_ms": 0.3, "peak_rss_mb": 0.1, "bytes": 0.02}
+
+TEXT = (
+    "Спустя два дня последний класс школы СП ШЦ-401 весело рассаживался под прозрачным куполом "
+    "гигантского вагона Спиральной Дороги. Едва поезд набрал скорость, в центральном проходе "
+    "появился Кими и объявил, что он готов читать реферат. Послышались энергичные протесты. "
+    "Ученики доказывали, что не хватит внимания — слишком интересно смотреть по сторонам. "
+    "Учитель примирил всех советом прослушать реферат в середине пути, когда поезд будет "
+    "пересекать фруктовый пояс шириной около четырехсот километров, — это два часа хода."
+)
+
+EXAMPLE_DATA = {
+    "last_name": "Иванова",
+    "first_name": "Мария",
+    "middle_name": "Иванова",
+    "gender": "Ж",
+    "birth_date": "2000-01-01",
+    "birth_place": "г.Москва",
+    "registration": "г.Москва, ул. Полковника Исаева, дом 17, кв 43",
+    "1_work": "Радистка 3 категории, в/ч 89031",
+    "2_work": "Радистка 1 категории, в/ч 17043",
+    "3_work": "Командир отделения радистов, в/ч 17043 главного управления разведки "
+              "комитета государственной безопасности республики Беларусь.",
+}
+
+EXAMPLE_COMPLETE = [
+    ("ZayavlenieNaZagranpasport", 1),
+    ("ClearPage", 1),
+    ("ZayavlenieNaZagranpasport", 1),
+]
+
+
+def synthetic_row(rnd, fields):
+    """Строка данных синтетического шаблона: короткие, длинные значения и фото"""
+    row = {}
+    for name in fields:
+        if name.startswith("photo"):
+            row[name] = rnd.choice(["foto.jpg", "foto1.jpg", "foto2.jpg"])
+        elif name.startswith("long"):
+            start = rnd.randrange(len(TEXT) // 2)
+            row[name] = TEXT[start:start + rnd.randrange(100, len(TEXT) // 2)]
+        else:
+            row[name] = "{} {}".format(name, rnd.randrange(10 ** 6))
+    return row
+
+
+def make_synthetic(rows, pages=2, fields_per_page=40):
+    """Создаёт шаблон _bench_synthetic: форма, поля, фото и data.xlsx"""
+    path = os.path.join(FILES, SYNTHETIC)
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(os.path.join(path, "images"))
+    for name in os.listdir(os.path.join(FILES, "try_xlsx", "images")):
+        shutil.copy(os.path.join(FILES, "try_xlsx", "images", name),
+                    os.path.join(path, "images", name))
+
+    # форма - страницы с сеткой линий, чтобы у формы было содержимое
+    can = canvas.Canvas(os.path.join(path, "form.pdf"), pagesize=A4, invariant=True)
+    for page in range(pages):
+        for y in range(40, 800, 18):
+            can.line(40, y, 555, y)
+        can.drawString(40, 810, "{} {}".format(SYNTHETIC, page + 1))
+        can.showPage()
+    can.save()
+
+    fields = {}
+    names = []
+    for page in range(pages):
+        page_fields = []
+        for i in range(fields_per_page):
+            if i == 0:
+                name, width = "photo{}".format(page), 90
+            elif i % 8 == 1:
+                name, width = "long{}_{}".format(page, i), 400
+            else:
+                name, width = "f{}_{}".format(page, i), 150 + i % 3 * 100
+            page_fields.append([40 + i % 2 * 260, 790 - i // 2 * 36, name,
+                                "Times New Roman", 9 + i % 3, width])
+            names.append((page, name))
+        fields[str(page)] = page_fields
+    with open(os.path.join(path, "fields.json"), "w") as f:
+        json.dump(fields, f, ensure_ascii=False, indent=4)
+
+    # data.xlsx: первая строка - номера страниц (с 1), вторая - имена полей
+    rnd = random.Random(0)
+    wb = openpyxl.Workbook(write_only=True)
+    sheet = wb.create_sheet()
+    sheet.append([page + 1 for page, name in names])
+    sheet.append([name for page, name in names])
+    for _ in range(rows):
+        row = synthetic_row(rnd, [name for page, name in names])
+        sheet.append([row[name] for page, name in names])
+    wb.save(os.path.join(path, "data.xlsx"))
+
+
+def synthetic_data():
+    fields = TPdf.load_fields_from_file(SYNTHETIC)
+    names = [field.name for page_fields in fields.values() for field in page_fields]
+    return synthetic_row(random.Random(1), names)
+
+
+def bench_text_wrap():
+    registry.register_fonts()
+    can = canvas.Canvas(io.BytesIO(), pagesize=A4)
+    can.setFont("Times New Roman", 10)
+    return lambda: list(TPdf.text_wrap(TEXT, 100, can))
+
+
+def bench_add_document(dir_name, data_fn=dict):
+    return lambda: TPdf().add_document(dir_name, data_fn())
+
+
+def bench_get_complete():
+    return lambda: TPdf().get_complete(EXAMPLE_COMPLETE, dict(EXAMPLE_DATA), b64="False")
+
+
+def bench_get_pdf_with_data(dir_name):
+    return lambda: TPdf().get_pdf_with_data(dir_name, b64="False")
+
+
+def bench_write_pdf_with_data(dir_name, **options):
+    """options - параметры вывода, отличные от output.CONFIG"""
+    def op():
+        output = io.BytesIO()
+        TPdf().write_pdf_with_data(dir_name, output, options=default_options()._replace(**options))
+        return output.getvalue()
+    return op
+
+
+def bench_http(path, cache=False):
+    """Запрос к приложению из index.py на тестовом сервере aiohttp
+
+    Запросы идут через обычную ClientSession: TestClient хранит все ответы до
+    закрытия, и пиковая память росла бы с числом повторов
+    """
+    from aiohttp import ClientSession
+    from aiohttp.test_utils import TestServer
+
+    os.environ["TPDF_CACHE_MAX_BYTES"] = str(64 * 1024 * 1024 if cache else 0)
+    from index import make_app
+
+    async def start():
+        server = TestServer(make_app())
+        await server.start_server()
+        return server, ClientSession()
+
+    async def stop():
+        await session.close()
+        await server.close()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    server, session = loop.run_until_complete(start())
+    atexit.register(loop.run_until_complete, stop())
+
+    async def get():
+        async with session.get(server.make_url(path)) as response:
+            body = await response.read()
+            assert response.status == 200, (response.status, body[:200])
+            return body
+    return lambda: loop.run_until_complete(get())
+
+
+# имя замера -> функция, готовящая операцию (вызывается в процессе замера)
+CASES = {
+    "text_wrap": bench_text_wrap,
+    "add_document.ClearPage": lambda: bench_add_document("ClearPage"),
+    "add_document.ZayavlenieNaZagranpasport": lambda: bench_add_document(
+        "ZayavlenieNaZagranpasport", lambda: dict(EXAMPLE_DATA)),
+    "add_document.synthetic": lambda: bench_add_document(SYNTHETIC, synthetic_data),
+    "get_complete.example": bench_get_complete,
+    "get_pdf_with_data.try_xlsx": lambda: bench_get_pdf_with_data("try_xlsx"),
+    "get_pdf_with_data.synthetic": lambda: bench_get_pdf_with_data(SYNTHETIC),
+    "write_pdf_with_data.synthetic": lambda: bench_write_pdf_with_data(SYNTHETIC),
+    "write_pdf_with_data.synthetic.uncompressed": lambda: bench_write_pdf_with_data(
+        SYNTHETIC, compress=False),
+    "write_pdf_with_data.synthetic.object_streams": lambda: bench_write_pdf_with_data(
+        SYNTHETIC, object_streams=True),
+    "http.get_file": lambda: bench_http(
+        "/tpdf/get_file?dir_name=ZayavlenieNaZagranpasport"),
+    "http.example": lambda: bench_http("/tpdf/example"),
+    "http.example_cached": lambda: bench_http("/tpdf/example", cache=True),
+    "http.get_file_with_data": lambda: bench_http(
+        "/tpdf/get_file_with_data?dir_name=try_xlsx"),
+    "http.positioning": lambda: bench_http(
+        "/tpdf/positioning?dir_name=try_xlsx&page_num=1"),
+}
+
+
+def peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux - килобайты, macos - байты
+    return rss / 1024 / (1024 if sys.platform == "darwin" else 1)
+
+
+def percentile(times, q):
+    times = sorted(times)
+    return times[min(int(len(times) * q), len(times) - 1)]
+
+
+def measure(op, min_time=1.0, min_repeat=3, max_repeat=1000) -> "Result":
+    """Замер операции op в текущем процессе (после одного прогона для прогрева)"""
+    result = op()
+    times = []
+    started = time.perf_counter()
+    while len(times) < min_repeat or (
+            time.perf_counter() - started < min_time and len(times) < max_repeat):
+        start = time.perf_counter()
+        op()
+        times.append(time.perf_counter() - start)
+    return Result(
+        ops_per_sec=round(len(times) / sum(times), 3),
+        p50_ms=round(percentile(times, 0.5) * 1000, 3),
+        p99_ms=round(percentile(times, 0.99) * 1000, 3),
+        peak_rss_mb=round(peak_rss_mb(), 1),
+        bytes=len(result) if isinstance(result, (bytes, str)) else None,
+        repeat=len(times),
+    )
+
+
+def run_case(name, min_time):
+    """Запускает замер name в отдельном процессе, возвращает Result"""
+    out = subprocess.run(
+        [sys.executable, "-m", "sandbox.bench", "--child", name,
+         "--min-time", str(min_time)],
+        stdout=subprocess.PIPE, check=True,
+        cwd=os.path.dirname(CUR_PATH),
+    ).stdout
+    return Result(**json.loads(out.decode("utf-8").splitlines()[-1]))
+
+
+def compare(results, baseline):
+    """Сравнение с базой: список строк с ухудшениями сверх THRESHOLDS"""
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        for key, threshold in THRESHOLDS.items():
+            value, base_value = result[key], base.get(key)
+            if value is None or not base_value:
+                continue
+            change = value / base_value - 1
+            worse = -change if key == "ops_per_sec" else change
+            if worse > threshold:
+                regressions.append("{}: {} {} -> {} ({:+.0%})".format(
+                    name, key, base_value, value, change))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("cases", nargs="*", help="префиксы имён замеров")
+    parser.add_argument("--rows", type=int, default=20,
+                        help="строк data.xlsx синтетического шаблона")
+    parser.add_argument("--min-time", type=float, default=1.0,
+                        help="минимальное время замера одной операции, сек")
+    parser.add_argument("--output", help="файл для результата в json")
+    parser.add_argument("--baseline", default=BASELINE, help="файл базы")
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="записать результат в файл базы")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        result = measure(CASES[args.child](), args.min_time)
+        print(json.dumps(result._asdict()))
+        return
+
+    names = [name for name in CASES
+             if not args.cases or any(name.startswith(c) for c in args.cases)]
+    results = {}
+    make_synthetic(args.rows)
+    try:
+        for name in names:
+            results[name] = run_case(name, args.min_time)._asdict()
+            print("{:40} {:>10.2f} ops/s  p50 {:>9.2f} ms  p99 {:>9.2f} ms  "
+                  "{:>7.1f} MB  {} bytes".format(
+                      name, *(results[name][key] for key in Result._fields[:5])),
+                  file=sys.stderr)
+    finally:
+        shutil.rmtree(os.path.join(FILES, SYNTHETIC), ignore_errors=True)
+
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "rows": args.rows,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
+    else:
+        print(json.dumps(report, indent=4))
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=4)
+        return
+    if os.path.isfile(args.baseline):
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f)["results"])
+        for line in regressions:
+            print("REGRESSION", line, file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+import io
+import unittest
+
+from app.batch import render_rows
+from app.tpdf import TPdf
+
+
+class RenderRowsTest(unittest.TestCase):
+    """Параллельное впечатывание (batch.render_rows) и последовательное
+    (TPdf.write_pdf_with_data) дают один и тот же pdf"""
+
+    dir_name = "try_xlsx"
+
+    @classmethod
+    def setUpClass(cls):
+        rows = list(TPdf.iter_data_rows(cls.dir_name))
+        # разные строки в разном порядке: новые символы появляются в разных
+        # чанках
+        cls.rows = rows + rows[::-1] + rows[1:]
+        serial = io.BytesIO()
+        TPdf().write_pdf_with_data(cls.dir_name, serial, rows=cls.rows)
+        cls.serial = serial.getvalue()
+
+    def test_equals_serial(self):
+        for chunk_size in (1, 2, 3, 100):
+            with self.subTest(chunk_size=chunk_size):
+                output = io.BytesIO()
+                stats = render_rows(self.dir_name, self.rows, output=output, workers=2,
+                                    chunk_size=chunk_size)
+                self.assertEqual(output.getvalue(), self.serial)
+                # коды символов назначены до отправки чанков, процессам
+                # нечего добавлять, и ни один чанк не рисуется дважды
+                self.assertEqual(stats["rerendered"], 0)
+
+    def test_assign_codes(self):
+        """assign_codes назначает те же коды, что и рисование наложений"""
+        drawn, assigned = TPdf(), TPdf()
+        drawn.render_overlays_batch(self.dir_name, self.rows)
+        assigned.assign_codes(self.dir_name, self.rows)
+        self.assertEqual(assigned.font_subsets.export(), drawn.font_subsets.export())
+
+
+if __name__ == "__main__":
+    unittest.main()
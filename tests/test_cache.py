@@ -0,0 +1,92 @@
+import io
+import os
+import tempfile
+import unittest
+
+from app.cache import ResultCache, result_key, write_cached
+
+
+def generate(parts, size=1000):
+    """fn для write_cached: пишет parts кусков по size байт"""
+    def fn(output):
+        for i in range(parts):
+            output.write(bytes([i % 256]) * size)
+        return parts
+    return fn
+
+
+class ResultCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def test_memory_lru(self):
+        cache = ResultCache(max_bytes=2500)
+        for key in "abc":
+            cache.put(key, key.encode() * 1000)
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.get("c"), b"c" * 1000)
+        self.assertEqual(cache.stats()["bytes"], 2000)
+
+    def test_spill_to_disk(self):
+        cache = ResultCache(max_bytes=1500, directory=self.tmp.name)
+        cache.put("a", b"a" * 1000)
+        cache.put("b", b"b" * 1000)
+        self.assertEqual(os.listdir(self.tmp.name), ["a.pdf"])
+        self.assertEqual(cache.get("a"), b"a" * 1000)
+        self.assertEqual(cache.stats()["disk_hits"], 1)
+        # после перезапуска результаты с диска подхватываются
+        self.assertEqual(ResultCache(1500, self.tmp.name).get("a"), b"a" * 1000)
+
+    def test_write_cached(self):
+        cache = ResultCache(max_bytes=10000)
+        output = io.BytesIO()
+        self.assertEqual(write_cached(cache, "k", generate(5), output=output), 5)
+        self.assertEqual(cache.get("k"), output.getvalue())
+
+    def test_write_cached_without_disk(self):
+        """Без папки кэша копия больше max_bytes не копится в памяти"""
+        cache = ResultCache(max_bytes=10000, max_disk_bytes=10 ** 9)
+        output = io.BytesIO()
+        write_cached(cache, "k", generate(50), output=output)
+        self.assertEqual(len(output.getvalue()), 50000)
+        self.assertIsNone(cache.get("k"))
+
+    def test_write_cached_spill_file(self):
+        """Больше max_bytes - во временный файл в папке кэша, больше
+        max_disk_bytes - не сохраняется вовсе"""
+        cache = ResultCache(max_bytes=10000, directory=self.tmp.name, max_disk_bytes=100000)
+        output = io.BytesIO()
+        write_cached(cache, "big", generate(50), output=output)
+        self.assertEqual(os.listdir(self.tmp.name), ["big.pdf"])
+        self.assertEqual(cache.get("big"), output.getvalue())
+        write_cached(cache, "huge", generate(200), output=io.BytesIO())
+        self.assertEqual(os.listdir(self.tmp.name), ["big.pdf"])
+
+    def test_write_cached_error(self):
+        """Недописанный результат не сохраняется, временный файл удаляется"""
+        cache = ResultCache(max_bytes=10000, directory=self.tmp.name)
+
+        def fail(output):
+            generate(50)(output)
+            raise RuntimeError
+
+        with self.assertRaises(RuntimeError):
+            write_cached(cache, "k", fail, output=io.BytesIO())
+        self.assertEqual(os.listdir(self.tmp.name), [])
+        self.assertIsNone(cache.get("k"))
+
+
+class ResultKeyTest(unittest.TestCase):
+
+    def test_key_depends_on_data(self):
+        complete = [("ClearPage", 1)]
+        key = result_key(complete, {"last_name": "Иванова"})
+        self.assertEqual(key, result_key(complete, {"last_name": "Иванова"}))
+        self.assertNotEqual(key, result_key(complete, {"last_name": "Петрова"}))
+        self.assertNotEqual(key, result_key(complete, {"last_name": "Иванова"}, fill_x=True))
+
+
+if __name__ == "__main__":
+    unittest.main()
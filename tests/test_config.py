@@ -0,0 +1,51 @@
+import os
+import unittest
+from unittest import mock
+
+from app import catalog, output
+from app.config import load_section
+
+DEFAULTS = {"workers": 1, "interval": 5.0, "dir": "", "linearize": False}
+
+
+class LoadSectionTest(unittest.TestCase):
+
+    def test_defaults(self):
+        with mock.patch.dict(os.environ, clear=True):
+            self.assertEqual(load_section("test", DEFAULTS), DEFAULTS)
+
+    def test_overrides(self):
+        env = {"TPDF_TEST_WORKERS": "4", "TPDF_TEST_INTERVAL": "0.5",
+               "TPDF_TEST_DIR": "/tmp/x", "TPDF_TEST_LINEARIZE": "yes"}
+        with mock.patch.dict(os.environ, env):
+            config = load_section("test", DEFAULTS)
+        self.assertEqual(config, {"workers": 4, "interval": 0.5, "dir": "/tmp/x",
+                                  "linearize": True})
+        self.assertEqual(DEFAULTS["workers"], 1)
+
+    def test_flags(self):
+        for value, expected in (("1", True), ("True", True), ("0", False), ("false", False),
+                                ("no", False)):
+            with self.subTest(value=value), \
+                    mock.patch.dict(os.environ, {"TPDF_TEST_LINEARIZE": value}):
+                self.assertIs(load_section("test", DEFAULTS)["linearize"], expected)
+
+    def test_bad_values(self):
+        for key, value in (("WORKERS", "four"), ("INTERVAL", "x"), ("LINEARIZE", "2")):
+            with self.subTest(key=key), \
+                    mock.patch.dict(os.environ, {"TPDF_TEST_" + key: value}), \
+                    self.assertRaisesRegex(ValueError, "TPDF_TEST_" + key):
+                load_section("test", DEFAULTS)
+
+    def test_sections(self):
+        """Разделы модулей читают свои переменные окружения"""
+        env = {"TPDF_OUTPUT_COMPRESS": "0", "TPDF_OUTPUT_OBJECT_STREAMS": "true",
+               "TPDF_CATALOG_INTERVAL": "1"}
+        with mock.patch.dict(os.environ, env):
+            self.assertEqual(output.default_options(),
+                             output.OutputOptions(False, True, False))
+            self.assertEqual(catalog.load_config(), {"interval": 1.0})
+
+
+if __name__ == "__main__":
+    unittest.main()
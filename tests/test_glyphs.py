@@ -0,0 +1,85 @@
+import random
+import unittest
+
+from reportlab.pdfbase.pdfmetrics import stringWidth
+
+from app.glyphs import fit_text, wrap_text
+from app.tpdf import registry
+
+FONT = "DejaVuSans"
+
+
+def reference_wrap(text, width, font_name, font_size):
+    """Посимвольный алгоритм прежнего TPdf.text_wrap"""
+    last_space = text_start = 0
+    word_len = cur_text_len = 0
+    for i, char in enumerate(text):
+        symbol_len = stringWidth(char, font_name, font_size)
+        if char == " ":
+            last_space = i
+            word_len = 0
+        else:
+            word_len += symbol_len
+        cur_text_len += symbol_len
+        if cur_text_len > width:
+            cur_text_len = word_len
+            if text_start < last_space:
+                yield text[text_start:last_space]
+                text_start = last_space + 1
+            else:
+                yield text[text_start:i]
+                text_start = i
+                word_len = cur_text_len = symbol_len
+    yield text[text_start:]
+
+
+class WrapTextTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        registry.register_fonts()
+
+    def test_matches_reference(self):
+        rnd = random.Random(1)
+        words = ["г.", "Москва", "ул.", "Ленина", "д.", "1", "Иванова", "Анна",
+                 "Сергеевна", "улица", "Новослободская", "Z" * 40, "wwwwwwwwwwww"]
+        for n in range(300):
+            text = " ".join(rnd.choice(words) for _ in range(rnd.randint(1, 40)))
+            width = rnd.choice((20, 50, 100.5, 250, 1000))
+            size = rnd.choice((8, 10, 12.5))
+            with self.subTest(text=text, width=width, size=size):
+                self.assertEqual(list(wrap_text(text, width, FONT, size)),
+                                 list(reference_wrap(text, width, FONT, size)))
+
+    def test_edge_cases(self):
+        self.assertEqual(list(wrap_text("", 100, FONT, 10)), [""])
+        # слово длиннее строки переносится по буквам
+        lines = list(wrap_text("Ш" * 30, 50, FONT, 10))
+        self.assertGreater(len(lines), 1)
+        self.assertEqual("".join(lines), "Ш" * 30)
+
+
+class FitTextTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        registry.register_fonts()
+
+    def test_max_lines(self):
+        text = "Иванова Анна Сергеевна " * 10
+        size, lines = fit_text(text, 100, FONT, 10, max_lines=2)
+        self.assertEqual(size, 10)
+        self.assertEqual(lines, list(wrap_text(text, 100, FONT, 10))[:2])
+
+    def test_min_font_size(self):
+        text = "Иванова Анна Сергеевна"
+        width = stringWidth(text, FONT, 8)
+        self.assertEqual(fit_text(text, width, FONT, 12, min_font_size=6), (8, [text]))
+        # меньше min_font_size шрифт не уменьшается
+        size, lines = fit_text(text, width, FONT, 12, min_font_size=10)
+        self.assertEqual(size, 10)
+        self.assertGreater(len(lines), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
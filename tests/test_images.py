@@ -0,0 +1,62 @@
+import io
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from pdfrw import PdfReader
+from PIL import Image
+from reportlab import rl_config
+from reportlab.pdfgen import canvas
+
+from app.images import ImageCache, draw_image, load_config
+from app.tpdf import FILES
+
+FOTO = os.path.join(FILES, "try_xlsx", "images", "foto.jpg")
+
+
+def draw(*paths):
+    """pdf с картинками paths"""
+    packet = io.BytesIO()
+    can = canvas.Canvas(packet)
+    for i, path in enumerate(paths):
+        draw_image(can, path, 100 * i, 100, 90)
+    can.save()
+    return packet.getvalue()
+
+
+class DrawImageTest(unittest.TestCase):
+
+    def test_binary_streams(self):
+        """Картинки без обёртки ASCII85, настройка reportlab не меняется"""
+        with tempfile.TemporaryDirectory() as tmp:
+            png = os.path.join(tmp, "alpha.png")
+            Image.new("RGBA", (40, 30), (255, 0, 0, 128)).save(png)
+            pdf = draw(FOTO, png, FOTO)
+        self.assertEqual(rl_config.useA85, 1)
+        xobjects = PdfReader(fdata=pdf).pages[0].Resources.XObject
+        # одинаковая картинка - один объект
+        self.assertEqual(len(xobjects), 2)
+        filters = sorted((image.Filter, image.SMask and image.SMask.Filter)
+                         for image in xobjects.values())
+        self.assertEqual(filters, [(["/DCTDecode"], None), (["/FlateDecode"], ["/FlateDecode"])])
+
+
+class ImageCacheTest(unittest.TestCase):
+
+    def test_config(self):
+        with mock.patch.dict(os.environ, {"TPDF_IMAGES_MAX_DPI": "150"}):
+            self.assertEqual(load_config(), {"max_items": 64, "max_dpi": 150})
+
+    def test_max_dpi(self):
+        """Картинка крупнее поля при max_dpi уменьшается, одна на ширину поля"""
+        cache = ImageCache(max_dpi=72)
+        image = cache.get(FOTO, 90)
+        self.assertEqual(image.reader.getSize()[0], 90)
+        self.assertIs(cache.get(FOTO, 90), image)
+        self.assertEqual(ImageCache().get(FOTO, 90).reader.getSize(), (1060, 1600))
+        self.assertEqual(cache.stats(), {"items": 1, "hits": 1, "misses": 1})
+
+
+if __name__ == "__main__":
+    unittest.main()
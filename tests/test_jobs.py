@@ -0,0 +1,61 @@
+import os
+import tempfile
+import unittest
+
+from app.jobs import QUEUED, JobStore
+from app.sources import InvalidSource
+
+
+class JobStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.store = JobStore(self.tmp.name)
+        self.addCleanup(self.store.close)
+
+    def job_dirs(self):
+        return [entry for entry in os.listdir(self.tmp.name)
+                if os.path.isdir(os.path.join(self.tmp.name, entry))]
+
+    def upload(self, name, body):
+        path = os.path.join(self.tmp.name, name)
+        with open(path, "wb") as f:
+            f.write(body)
+        return path
+
+    def test_create_from_rows(self):
+        job_id = self.store.create("try_xlsx", rows=[{"last_name": "Иванова"}, {}])
+        job = self.store.get(job_id)
+        self.assertEqual((job["status"], job["rows_total"], job["source"]),
+                         (QUEUED, 2, "rows.jsonl"))
+
+    def test_create_from_template_data(self):
+        job = self.store.get(self.store.create("try_xlsx"))
+        self.assertEqual(job["source"], "data.xlsx")
+        self.assertGreater(job["rows_total"], 0)
+
+    def test_create_from_upload(self):
+        path = self.upload("upload.csv", "last_name\nИванова\nПетрова\n".encode())
+        job = self.store.get(self.store.create("try_xlsx", path=path))
+        self.assertEqual((job["source"], job["rows_total"]), ("data.csv", 2))
+        self.assertFalse(os.path.exists(path))
+
+    def test_corrupt_upload(self):
+        """Битый xlsx - ValueError, папка задания не остаётся"""
+        path = self.upload("upload.xlsx", b"not a zip file")
+        with self.assertRaises(InvalidSource):
+            self.store.create("try_xlsx", path=path)
+        self.assertEqual(self.job_dirs(), [])
+        self.assertEqual(self.store.counts(), {})
+
+    def test_missing_template(self):
+        with self.assertRaises(FileNotFoundError):
+            self.store.create("NOPE", rows=[])
+        with self.assertRaises(FileNotFoundError):
+            self.store.create("ClearPage")
+        self.assertEqual(self.job_dirs(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
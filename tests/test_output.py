@@ -0,0 +1,104 @@
+import importlib.util
+import io
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from app.output import (OutputOptions, OutputUnavailable, PdfOutput, check_linearize,
+                        parse_options)
+from app.tpdf import TPdf
+
+HAS_PIKEPDF = importlib.util.find_spec("pikepdf") is not None
+
+COMPLETE = [("ZayavlenieNaZagranpasport", 2), ("ClearPage", 1)]
+DATA = {"last_name": "Иванова", "first_name": "Анна"}
+PLAIN = OutputOptions(compress=True, object_streams=False, linearize=False)
+
+
+def write_complete(**options):
+    output = io.BytesIO()
+    pages = TPdf().write_complete(COMPLETE, DATA, output, options=PLAIN._replace(**options))
+    return pages, output.getvalue()
+
+
+class OutputOptionsTest(unittest.TestCase):
+
+    def test_parse_options(self):
+        self.assertEqual(parse_options({"linearize": "yes", "compress": "0"}, PLAIN),
+                         OutputOptions(False, False, True))
+        with self.assertRaises(ValueError):
+            parse_options({"object_streams": "2"}, PLAIN)
+
+    def test_plain(self):
+        pages, pdf = write_complete()
+        self.assertTrue(pdf.startswith(b"%PDF-1.3"))
+        self.assertIn(b"\nxref\n", pdf)
+        self.assertNotIn(b"/ObjStm", pdf)
+        self.assertEqual(self.page_count(pdf), pages)
+
+    def test_uncompressed(self):
+        pages, pdf = write_complete(compress=False)
+        self.assertGreater(len(pdf), len(write_complete()[1]))
+        self.assertEqual(self.page_count(pdf), pages)
+
+    def test_object_streams(self):
+        """Объекты без потоков - в потоках объектов, xref - потоком"""
+        pages, pdf = write_complete(object_streams=True)
+        self.assertTrue(pdf.startswith(b"%PDF-1.5"))
+        self.assertIn(b"/ObjStm", pdf)
+        self.assertIn(b"/XRef", pdf)
+        self.assertNotIn(b"\nxref\n", pdf)
+        self.assertLess(len(pdf), len(write_complete()[1]))
+        self.assertEqual(self.page_count(pdf), pages)
+
+    def test_rows_object_streams(self):
+        """Впечатывание строк данных: общие объекты формы и шрифты (LatePdfDict)
+        в потоках объектов"""
+        for object_streams in (False, True):
+            with self.subTest(object_streams=object_streams):
+                output = io.BytesIO()
+                stats = TPdf().write_pdf_with_data(
+                    "try_xlsx", output, options=PLAIN._replace(object_streams=object_streams))
+                self.assertEqual(self.page_count(output.getvalue()), stats["pages"])
+
+    @unittest.skipUnless(HAS_PIKEPDF, "нет pikepdf")
+    def test_linearize(self):
+        import pikepdf
+        for object_streams in (False, True):
+            with self.subTest(object_streams=object_streams):
+                pages, pdf = write_complete(linearize=True, object_streams=object_streams)
+                with pikepdf.open(io.BytesIO(pdf)) as doc:
+                    self.assertTrue(doc.is_linearized)
+                    self.assertEqual(len(doc.pages), pages)
+                self.assertEqual(b"/ObjStm" in pdf, object_streams)
+
+    def test_linearize_cleanup(self):
+        """Временная папка линеаризации удаляется и при ошибке генерации"""
+        if not HAS_PIKEPDF:
+            self.skipTest("нет pikepdf")
+        with tempfile.TemporaryDirectory() as tmp, \
+                mock.patch.object(tempfile, "tempdir", tmp):
+            with self.assertRaises(RuntimeError), \
+                    PdfOutput(io.BytesIO(), PLAIN._replace(linearize=True)):
+                raise RuntimeError
+            self.assertEqual(os.listdir(tmp), [])
+
+    def test_linearize_unavailable(self):
+        with mock.patch("importlib.util.find_spec", return_value=None), \
+                mock.patch("shutil.which", return_value=None):
+            with self.assertRaises(OutputUnavailable):
+                check_linearize()
+
+    def page_count(self, pdf):
+        """Число страниц по мнению pikepdf (qpdf): заодно проверка, что pdf
+        читается"""
+        if not HAS_PIKEPDF:
+            self.skipTest("нет pikepdf")
+        import pikepdf
+        with pikepdf.open(io.BytesIO(pdf)) as doc:
+            return len(doc.pages)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,22 @@
+import unittest
+from unittest import mock
+
+from aiohttp import web
+
+from app.server import serve
+
+
+class ServeTest(unittest.TestCase):
+
+    def test_max_requests_single_process(self):
+        """max_requests в одном процессе не действует - предупреждение в логе"""
+        make_app = mock.Mock(return_value=web.Application())
+        with mock.patch.object(web, "run_app") as run_app, \
+                self.assertLogs("app.server", "WARNING") as logs:
+            serve(make_app, workers=1, max_requests=100)
+        run_app.assert_called_once()
+        self.assertIn("max_requests=100", logs.output[0])
+
+
+if __name__ == "__main__":
+    unittest.main()
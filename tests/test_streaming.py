@@ -0,0 +1,78 @@
+import asyncio
+import base64
+import threading
+import unittest
+
+from app.streaming import Base64Writer, QueueWriter, StreamAborted
+
+
+def write_parts(writer, parts, size=100):
+    """Пишет parts кусков по size байт и закрывает writer"""
+    for i in range(parts):
+        writer.write(bytes([i]) * size)
+    writer.close()
+
+
+class QueueWriterTest(unittest.IsolatedAsyncioTestCase):
+
+    async def read_all(self, queue_writer):
+        data = b""
+        while True:
+            chunk = await queue_writer.get()
+            if chunk is None:
+                return data
+            data += chunk
+
+    async def test_slow_client(self):
+        """Генерация не ждёт клиента: куски сверх max_chunks - во временном
+        файле, порядок сохраняется"""
+        queue_writer = QueueWriter(asyncio.get_running_loop(), chunk_size=100, max_chunks=2)
+        thread = threading.Thread(target=write_parts, args=(queue_writer, 50))
+        thread.start()
+        await asyncio.get_running_loop().run_in_executor(None, thread.join, 5)
+        self.assertFalse(thread.is_alive())
+        data = await self.read_all(queue_writer)
+        self.assertEqual(data, b"".join(bytes([i]) * 100 for i in range(50)))
+
+    async def test_spill_limit(self):
+        """Сверх max_spill запись ждёт, пока клиент заберёт данные"""
+        queue_writer = QueueWriter(asyncio.get_running_loop(), chunk_size=100, max_chunks=2,
+                                   max_spill=300)
+        thread = threading.Thread(target=write_parts, args=(queue_writer, 20))
+        thread.start()
+        await asyncio.get_running_loop().run_in_executor(None, thread.join, 0.5)
+        self.assertTrue(thread.is_alive())
+        data = await self.read_all(queue_writer)
+        thread.join(5)
+        self.assertEqual(data, b"".join(bytes([i]) * 100 for i in range(20)))
+
+    async def test_abort(self):
+        """После отключения клиента запись прерывается"""
+        queue_writer = QueueWriter(asyncio.get_running_loop(), chunk_size=100, max_chunks=1,
+                                   max_spill=100)
+        errors = []
+
+        def target():
+            try:
+                write_parts(queue_writer, 10)
+            except StreamAborted as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=target)
+        thread.start()
+        await asyncio.sleep(0.1)
+        queue_writer.abort()
+        await asyncio.get_running_loop().run_in_executor(None, thread.join, 5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(len(errors), 1)
+
+    async def test_base64(self):
+        queue_writer = QueueWriter(asyncio.get_running_loop(), chunk_size=64)
+        writer = Base64Writer(queue_writer)
+        await asyncio.get_running_loop().run_in_executor(None, write_parts, writer, 7, 10)
+        data = await self.read_all(queue_writer)
+        self.assertEqual(base64.b64decode(data), b"".join(bytes([i]) * 10 for i in range(7)))
+
+
+if __name__ == "__main__":
+    unittest.main()
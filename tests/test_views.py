@@ -0,0 +1,153 @@
+import os
+import tempfile
+from unittest import mock
+
+from aiohttp.test_utils import AioHTTPTestCase
+
+from index import make_app
+
+
+class AppTestCase(AioHTTPTestCase):
+    """Приложение index.make_app с папкой заданий во временной папке"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        env = mock.patch.dict(os.environ, {"TPDF_JOBS_DIR": self.tmp.name,
+                                           "TPDF_JOBS_WORKERS": "0"})
+        env.start()
+        self.addCleanup(env.stop)
+        super().setUp()
+
+    async def get_application(self):
+        return make_app()
+
+    async def assertStatus(self, response, status):
+        body = await response.text()
+        self.assertEqual(response.status, status, body)
+        return body
+
+
+class SubmitJobTest(AppTestCase):
+
+    async def test_rows(self):
+        response = await self.client.post(
+            "/tpdf/jobs", json={"dir_name": "try_xlsx", "rows": [{"last_name": "Иванова"}]})
+        await self.assertStatus(response, 202)
+
+    async def test_bad_json(self):
+        for body in ("{", "[]", '{"rows": []}', '{"dir_name": "try_xlsx", "rows": 5}',
+                     '{"dir_name": "try_xlsx", "rows": [1, 2]}'):
+            with self.subTest(body=body):
+                response = await self.client.post(
+                    "/tpdf/jobs", data=body, headers={"Content-Type": "application/json"})
+                await self.assertStatus(response, 400)
+
+    async def test_unknown_template(self):
+        response = await self.client.post("/tpdf/jobs", json={"dir_name": "NOPE"})
+        await self.assertStatus(response, 404)
+
+    async def test_corrupt_upload(self):
+        response = await self.client.post(
+            "/tpdf/jobs?dir_name=try_xlsx", data=b"not a zip file",
+            headers={"Content-Type": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"})
+        await self.assertStatus(response, 400)
+        self.assertEqual(
+            [entry for entry in os.listdir(self.tmp.name)
+             if os.path.isdir(os.path.join(self.tmp.name, entry))], [])
+
+
+class TemplateCheckTest(AppTestCase):
+    """Неизвестный шаблон или шаблон без данных - 404, а не 500"""
+
+    async def test_unknown_template(self):
+        for url in ("/tpdf/get_file?dir_name=NOPE", "/tpdf/get_file",
+                    "/tpdf/preview?dir_name=NOPE", "/tpdf/positioning?dir_name=NOPE",
+                    "/tpdf/get_file_with_data?dir_name=NOPE",
+                    "/tpdf/get_zip_with_data?dir_name=NOPE",
+                    "/tpdf/get_file?dir_name=..", "/tpdf/get_file?dir_name=.hidden"):
+            with self.subTest(url=url):
+                await self.assertStatus(await self.client.get(url), 404)
+
+    async def test_no_data_file(self):
+        for url in ("/tpdf/get_file_with_data?dir_name=ClearPage",
+                    "/tpdf/get_zip_with_data?dir_name=ClearPage"):
+            with self.subTest(url=url):
+                await self.assertStatus(await self.client.get(url), 404)
+
+    async def test_save_form_fields(self):
+        response = await self.client.post(
+            "/tpdf/save_form_fields", json={"pos": {"dir_name": "NOPE"}})
+        await self.assertStatus(response, 404)
+        for body in ("{", "{}", '{"pos": 1}'):
+            with self.subTest(body=body):
+                response = await self.client.post(
+                    "/tpdf/save_form_fields", data=body,
+                    headers={"Content-Type": "application/json"})
+                await self.assertStatus(response, 400)
+
+    async def test_template_metrics(self):
+        """Неизвестные имена шаблонов не попадают в метки метрик"""
+        for i in range(5):
+            await self.client.get("/tpdf/get_file?dir_name=NOPE%d" % i)
+        metrics = await (await self.client.get("/metrics")).text()
+        self.assertNotIn('template="NOPE', metrics)
+
+
+class ZipWithDataTest(AppTestCase):
+
+    async def test_json_rows(self):
+        response = await self.client.post("/tpdf/get_zip_with_data", json={
+            "complete": [["try_xlsx", 1], ["ClearPage", 2]],
+            "rows": [{"last_name": "Иванова"}, {"last_name": "Петрова"}],
+            "name": "{last_name}"})
+        await response.read()
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.content_type, "application/zip")
+
+    async def test_bad_json(self):
+        for body in ("{", "[]", "{}", '{"complete": 5}', '{"complete": []}',
+                     '{"complete": [["try_xlsx", "x"]]}',
+                     '{"complete": [["try_xlsx", 1]], "rows": {"a": 1}}',
+                     '{"complete": [["try_xlsx", 1]], "name": 5}',
+                     '{"complete": [["try_xlsx", 1]], "name": "{unknown_field"}'):
+            with self.subTest(body=body):
+                response = await self.client.post(
+                    "/tpdf/get_zip_with_data", data=body,
+                    headers={"Content-Type": "application/json"})
+                await self.assertStatus(response, 400)
+
+
+class ETagTest(AppTestCase):
+    """Ключ кэша результатов - ETag: повторный запрос с If-None-Match - 304"""
+
+    async def test_not_modified(self):
+        url = "/tpdf/get_file?dir_name=ClearPage"
+        response = await self.client.get(url)
+        body = await response.read()
+        self.assertEqual(response.status, 200)
+        etag = response.headers["ETag"]
+        for if_none_match in (etag, "*", '"other", ' + etag):
+            with self.subTest(if_none_match=if_none_match):
+                response = await self.client.get(url, headers={"If-None-Match": if_none_match})
+                await self.assertStatus(response, 304)
+                self.assertEqual(response.headers["ETag"], etag)
+        # другой ETag - pdf из кэша, тот же самый
+        response = await self.client.get(url, headers={"If-None-Match": '"other"'})
+        self.assertEqual(await response.read(), body)
+        self.assertEqual(response.headers["ETag"], etag)
+
+    async def test_b64(self):
+        """У base64 варианта свой ETag"""
+        url = "/tpdf/get_file?dir_name=ClearPage"
+        etag = (await self.client.get(url)).headers["ETag"]
+        response = await self.client.get(url + "&b64=True", headers={"If-None-Match": etag})
+        await self.assertStatus(response, 200)
+        self.assertNotEqual(response.headers["ETag"], etag)
+
+    async def test_depends_on_options(self):
+        url = "/tpdf/get_file?dir_name=ClearPage"
+        etag = (await self.client.get(url)).headers["ETag"]
+        response = await self.client.get(url + "&compress=0", headers={"If-None-Match": etag})
+        await response.read()
+        self.assertEqual(response.status, 200)